@@ -1,7 +1,9 @@
 from django.contrib import admin
-from main.models import Project, ProjectTag, ProjectTagAdmin, ProjectAdmin, ProjectUpload, Announcement
+from main.models import Project, ProjectTag, ProjectTagAdmin, ProjectAdmin, ProjectUpload, ProjectPurge, \
+    Announcement
 
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(ProjectTag, ProjectTagAdmin)
 admin.site.register(ProjectUpload)
+admin.site.register(ProjectPurge)
 admin.site.register(Announcement)
@@ -0,0 +1,500 @@
+"""Helpers for exporting a project's data as a zip file.
+
+The export is produced as a stream: export_entries generates the
+(file name, contents) pairs one task at a time, and zip_chunks
+compresses each entry and hands back the zip file's bytes as soon as
+they are written, so the whole archive never has to sit in memory.
+
+Full exports are cached: build_export writes the zip file to
+settings.CLICKWORK_EXPORT_DIR, under a name that includes the
+project's export marker, which changes whenever the set of completed
+tasks changes or any of their Responses or Results is saved or
+deleted.  Until then, the file can be served again as it is.  The
+first time, the file can be sent to the client while it is being
+written; see export_chunks.
+
+A project can be exported in one of several formats (see
+main.models.EXPORT_FORMAT_CHOICES).  The default puts the files that
+each task's export() method returns into the zip file under the
+task's id.  The table formats instead put the rows that each task's
+export_rows() method returns into one JSON lines or CSV file per
+table and per batch of tasks, named for the table and the range of
+task ids in the batch, which makes for far fewer, larger entries.
+The CSV files of a table all have the same header, so they can be
+concatenated.
+
+When settings.CLICKWORK_EXPORT_WORKERS is more than 1, the batches
+are rendered by a pool of worker processes, each with its own
+database connection; their entries are still written in task order,
+and only a few batches are rendered ahead of the one being written.
+
+Each task's rendered export is cached in CachedTaskExport along with
+the task's modified time, so that a task is only rendered again once
+it or its Responses or Result have changed.
+
+An export can also be incremental, containing only the tasks whose
+Responses or Result have been saved since a given time (the
+"watermark"); see changed_tasks.  Incremental exports end with a
+manifest giving the watermark to use for the next one.  Exports can
+also be narrowed down to some of the tasks; see filter_tasks.  Only
+unfiltered full exports are cached."""
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, Max
+
+from main.helpers import get_project_type, bounded_imap
+from main.models import CachedTaskExport, ProjectExport, Task
+from main.types import type_list
+
+from cStringIO import StringIO
+import base64
+import csv
+import datetime
+import hashlib
+import itertools
+import multiprocessing
+import os
+import simplejson as json
+import tempfile
+import zipfile
+
+#: Format of the watermarks in manifests and in the "since" parameter.
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def parse_watermark(value):
+    """Turn a watermark string into a datetime; the fractional seconds
+    may be left out.  Raises ValueError if the string is malformed."""
+    try:
+        return datetime.datetime.strptime(value, WATERMARK_FORMAT)
+    except ValueError:
+        return datetime.datetime.strptime(value, WATERMARK_FORMAT[:-3])
+
+def completed_tasks(project):
+    """Return a QuerySet of the tasks that a full export includes."""
+    return Task.objects.filter(completed=True, project=project)
+
+def changed_tasks(project, since):
+    """Return a QuerySet of the completed tasks whose Responses or
+    Result have changed after the given datetime."""
+    return completed_tasks(project).filter(modified__gt=since)
+
+#: The parameters that filter_tasks understands.
+EXPORT_FILTERS = ("min_id", "max_id", "ids", "merged", "merged_after", "merged_before",
+                  "annotators")
+
+def _id_list(value):
+    return [int(task_id) for task_id in value.split(",") if task_id.strip()]
+
+def filter_tasks(tasks, parameters):
+    """Narrow down a QuerySet of tasks to export according to the
+    given request parameters, all of which are optional:
+
+      * min_id, max_id: the range of task ids to include;
+      * ids: a comma-separated list of task ids;
+      * merged: if "true", only the tasks that have a Result;
+      * merged_after, merged_before: only the tasks whose Result was
+        finished in this window (watermarks, like "since");
+      * annotators: a comma-separated list of usernames; only the
+        tasks that at least one of them has responded to.
+
+    The filters are all done in the database.  Raises ValueError if
+    any of the parameters is malformed."""
+    if parameters.get("min_id"):
+        tasks = tasks.filter(id__gte=int(parameters["min_id"]))
+    if parameters.get("max_id"):
+        tasks = tasks.filter(id__lte=int(parameters["max_id"]))
+    if parameters.get("ids"):
+        tasks = tasks.filter(id__in=_id_list(parameters["ids"]))
+    if parameters.get("merged") == "true":
+        tasks = tasks.filter(result__isnull=False)
+    if parameters.get("merged_after"):
+        tasks = tasks.filter(result__end_time__gte=parse_watermark(parameters["merged_after"]))
+    if parameters.get("merged_before"):
+        tasks = tasks.filter(result__end_time__lt=parse_watermark(parameters["merged_before"]))
+    if parameters.get("annotators"):
+        usernames = [name.strip() for name in parameters["annotators"].split(",")]
+        tasks = tasks.filter(response__user__username__in=usernames).distinct()
+    return tasks
+
+def task_id_batches(tasks):
+    """Yield the ids of the tasks in the given QuerySet, in order, in
+    lists of settings.CLICKWORK_EXPORT_BATCH_SIZE."""
+    batch = []
+    for task_id in tasks.order_by("id").values_list("id", flat=True).iterator():
+        batch.append(task_id)
+        if len(batch) >= settings.CLICKWORK_EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def manifest_entry(project, since, watermark):
+    """Return the (pathname, contents) pair for the manifest of an
+    incremental export."""
+    manifest = {"project": project.id,
+                "since": since and since.strftime(WATERMARK_FORMAT),
+                "watermark": watermark.strftime(WATERMARK_FORMAT)}
+    return "manifest.json", json.dumps(manifest, indent=2)
+
+def _json_value(value):
+    """Turn the values that simplejson can't handle (dates and times,
+    mostly) into strings."""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return unicode(value)
+
+def jsonl_table(rows, columns):
+    """Render a list of row dicts as JSON lines: one JSON object per
+    line.  The columns are not needed; see csv_table."""
+    return "".join(json.dumps(row, sort_keys=True, default=_json_value) + "\n"
+                   for row in rows)
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    elif hasattr(value, "isoformat"):
+        return value.isoformat()
+    return unicode(value).encode("utf-8")
+
+def csv_table(rows, columns):
+    """Render a list of row dicts as CSV, with a header line naming
+    the given columns.  columns is a list shared by all the files of
+    one table in an export, so that they all have the same header: it
+    starts out empty and is filled in from the first rows rendered,
+    and any columns that only turn up later are added to the end."""
+    known = set(columns)
+    columns.extend(sorted(set(column for row in rows if not known.issuperset(row)
+                              for column in row) - known))
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+    return output.getvalue()
+
+#: How to render a table in each of the table formats.
+TABLE_RENDERERS = {"jsonl": jsonl_table, "csv": csv_table}
+
+def _file_payload(task, task_data):
+    """Turn what a task's export() method returned into a list of
+    [pathname, base64-encoded contents] pairs, which can be stored as
+    JSON."""
+    if type(task_data) != dict:
+        task_data = {None: task_data}
+    payload = []
+    for key, val in task_data.items():
+        if isinstance(val, unicode):
+            val = val.encode("utf-8")
+        if key is None:
+            pathname = "task-%s" % task.id
+        else:
+            pathname = "task-%s-%s" % (task.id, key)
+        payload.append([pathname, base64.b64encode(val)])
+    return payload
+
+def _rows_payload(task, task_tables):
+    """Turn what a task's export_rows() method returned into plain
+    JSON values, the way they will be rendered."""
+    return json.loads(json.dumps(task_tables, default=_json_value))
+
+#: How to render each kind of payload, and which ProjectType method
+#: renders the tasks in a batch for it.
+PAYLOAD_KINDS = {"files": (_file_payload, "export_batch"),
+                 "rows": (_rows_payload, "export_rows_batch")}
+
+def cached_payloads(ptype, task_ids, kind):
+    """Yield a (task id, payload) pair for each task in one batch, in
+    order, where the payload is the task's export, of the given kind
+    (see PAYLOAD_KINDS), in a form that can be stored as JSON.  The
+    payloads of tasks that have not been modified since they were
+    last exported are taken from CachedTaskExport; only the others
+    are rendered, and then cached, unless
+    settings.CLICKWORK_EXPORT_TASK_CACHE is False."""
+    to_payload, method = PAYLOAD_KINDS[kind]
+    use_cache = settings.CLICKWORK_EXPORT_TASK_CACHE
+    payloads = {}
+    if use_cache:
+        ## Read the versions before rendering anything, so that a
+        ## task that changes while it is being rendered is not
+        ## cached as if it were up to date.
+        versions = dict(Task.objects.filter(pk__in=task_ids).values_list("id", "modified"))
+        for task_id, version, payload in CachedTaskExport.objects.filter(
+                task__in=task_ids, kind=kind).values_list("task", "version", "payload"):
+            if versions.get(task_id) == version:
+                payloads[task_id] = json.loads(payload)
+    dirty = [task_id for task_id in task_ids if task_id not in payloads]
+    if dirty:
+        fresh = []
+        for task, task_data in getattr(ptype, method)(dirty):
+            payloads[task.id] = to_payload(task, task_data)
+            if use_cache:
+                fresh.append((task.id, versions.get(task.id), json.dumps(payloads[task.id])))
+        if fresh:
+            store_payloads(kind, fresh)
+    for task_id in task_ids:
+        if task_id in payloads:
+            yield task_id, payloads[task_id]
+
+def store_payloads(kind, rows):
+    """Cache the given (task id, version, payload) rows of the given
+    kind, replacing whatever was cached for those tasks before, in one
+    DELETE and one INSERT.  If another export is caching some of the
+    same tasks at the same time, the INSERT can clash with it; the
+    rows are just left uncached then, for the next export to cache."""
+    CachedTaskExport.objects.filter(task__in=[row[0] for row in rows], kind=kind).delete()
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    params = []
+    for task_id, version, payload in rows:
+        params.extend([task_id, kind, version, payload])
+    cursor = connection.cursor()
+    sid = transaction.savepoint()
+    try:
+        cursor.execute("INSERT INTO %s (task_id, kind, version, payload) VALUES %s" % \
+                           (CachedTaskExport._meta.db_table, values), params)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+
+def batch_tables(ptype, task_ids):
+    """Return a dict of the rows of each table for one batch of tasks
+    in one of the table formats, in task order."""
+    tables = {}
+    for task_id, task_tables in cached_payloads(ptype, task_ids, "rows"):
+        for table, rows in task_tables.items():
+            tables.setdefault(table, []).extend(rows)
+    return tables
+
+def table_entries(task_ids, tables, format, columns):
+    """Yield (pathname, contents) pairs for the tables of one batch of
+    tasks (see batch_tables): one file per table, named like
+    <table>-<first task id>-<last task id>.<format>.  columns is a
+    dict, shared by every batch of one export, of each table's
+    columns (see csv_table)."""
+    render = TABLE_RENDERERS[format]
+    for table in sorted(tables):
+        yield "%s-%s-%s.%s" % (table, task_ids[0], task_ids[-1], format), \
+            render(tables[table], columns.setdefault(table, []))
+
+def file_entries(ptype, task_ids):
+    """Yield (pathname, contents) pairs for the files that the tasks
+    in one batch export, named like task-<task id>-<file name>."""
+    for task_id, payload in cached_payloads(ptype, task_ids, "files"):
+        for pathname, val in payload:
+            yield pathname, base64.b64decode(val)
+
+def batch_output(ptype, task_ids, format):
+    """Render one batch of tasks in the given format: for the files
+    format, an iterable of (pathname, contents) pairs; for the table
+    formats, the batch's tables (see batch_tables), which are only
+    turned into files once the columns of the export's earlier
+    batches are known."""
+    if format == "files":
+        return file_entries(ptype, task_ids)
+    else:
+        return batch_tables(ptype, task_ids)
+
+def render_batch(args):
+    """Render one batch of tasks; args is a tuple of the name of the
+    project type, the list of task ids and the format.  Returns what
+    batch_output does, with the files format's entries in a list.
+    This runs in a worker process."""
+    type_name, task_ids, format = args
+    output = batch_output(type_list[type_name], task_ids, format)
+    if format == "files":
+        output = list(output)
+    return output
+
+def _parallel_batches(ptype, tasks, format, workers):
+    ## The ids are all fetched up front, because the database
+    ## connection is closed before the workers are forked: a worker
+    ## that inherited it would share it with this process, and
+    ## closing or dropping it there would end this process's session
+    ## too.  Each worker, and this process afterwards, opens a
+    ## connection of its own.  There must be nothing uncommitted.
+    batches = [(ptype.name, task_ids, format) for task_ids in task_id_batches(tasks)]
+    connection.close()
+    pool = multiprocessing.Pool(workers)
+    try:
+        ## The batches' output comes back in order, however the
+        ## workers happen to finish, and only a couple of batches per
+        ## worker are rendered ahead of the one being written out.
+        for batch, output in itertools.izip(
+                batches, bounded_imap(pool, render_batch, batches, 2 * workers)):
+            yield batch[1], output
+    finally:
+        pool.terminate()
+
+def task_entries(ptype, tasks, format):
+    """Yield the (pathname, contents) pairs for all the given tasks in
+    the given format, in task id order.  When
+    settings.CLICKWORK_EXPORT_WORKERS is more than 1, the batches of
+    tasks are rendered by that many worker processes."""
+    workers = settings.CLICKWORK_EXPORT_WORKERS
+    if workers > 1:
+        batches = _parallel_batches(ptype, tasks, format, workers)
+    else:
+        batches = ((task_ids, batch_output(ptype, task_ids, format))
+                   for task_ids in task_id_batches(tasks))
+    columns = {}
+    for task_ids, output in batches:
+        if format != "files":
+            output = table_entries(task_ids, output, format, columns)
+        for entry in output:
+            yield entry
+
+def export_entries(project, ptype, tasks=None, format="files"):
+    """Yield (pathname, contents) pairs for everything in the export
+    of the given project, which should already have been cast to its
+    project type's subclass.  A project type can put an export method
+    on its task and/or its project subclass, and an export_rows method
+    on its task subclass for the table formats.  If tasks is given, it
+    is a QuerySet of the tasks to export; by default all the completed
+    tasks are exported."""
+    try:
+        data = project.export()
+        for key, val in data.items():
+            yield "project-%s" % key, val
+    except NotImplementedError:
+        pass
+    if tasks is None:
+        tasks = completed_tasks(project)
+    try:
+        for entry in task_entries(ptype, tasks, format):
+            yield entry
+    except NotImplementedError:
+        pass
+
+class ZipStream(object):
+    """A write-only file-like object for zipfile.ZipFile to write to.
+    Whatever has been written since the last call to drain() can be
+    collected by calling it.  ZipFile.writestr() does not need to
+    seek, only to know its position, so this is all it needs."""
+    def __init__(self):
+        self.pieces = []
+        self.position = 0
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = "".join(self.pieces)
+        self.pieces = []
+        return data
+
+def zip_chunks(entries):
+    """Given an iterable of (pathname, contents) pairs, where the
+    contents are bytestrings or unicode objects, yield the bytes of a
+    zip file containing them, a few entries' worth at a time.  The
+    zip file uses the ZIP64 extensions if it has to, that is if it has
+    more than 65535 entries or is bigger than 2GB."""
+    stream = ZipStream()
+    zip = zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    for pathname, data in entries:
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        info = zipfile.ZipInfo(pathname)
+        info.external_attr = settings.CLICKWORK_EXPORT_FILE_PERMISSIONS << 16L
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zip.writestr(info, data)
+        chunk = stream.drain()
+        if chunk:
+            yield chunk
+    zip.close()
+    yield stream.drain()
+
+def export_marker(project, format="files"):
+    """Return a hex digest that changes whenever the full export of
+    the given project in the given format would change."""
+    stats = completed_tasks(project).aggregate(count=Count("id"), last_modified=Max("modified"))
+    return hashlib.sha1("%s %s %s %s" % (project.id, stats["count"],
+                                         stats["last_modified"], format)).hexdigest()
+
+def rekey_export(export, project):
+    """If the given project has changed since the given ProjectExport
+    was asked for, so that its marker is out of date, give it the
+    project's current marker instead, so that what is built is filed
+    under the state of the project it shows; unless there already is
+    an export with that marker, in which case the out of date one is
+    deleted.  Returns whether the export is still there to build."""
+    marker = export_marker(project, export.format)
+    if marker == export.marker:
+        return True
+    if ProjectExport.objects.filter(project=project, marker=marker).exists():
+        export.delete()
+        return False
+    export.marker = marker
+    sid = transaction.savepoint()
+    try:
+        export.save()
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        ## another process asked for the same export just now
+        transaction.savepoint_rollback(sid)
+        ProjectExport.objects.filter(pk=export.pk).delete()
+        return False
+    return True
+
+def export_chunks(export):
+    """Build the zip file for the given ProjectExport, yielding its
+    bytes as they are written, and mark it complete once they all
+    have been; if there is nothing to export, nothing is yielded, and
+    that is recorded as the export's error instead.  Older exports of
+    the same project in the same format are thrown away.  If the
+    caller stops early, the partly written file is thrown away too,
+    and the export is left incomplete.
+
+    The export is first given the project's current marker (see
+    rekey_export); if that makes it a duplicate, it is deleted and
+    nothing is yielded, and its id is set to None."""
+    ptype = get_project_type(export.project)
+    project = ptype.cast(export.project)
+    if not rekey_export(export, project):
+        export.id = None
+        return
+    entries = export_entries(project, ptype, format=export.format)
+    try:
+        first_entry = entries.next()
+    except StopIteration:
+        export.error = "Project %s could not be exported; the export file is empty." % \
+            repr(project)
+    else:
+        if not os.path.isdir(settings.CLICKWORK_EXPORT_DIR):
+            os.makedirs(settings.CLICKWORK_EXPORT_DIR)
+        ## write to a temporary file first, so that nobody is ever
+        ## served a partly written export
+        fd, temp_path = tempfile.mkstemp(".zip", dir=settings.CLICKWORK_EXPORT_DIR)
+        f = os.fdopen(fd, "wb")
+        try:
+            for chunk in zip_chunks(itertools.chain([first_entry], entries)):
+                f.write(chunk)
+                yield chunk
+            f.close()
+            os.rename(temp_path, export.path)
+        except:
+            f.close()
+            os.remove(temp_path)
+            raise
+    export.complete = True
+    export.full_clean()
+    export.save()
+    for old_export in ProjectExport.objects.filter(project=export.project, format=export.format) \
+            .exclude(pk=export.pk):
+        if os.path.exists(old_export.path):
+            os.remove(old_export.path)
+        old_export.delete()
+
+def build_export(export):
+    """Write the zip file for the given ProjectExport all at once; see
+    export_chunks."""
+    for chunk in export_chunks(export):
+        pass
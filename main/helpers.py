@@ -3,6 +3,8 @@ from main.types import type_list
 from django.contrib.auth.models import User
 from django.conf import settings
 
+import collections
+import itertools
 import sys
 from functools import wraps
 
@@ -26,3 +28,17 @@ def get_project_type(project):
     if type_list.has_key(project.type):
         return type_list[project.type]
     raise Exception("Project %s has type %s, which is not in: %s" % (project.id, project.type, type_list.keys()))    
+
+def bounded_imap(pool, function, items, window):
+    """Like pool.imap(function, items), yielding the results in the
+    order of the items, but only ever handing the pool window items
+    more than have been yielded, so that results which the caller has
+    not got round to yet cannot pile up without limit."""
+    items = iter(items)
+    pending = collections.deque(pool.apply_async(function, (item,))
+                                for item in itertools.islice(items, window))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.apply_async(function, (item,)))
+        yield result
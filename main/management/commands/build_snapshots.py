@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.models import DashboardSnapshot
+from main.views.overview import SNAPSHOTS
+
+class Command(BaseCommand):
+    args = '[<page> ...]'
+    help = 'Rebuild the snapshots of the given overview pages (or of all of them): %s' % \
+        ", ".join(sorted(SNAPSHOTS))
+
+    def handle(self, *args, **options):
+        names = args or sorted(SNAPSHOTS)
+        for name in names:
+            if name not in SNAPSHOTS:
+                raise CommandError('There is no overview page called %s' % name)
+        for name in names:
+            DashboardSnapshot.store(name, SNAPSHOTS[name]())
+            self.stdout.write('Rebuilt the snapshot of %s\n' % name)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.models import Project, ProjectStats
+
+class Command(BaseCommand):
+    args = '[<project id> ...]'
+    help = 'Count the tasks of the given projects (or of all projects) from scratch'
+
+    def handle(self, *args, **options):
+        if args:
+            try:
+                project_ids = [int(arg) for arg in args]
+            except ValueError:
+                raise CommandError('Project ids must be numbers')
+        else:
+            project_ids = Project.objects.order_by("id").values_list("id", flat=True)
+        for project_id in project_ids:
+            if not Project.objects.filter(pk=project_id).exists():
+                raise CommandError('Project %d does not exist' % project_id)
+            ProjectStats.rebuild(project_id)
+            self.stdout.write('Rebuilt the stats of project %d\n' % project_id)
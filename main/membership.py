@@ -0,0 +1,90 @@
+"""A process-wide cache of which active users belong to which groups.
+
+The overview pages show the members of a lot of groups, and group
+membership hardly ever changes, so rather than walking each group's
+user_set on every request, group_members remembers the usernames of
+each group's active members.  The signal receivers below forget a
+group's members as soon as this process sees them change; since other
+processes may change them too, everything is also forgotten once it
+is settings.CLICKWORK_GROUP_CACHE_TTL seconds old."""
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+import threading
+import time
+
+_members = {}
+_loaded = [time.time()]
+_lock = threading.Lock()
+
+def invalidate(group_ids=None):
+    """Forget the members of the given groups, or of all groups."""
+    with _lock:
+        if group_ids is None:
+            _members.clear()
+            _loaded[0] = time.time()
+        else:
+            for group_id in group_ids:
+                _members.pop(group_id, None)
+
+def group_members(group_ids):
+    """Return a dict mapping each of the given group ids to a sorted
+    list of the usernames of the group's active members.  The groups
+    that are not cached yet are all fetched in a single query."""
+    if time.time() - _loaded[0] > settings.CLICKWORK_GROUP_CACHE_TTL:
+        invalidate()
+    with _lock:
+        result = dict((group_id, _members[group_id])
+                      for group_id in group_ids if group_id in _members)
+    missing = [group_id for group_id in group_ids if group_id not in result]
+    if missing:
+        fetched = dict((group_id, []) for group_id in missing)
+        for group_id, username in User.groups.through.objects \
+                .filter(group__in=missing, user__is_active=True) \
+                .values_list("group", "user__username"):
+            fetched[group_id].append(username)
+        for usernames in fetched.values():
+            usernames.sort()
+        with _lock:
+            _members.update(fetched)
+        result.update(fetched)
+    return result
+
+@receiver(m2m_changed, sender=User.groups.through)
+def on_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if reverse:
+        ## instance is a group, and its users changed
+        invalidate([instance.id])
+    elif pk_set is not None:
+        invalidate(pk_set)
+    else:
+        ## all of a user's groups were cleared, and we no longer know
+        ## which they were
+        invalidate()
+
+@receiver(post_save, sender=User)
+def on_user_saved(sender, instance, created, **kwargs):
+    ## Users are saved every time they log in, so only forget the
+    ## user's groups whose cached members no longer match the user's
+    ## username and active flag (because the user has been renamed,
+    ## deactivated or reactivated).
+    if created or not _members:
+        return
+    group_ids = list(instance.groups.values_list("id", flat=True))
+    with _lock:
+        stale = [group_id for group_id in group_ids if group_id in _members and
+                 (instance.username in _members[group_id]) != instance.is_active]
+    invalidate(stale)
+
+@receiver(post_delete, sender=User)
+def on_user_deleted(sender, instance, **kwargs):
+    invalidate()
+
+@receiver(post_delete, sender=Group)
+def on_group_deleted(sender, instance, **kwargs):
+    invalidate([instance.id])
@@ -1,13 +1,17 @@
 from django import forms
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
 from django.contrib import admin
 from django.contrib.auth.models import Group, User
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.template.loader import get_template
+from contextlib import contextmanager
 import datetime
 import inspect
+import simplejson as json
+import os
 import sys
+import threading
 
 def abstract():
     """Function to work around (pre-2.6) Python's lack of abstract methods.
@@ -160,6 +164,9 @@ class TaskManager(models.Manager):
         ## object raises an exception from deep in the bowels of
         ## Django.  I assume this is a Django bug.
         tasks = self.exclude(project__priority=-1)
+        ## Projects that are being emptied are hidden while their
+        ## tasks are deleted (see ProjectPurge).
+        tasks = tasks.exclude(project__projectpurge__complete=False)
         tasks = tasks.annotate(wip_count=models.Count("workinprogress"))
         tasks = tasks.order_by("-project__priority", "project__id", "-completed_assignments", "?")
         return tasks
@@ -224,8 +231,23 @@ class Task(models.Model):
     completed_assignments = models.IntegerField(default=0)
     completed = models.BooleanField(default=False)
 
+    #: Fingerprint of the upload row this task was made from, if any
+    #: (see main.uploads.row_fingerprint); used to avoid making the
+    #: same task twice when a file is uploaded again.
+    input_fingerprint = models.CharField(max_length=40, null=True, blank=True,
+                                         editable=False)
+
+    #: When the task was last saved (other than when it was created),
+    #: a Response or Result for it was last saved or deleted, or it
+    #: was last unmerged; None if none of these has happened yet.
+    #: Changes made with QuerySet.update() don't count.
+    modified = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+
     objects = TaskManager()
 
+    class Meta:
+        unique_together = ("project", "input_fingerprint")
+
     def __unicode__(self):
         return u"task %d of %s" % (self.id, unicode(self.project))
 
@@ -341,6 +363,17 @@ class Task(models.Model):
         raise NotImplementedError("Subclasses must implement either " \
                                       "Project.export() or Task.export()")
 
+    def export_rows(self):
+        """Returns a dict whose keys are table names, such as
+        "tasks", "responses" and "results", and whose values are
+        lists of rows for those tables, each row being a dict of column
+        names and values.  This is used instead of export() when the
+        project is exported in one of the table formats (JSON lines or
+        CSV), in which the rows from every task go into one file per
+        table rather than into files of their own."""
+        raise NotImplementedError("Subclasses must implement Task.export_rows() "
+                                  "to be exported as tables")
+
     def viewable_by(self, user):
         """Indicates whether or not this task can be viewed by the given
         user."""
@@ -496,14 +529,427 @@ class ProjectUpload(models.Model):
     complete = models.BooleanField(default=False,editable=False)
     error = models.TextField(blank=True)
 
+    #: The number of rows of the upload that have been turned into
+    #: tasks and committed (only tracked for project types that
+    #: process their uploads a row at a time; see main.uploads).
+    rows_processed = models.IntegerField(default=0, editable=False)
+
+    #: The number of rows in the upload, or None if they have not
+    #: been counted yet.
+    rows_total = models.IntegerField(null=True, blank=True, editable=False)
+
+    #: Byte offset in the upload just past the last committed row;
+    #: processing resumes from here if it was interrupted.
+    byte_offset = models.BigIntegerField(default=0, editable=False)
+
+    #: The number of rows that were not turned into tasks because
+    #: the project already had tasks for them.
+    rows_skipped = models.IntegerField(default=0, editable=False)
+
+    #: SHA-1 digest of the uploaded file.
+    digest = models.CharField(max_length=40, blank=True, editable=False, db_index=True)
+
     def __unicode__(self):
         return u"upload %d to %s at %s" % (self.id, unicode(self.project),
                                            unicode(self.timestamp))
 
+    def as_dict(self):
+        return {"id": self.id,
+                "name": self.upload.name,
+                "url": self.upload.url,
+                "timestamp": self.timestamp,
+                "complete": self.complete,
+                "error": self.error,
+                "rows_processed": self.rows_processed,
+                "rows_skipped": self.rows_skipped,
+                "rows_total": self.rows_total}
+
+class UploadFingerprint(models.Model):
+    """How many of the rows committed so far from an upload had the
+    given contents, identified by the fingerprint of their first
+    occurrence (see main.uploads.row_fingerprint).  These are kept
+    only while the upload is being processed, so that each chunk can
+    number the rows that repeat earlier ones without anything having
+    to remember every row of the upload, and so that processing can
+    resume from the upload's byte_offset."""
+    upload = models.ForeignKey(ProjectUpload)
+    fingerprint = models.CharField(max_length=40)
+    occurrences = models.IntegerField()
+
+    class Meta:
+        unique_together = ("upload", "fingerprint")
+
+    def __unicode__(self):
+        return u"%d rows like %s in %s" % (self.occurrences, self.fingerprint,
+                                           unicode(self.upload))
+
+class ProjectPurge(models.Model):
+    """Track a request to remove all the tasks from a project.  The
+    tasks are deleted in chunks, in order of their ids, each chunk in
+    its own transaction, so that emptying a large project neither
+    holds locks for long nor has to be done within a single request.
+    While a purge is incomplete, the project's tasks are not handed
+    out to annotators or mergers.
+
+    Only the tasks that existed when the purge was requested are
+    deleted; tasks uploaded after that are kept."""
+
+    project = models.ForeignKey(Project)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    complete = models.BooleanField(default=False, editable=False)
+    error = models.TextField(blank=True)
+
+    #: The highest task id in the project when the purge was requested.
+    last_task_id = models.IntegerField(editable=False)
+
+    #: The number of tasks to be deleted, and the number deleted so far.
+    tasks_total = models.IntegerField(editable=False)
+    tasks_deleted = models.IntegerField(default=0, editable=False)
+
+    def __unicode__(self):
+        return u"purge %d of %s at %s" % (self.id, unicode(self.project),
+                                          unicode(self.timestamp))
+
+    @classmethod
+    def request(cls, project):
+        """Create and save a purge of the given project's tasks."""
+        tasks = Task.objects.filter(project=project)
+        purge = cls(project=project,
+                    last_task_id=tasks.aggregate(models.Max("id"))["id__max"] or 0,
+                    tasks_total=tasks.count())
+        purge.full_clean()
+        purge.save()
+        return purge
+
+    def as_dict(self):
+        return {"id": self.id,
+                "timestamp": self.timestamp,
+                "complete": self.complete,
+                "error": self.error,
+                "tasks_deleted": self.tasks_deleted,
+                "tasks_total": self.tasks_total}
+
+    def run(self, chunk_size=None):
+        """Delete the tasks, chunk by chunk, and mark the purge complete.
+        If this is interrupted, running it again carries on from
+        wherever it stopped.
+
+        NOTE: if subclasses have customized the delete() method, these
+        bulk deletes will not call it."""
+        if chunk_size is None:
+            chunk_size = settings.CLICKWORK_PURGE_CHUNK_SIZE
+        tasks = Task.objects.filter(project=self.project, id__lte=self.last_task_id)
+        while True:
+            with transaction.commit_on_success():
+                ids = list(tasks.order_by("id").values_list("id", flat=True)[:chunk_size])
+                if ids:
+                    with bulk_deletion(self.project_id):
+                        Task.objects.filter(id__in=ids).delete()
+                    ProjectPurge.objects.filter(pk=self.pk).update(
+                        tasks_deleted=models.F("tasks_deleted") + len(ids))
+            if not ids:
+                break
+            self.tasks_deleted += len(ids)
+        self.complete = True
+        self.full_clean()
+        self.save()
+
+#: The formats a project can be exported in: one or more files per
+#: task, as returned by Task.export(), or one file per table, as
+#: returned by Task.export_rows(), in JSON lines or CSV.
+EXPORT_FORMAT_CHOICES = (("files", "Files per task"),
+                         ("jsonl", "JSON lines per table"),
+                         ("csv", "CSV per table"))
+
+class ProjectExport(models.Model):
+    """A zip file holding the full export of a project, as it was when
+    the project's export marker (see main.exports.export_marker) had
+    the given value.  The file is built once, by the task factory or
+    inline, and then served to everyone who asks for the export until
+    the project changes."""
+    project = models.ForeignKey(Project)
+    marker = models.CharField(max_length=40, editable=False)
+    format = models.CharField(max_length=10, choices=EXPORT_FORMAT_CHOICES, default="files")
+    timestamp = models.DateTimeField(auto_now_add=True)
+    complete = models.BooleanField(default=False, editable=False)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ("project", "marker")
+
+    def __unicode__(self):
+        return u"export %d of %s at %s" % (self.id, unicode(self.project),
+                                           unicode(self.timestamp))
+
+    @property
+    def path(self):
+        """Where the zip file is kept."""
+        return os.path.join(settings.CLICKWORK_EXPORT_DIR,
+                            "project-%s-%s.zip" % (self.project_id, self.marker))
+
+class ExportCursor(models.Model):
+    """Remembers, for one consumer of a project's exports, how far
+    that consumer has got, so that its next export only needs to
+    include the tasks that have changed since."""
+    project = models.ForeignKey(Project)
+    consumer = models.CharField(max_length=100)
+    watermark = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("project", "consumer")
+
+    def __unicode__(self):
+        return u"export cursor %s for %s at %s" % (self.consumer, unicode(self.project),
+                                                   unicode(self.watermark))
+
+class CachedTaskExport(models.Model):
+    """The export of one task, as rendered when the task's modified
+    time was the given version.  Exports reuse it for as long as the
+    task has not been modified since, rather than rendering the task
+    again; see main.exports.cached_payloads.  The kind is "files" for
+    what Task.export() returns and "rows" for what
+    Task.export_rows() returns.  These go away with their tasks,
+    including when a project is emptied."""
+    task = models.ForeignKey(Task)
+    kind = models.CharField(max_length=10)
+    version = models.DateTimeField(null=True, blank=True)
+    #: The rendered export, as JSON.
+    payload = models.TextField()
+
+    class Meta:
+        unique_together = ("task", "kind")
+
+    def __unicode__(self):
+        return u"cached %s export of %s at %s" % (self.kind, unicode(self.task),
+                                                  unicode(self.version))
+
+class ProjectStats(models.Model):
+    """Counts of a project's tasks in each state, kept up to date as
+    its tasks, responses, results and works in progress change (see
+    the signal receivers at the end of this module), so that overview
+    pages can read them instead of counting tasks every time.  When
+    tasks are deleted, the counts are just marked stale, and worked
+    out again from scratch by the task factory (see for_projects); the
+    rebuild_stats management command works them all out again, in
+    case they have drifted."""
+    project = models.OneToOneField(Project)
+    tasks = models.IntegerField(default=0)
+    #: Tasks that still need annotations.
+    to_tag = models.IntegerField(default=0)
+    #: Tasks that have all their annotations but no Result yet.
+    needs_merging = models.IntegerField(default=0)
+    #: Tasks that have a Result.
+    merged = models.IntegerField(default=0)
+    #: Works in progress on the project's tasks.
+    in_flight = models.IntegerField(default=0)
+    stale = models.BooleanField(default=False)
+    #: When the counts (AssignmentCounts included), or the project
+    #: itself, last changed (see ProjectStats.touch).
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"stats for %s" % unicode(self.project)
+
+    @classmethod
+    def rebuild(cls, project_id):
+        """Count the given project's tasks from scratch, and save and
+        return the counts.  If the counts are changed by someone else
+        while they are being counted, they are counted again, so that
+        newer counts are never overwritten with older ones; if they
+        keep changing, they are left marked stale."""
+        for attempt in range(3):
+            with transaction.commit_on_success():
+                stats = cls._recount(project_id)
+            if stats is not None:
+                return stats
+        cls.objects.filter(project=project_id).update(stale=True)
+        return cls.objects.get(project=project_id)
+
+    @classmethod
+    def _recount(cls, project_id):
+        """Count the given project's tasks, and save and return the
+        counts, unless its ProjectStats was created or changed by
+        someone else in the meantime, in which case return None."""
+        try:
+            stats = cls.objects.get(project=project_id)
+        except cls.DoesNotExist:
+            stats = None
+        cursor = connection.cursor()
+        cursor.execute("""SELECT COUNT(t.id),
+                                 SUM(CASE WHEN NOT t.completed THEN 1 ELSE 0 END),
+                                 SUM(CASE WHEN t.completed AND r.id IS NULL THEN 1 ELSE 0 END),
+                                 SUM(CASE WHEN r.id IS NOT NULL THEN 1 ELSE 0 END)
+                          FROM main_task AS t LEFT JOIN main_result AS r ON (r.task_id = t.id)
+                          WHERE t.project_id = %s""", [project_id])
+        counts = [int(count or 0) for count in cursor.fetchone()]
+        values = dict(zip(("tasks", "to_tag", "needs_merging", "merged"), counts))
+        values["in_flight"] = WorkInProgress.objects.filter(task__project=project_id).count()
+        values["stale"] = False
+        values["updated"] = datetime.datetime.now()
+        ## Generate assignment counts.  When a project has 5000 or more tasks,
+        ## the join-group-and-count operation using the Django QuerySet API
+        ## is painfully slow, so we are dropping back to raw SQL here.
+        cursor.execute("""SELECT completed_assignments, COUNT(t.id) AS howmany
+                          FROM main_task AS t LEFT JOIN main_result AS r ON (r.task_id = t.id)
+                          WHERE project_id = %s AND (r.id IS NULL OR NOT completed)
+                          GROUP BY completed_assignments""", [project_id])
+        assignments = cursor.fetchall()
+        if stats is None:
+            sid = transaction.savepoint()
+            try:
+                stats = cls.objects.create(project_id=project_id, **values)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                return None
+            transaction.savepoint_commit(sid)
+        elif cls.objects.filter(pk=stats.pk, updated=stats.updated).update(**values):
+            for name, value in values.items():
+                setattr(stats, name, value)
+        else:
+            return None
+        AssignmentCount.objects.filter(project=project_id).delete()
+        for completed_assignments, howmany in assignments:
+            AssignmentCount.objects.create(project_id=project_id,
+                                           completed_assignments=completed_assignments,
+                                           tasks=howmany)
+        return stats
+
+    @classmethod
+    def for_projects(cls, project_ids):
+        """Return a dict mapping each of the given project ids to its
+        ProjectStats, counting the tasks of any project that has no
+        counts yet.  Stale counts are left for the task factory to
+        count again (see rebuild_stale), and returned as they are in
+        the meantime, unless uploads are processed inline, in which
+        case they are counted again here too."""
+        stats = dict((s.project_id, s) for s in cls.objects.filter(project__in=project_ids))
+        inline = not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE
+        for project_id in project_ids:
+            if project_id not in stats or (inline and stats[project_id].stale):
+                stats[project_id] = cls.rebuild(project_id)
+        return stats
+
+    @classmethod
+    def rebuild_stale(cls):
+        """Count the tasks of every project whose counts are stale."""
+        for project_id in cls.objects.filter(stale=True).values_list("project", flat=True):
+            cls.rebuild(project_id)
+
+    @classmethod
+    def bump(cls, project_id, **deltas):
+        """Add the given amounts to the named counts of the given
+        project.  If the project has no counts yet, nothing is done;
+        they will be worked out from scratch when they are needed."""
+        changes = dict((name, models.F(name) + delta)
+                       for name, delta in deltas.items() if delta)
+        if changes:
+            cls.objects.filter(project=project_id).update(updated=datetime.datetime.now(),
+                                                          **changes)
+
+    @classmethod
+    def touch(cls, project_id):
+        """Record that something about the given project that the
+        overview pages show has changed, without changing its counts."""
+        cls.objects.filter(project=project_id).update(updated=datetime.datetime.now())
+
+    @classmethod
+    def bump_assignments(cls, project_id, completed_assignments, delta):
+        """Add delta to the number of the project's unmerged tasks with
+        the given number of completed assignments, and record that the
+        project's stats have changed (see touch)."""
+        if not cls.objects.filter(project=project_id).update(updated=datetime.datetime.now()):
+            return
+        counts = AssignmentCount.objects.filter(project=project_id,
+                                                completed_assignments=completed_assignments)
+        if counts.update(tasks=models.F("tasks") + delta):
+            return
+        ## Another process can create the same count in between; if
+        ## so, add to that one instead.
+        sid = transaction.savepoint()
+        try:
+            AssignmentCount.objects.create(project_id=project_id,
+                                           completed_assignments=completed_assignments,
+                                           tasks=delta)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            counts.update(tasks=models.F("tasks") + delta)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def assignments(self):
+        """Return a list of dicts with completed_assignments and
+        howmany keys, giving the number of unmerged tasks with each
+        number of completed assignments, followed by the numbers of
+        tasks that need merging and that are finished."""
+        result = [{"completed_assignments": count.completed_assignments,
+                   "howmany": count.tasks}
+                  for count in AssignmentCount.objects.filter(project=self.project_id, tasks__gt=0)
+                  .order_by("completed_assignments")]
+        if self.needs_merging:
+            result.append({'completed_assignments': 'Needs Merging', 'howmany': self.needs_merging})
+        if self.merged:
+            result.append({'completed_assignments': 'Finished', 'howmany': self.merged})
+        return result
+
+class AssignmentCount(models.Model):
+    """How many of a project's unmerged tasks have a given number of
+    completed assignments; kept up to date along with ProjectStats."""
+    project = models.ForeignKey(Project)
+    completed_assignments = models.IntegerField()
+    tasks = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("project", "completed_assignments")
+
+class DashboardSnapshot(models.Model):
+    """A copy, as JSON, of the data behind one of the overview pages,
+    so that the page can be served without querying for it again.
+    Snapshots are built by the build_snapshots management command or
+    the taskfactory, or on request by a superuser (see
+    main.views.overview)."""
+    name = models.CharField(max_length=64, unique=True)
+    data = models.TextField()
+    built = models.DateTimeField()
+
+    def __unicode__(self):
+        return u"snapshot of %s" % self.name
+
+    @classmethod
+    def store(cls, name, data):
+        """Save the given JSON-serializable data as the snapshot with
+        the given name, replacing any older one, and return it."""
+        snapshot, created = cls.objects.get_or_create(
+            name=name, defaults={"built": datetime.datetime.now()})
+        snapshot.data = json.dumps(data)
+        snapshot.built = datetime.datetime.now()
+        snapshot.save()
+        return snapshot
+
+    @classmethod
+    def load(cls, name, max_age):
+        """Return the snapshot with the given name, or None if there is
+        none that was built in the last max_age seconds."""
+        built_after = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        try:
+            return cls.objects.get(name=name, built__gte=built_after)
+        except cls.DoesNotExist:
+            return None
+
+    def age(self):
+        """How many seconds ago the snapshot was built."""
+        age = datetime.datetime.now() - self.built
+        return age.days * 86400 + age.seconds
+
 class ProjectType(object):
     """Represents a type of project; hence subclasses of this class
     are associated with subclasses of Project, Task, etc."""
 
+    #: An SQL condition that is true when the response whose id is
+    #: %(response)s agrees with the result whose id is %(result)s, or
+    #: None if the project type cannot tell (see
+    #: main.views.project.annotator_stats).
+    agreement_sql = None
+
     def cast(self, model):
         """Downcasts a model object from its superclass to its
         concrete class, if the project type has defined the
@@ -513,6 +959,24 @@ class ProjectType(object):
         type, then the original model object will be returned."""
         abstract()
 
+    def export_batch(self, task_ids):
+        """Given a list of task ids, in order, yield a (task, export)
+        pair for each task, where export is the return value of the
+        task's export() method.  This version casts and exports the
+        tasks one at a time; project types should override it to
+        fetch everything their export() methods need for the whole
+        batch in a few queries."""
+        for task in Task.objects.filter(pk__in=task_ids).order_by("id"):
+            task = self.cast(task)
+            yield task, task.export()
+
+    def export_rows_batch(self, task_ids):
+        """Like export_batch, but yields (task, rows) pairs, where rows
+        is the return value of the task's export_rows() method."""
+        for task in Task.objects.filter(pk__in=task_ids).order_by("id"):
+            task = self.cast(task)
+            yield task, task.export_rows()
+
 class PageTrack(models.Model):
     """Records when users arrive and depart from pages in the application."""
     user = models.ForeignKey(User, help_text="The user who saw the page.")
@@ -537,6 +1001,11 @@ class Announcement(models.Model):
 # available as models.
 import types
 
+# Likewise, these register the signal receivers that keep the group
+# membership and workload caches up to date.
+import membership
+import workload
+
 ##
 ## Set up code to receive login/logout signals and log them.  This
 ## doesn't have much to do with models, but the "Where should this
@@ -569,3 +1038,143 @@ def on_login(sender, **kwargs):
 @receiver(user_logged_out)
 def on_logout(sender, **kwargs):
     log_transition("logged out", **kwargs)
+
+##
+## Keep Task.modified up to date.  The signals are sent with the
+## concrete subclass as the sender, so we can't filter on the sender.
+##
+from django.db.models.signals import pre_save, post_save, post_delete
+
+@receiver(pre_save)
+def on_task_edited(sender, instance, **kwargs):
+    ## An edited task exports differently, too.  (This also keeps a
+    ## task that was loaded before a Response was saved from putting
+    ## its old modified time back.)
+    if isinstance(instance, Task) and instance.pk is not None:
+        instance.modified = datetime.datetime.now()
+
+@receiver(post_save)
+def on_work_saved(sender, instance, **kwargs):
+    if isinstance(instance, (Response, Result)):
+        Task.objects.filter(pk=instance.task_id).update(modified=datetime.datetime.now())
+
+@receiver(post_delete)
+def on_work_deleted(sender, instance, **kwargs):
+    ## As in on_stats_deleted, only the superclass's row counts.
+    if type(instance) in (Response, Result) and not bulk_deleting():
+        Task.objects.filter(pk=instance.task_id).update(modified=datetime.datetime.now())
+
+##
+## Keep ProjectStats up to date.  Each task remembers the state it
+## was loaded in, so that when it is saved we can tell what changed.
+##
+from django.db.models.signals import post_init, m2m_changed, class_prepared
+
+def task_state(task):
+    return (task.completed_assignments, task.completed)
+
+def on_task_loaded(sender, instance, **kwargs):
+    instance._stats_state = task_state(instance)
+
+## post_init is sent for every model instance that is loaded, so
+## rather than check each one, only listen for it from Task and its
+## subclasses (the project types' tasks), which are mostly defined
+## after this module.
+def connect_task_loaded(sender, **kwargs):
+    if issubclass(sender, Task):
+        post_init.connect(on_task_loaded, sender=sender)
+
+def _task_classes(cls):
+    yield cls
+    for subclass in cls.__subclasses__():
+        for task_class in _task_classes(subclass):
+            yield task_class
+
+for task_class in _task_classes(Task):
+    connect_task_loaded(task_class)
+class_prepared.connect(connect_task_loaded)
+
+@receiver(post_save)
+def on_stats_saved(sender, instance, created, **kwargs):
+    if isinstance(instance, Task):
+        old_state, new_state = instance._stats_state, task_state(instance)
+        instance._stats_state = new_state
+        if created:
+            ProjectStats.bump(instance.project_id, tasks=1, to_tag=int(not instance.completed),
+                              needs_merging=int(instance.completed))
+            ProjectStats.bump_assignments(instance.project_id, instance.completed_assignments, 1)
+        elif old_state != new_state and not Result.objects.filter(task=instance.pk).exists():
+            ProjectStats.bump_assignments(instance.project_id, old_state[0], -1)
+            ProjectStats.bump_assignments(instance.project_id, new_state[0], 1)
+            ProjectStats.bump(instance.project_id,
+                              to_tag=int(old_state[1]) - int(new_state[1]),
+                              needs_merging=int(new_state[1]) - int(old_state[1]))
+    elif created and isinstance(instance, (Result, WorkInProgress)):
+        on_task_work_changed(instance, 1)
+
+_bulk = threading.local()
+
+@contextmanager
+def bulk_deletion(project_id):
+    """Within this block, which should delete some of the given
+    project's tasks, the signal receivers below leave the deleted
+    tasks and their work alone, one by one; the project's stats are
+    marked stale just once instead."""
+    ProjectStats.objects.filter(project=project_id).update(
+        stale=True, updated=datetime.datetime.now())
+    _bulk.deleting = True
+    try:
+        yield
+    finally:
+        _bulk.deleting = False
+
+def bulk_deleting():
+    """Whether this thread is inside a bulk_deletion block."""
+    return getattr(_bulk, "deleting", False)
+
+@receiver(post_delete)
+def on_stats_deleted(sender, instance, **kwargs):
+    if bulk_deleting():
+        return
+    ## Deleting an instance of a subclass deletes its superclass's
+    ## row as well, and each gets a signal, so only count the latter.
+    if isinstance(instance, Task):
+        ProjectStats.objects.filter(project=instance.project_id).update(
+            stale=True, updated=datetime.datetime.now())
+    elif type(instance) in (Result, WorkInProgress):
+        on_task_work_changed(instance, -1)
+
+@receiver(post_save)
+def on_project_saved(sender, instance, created, **kwargs):
+    if isinstance(instance, Project) and not created:
+        ProjectStats.touch(instance.id)
+
+@receiver(m2m_changed, sender=Project.annotators.through)
+@receiver(m2m_changed, sender=Project.mergers.through)
+@receiver(m2m_changed, sender=Project.tags.through)
+def on_project_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        ProjectStats.touch(instance.id)
+    elif pk_set is not None:
+        for project_id in pk_set:
+            ProjectStats.touch(project_id)
+    else:
+        ProjectStats.objects.update(updated=datetime.datetime.now())
+
+def on_task_work_changed(instance, delta):
+    """Count a Result or WorkInProgress that has been created (delta
+    is 1) or deleted (delta is -1)."""
+    try:
+        project_id, completed_assignments = Task.objects.filter(pk=instance.task_id) \
+            .values_list("project", "completed_assignments")[0]
+    except IndexError:
+        ## the task is being deleted too, and its project's counts
+        ## have been marked stale
+        return
+    if isinstance(instance, Result):
+        ProjectStats.bump(project_id, merged=delta, needs_merging=-delta)
+        ProjectStats.bump_assignments(project_id, completed_assignments, -delta)
+    else:
+        ProjectStats.bump(project_id, in_flight=delta)
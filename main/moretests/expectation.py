@@ -139,12 +139,14 @@ class WebTarget(object):
                                              follow=(self.final_views is not None))
         else:
             test_case.fail("Unhandled HTTP method %s" % self.method)
+        ## a streamed response's content can only be read once
+        content = response.content
         ## check the status code
         status_code_failure_message = \
             "Status code %d not in {%s}; response content:\n%s" % \
             (response.status_code,
              ", ".join([str(s) for s in self.statuses]),
-             response.content)
+             content)
         if "Location" in response:
             status_code_failure_message += "\nLocation: %s" % response["Location"]
         test_case.assert_(response.status_code in self.statuses,
@@ -158,8 +160,8 @@ class WebTarget(object):
             test_case.assert_(final_view in self.final_views,
                               "Redirect to %s unexpected" % final_path)
         ## unmarshal the JSON in the response and return it to the caller
-        if response.content:
-            return json.loads(response.content)
+        if content:
+            return json.loads(content)
         elif response.status_code in (301, 302):
             return {"__redirected_to__": response["Location"]}
         else:
@@ -22,16 +22,30 @@ u'Test Project'
 >>> p.delete()
 """
 from django.test.client import Client
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.contrib.auth.models import User, Group
 from django.conf import settings
-from main.models import Project, Review, Response
+from django.db import connection
+from main.models import Project, ProjectTag, Review, Response, ProjectUpload, ProjectPurge, \
+    ProjectExport, CachedTaskExport, ProjectStats, WorkInProgress, ExportCursor, \
+    UploadFingerprint
+from main.exports import export_entries, render_batch, table_entries, csv_table, \
+    parse_watermark, zip_chunks, export_marker, build_export
+from main.uploads import process_upload, read_rows, csv_row, shard_boundaries, upload_digest, \
+    read_fingerprinted_rows, row_fingerprint, parse_shard, text_row
 
-from main.wrapper import RequestGuts, ForbiddenResponse
+from main.wrapper import RequestGuts, ForbiddenResponse, AttachmentResponse
 from main.helpers import *
 import main.views.base
+import main.views.overview
+import main.views.project
+import main.membership
+import main.workload
+import main.uploads
 import main.types
-from main.types.simple import SimpleProject, SimpleTask, SimpleResponse
+from main.types.simple import SimpleProject, SimpleTask, SimpleResponse, SimpleResult
 
 from main.moretests.expectation import Conditions, WebTarget, ViewExpectation
 
@@ -39,12 +53,20 @@ from main.templatetags import url
 
 import datetime
 import doctest
+import os
+import shutil
+import simplejson as json
 import sys
+import tempfile
+import threading
 import unittest
 
 from cStringIO import StringIO
-from base64 import b64decode
+from base64 import b64decode, b64encode
 from zipfile import ZipFile, ZIP_DEFLATED
+import bz2
+import gzip
+import multiprocessing
 
 class WrapperTests(TestCase):
     def setUp(self):
@@ -64,6 +86,17 @@ class WrapperTests(TestCase):
         expectation = ViewExpectation(Conditions.null(), target)
         expectation.check(self)
 
+    def test_attachment_json_streamed(self):
+        """
+        JSON attachments are base64-encoded a piece at a time.
+        """
+        pieces = ["a", "bcde", "", "fghijklm", "n"]
+        for contents in ("".join(pieces), pieces, StringIO("".join(pieces))):
+            response = AttachmentResponse("test.txt", "text/plain", contents).sprout_json({})
+            self.failUnlessEqual(json.loads(response.content),
+                                 {"name": "test.txt", "content_type": "text/plain",
+                                  "contents_in_base64": b64encode("abcdefghijklmn")})
+
 class BaseViews(TestCase):
 
     def setUp(self):
@@ -78,9 +111,7 @@ class BaseViews(TestCase):
         target = WebTarget("GET", main.views.base.home)
         def honey_i_am_home(input_context, output_context):
             """Check for JSON output that could only have come from the home page."""
-            return all(["respondable_tasks" in output_context,
-                        "respondable_task_count" in output_context,
-                        "resolvable_tasks" in output_context,
+            return all(["respondable_task_count" in output_context,
                         "resolvable_task_count" in output_context,
                         "recent_responses" in output_context,
                         "reviews" in output_context])
@@ -128,6 +159,473 @@ class ProjectViews(TestCase):
         self.t = t
         self.user = u
         self.p = p
+        self.old_export_dir = settings.CLICKWORK_EXPORT_DIR
+        settings.CLICKWORK_EXPORT_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.CLICKWORK_EXPORT_DIR)
+        settings.CLICKWORK_EXPORT_DIR = self.old_export_dir
+
+    def export_project_cached(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        url = "/project/%d/export/" % self.p.id
+        ## the first export is streamed as it is built, and saved
+        first = self.client.get(url)
+        self.failUnlessEqual(first.status_code, 200)
+        self.failIf(first.has_header("ETag"))
+        contents = first.content
+        self.failUnlessEqual(len(os.listdir(settings.CLICKWORK_EXPORT_DIR)), 1)
+        again = self.client.get(url)
+        etag = again["ETag"]
+        self.failUnlessEqual(again.content, contents)
+        self.failUnlessEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        ## taking away a response changes the export
+        SimpleResponse.objects.get(task=self.t).delete()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.failUnlessEqual(changed.status_code, 200)
+        changed.content
+        self.failIfEqual(self.client.get(url)["ETag"], etag)
+        etag = self.client.get(url)["ETag"]
+        t2 = SimpleTask(question="another question", project=self.p, completed=True)
+        t2.full_clean()
+        t2.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.failUnlessEqual(changed.status_code, 200)
+        changed.content
+        self.failIfEqual(self.client.get(url)["ETag"], etag)
+        self.failUnlessEqual(len(os.listdir(settings.CLICKWORK_EXPORT_DIR)), 1)
+
+    def export_rekeyed(self):
+        """An export that was queued before the project changed is
+        built, and filed, as the project is now."""
+        export = ProjectExport.objects.create(project=self.p, marker=export_marker(self.p))
+        t2 = SimpleTask(question="another question", project=self.p, completed=True)
+        t2.full_clean()
+        t2.save()
+        build_export(export)
+        export = ProjectExport.objects.get(pk=export.pk)
+        self.failUnlessEqual((export.marker, export.complete), (export_marker(self.p), True))
+        self.failUnless(os.path.exists(export.path))
+        ## one that the current export has overtaken is dropped
+        stale = ProjectExport.objects.create(project=self.p, marker="0" * 40)
+        build_export(stale)
+        self.failUnlessEqual(list(ProjectExport.objects.filter(project=self.p)), [export])
+
+    def overview_brief(self):
+        """The brief overview gets every project's details and counts
+        in the same number of queries however many projects there
+        are."""
+        p2 = SimpleProject(admin=self.user, title="Another Project", description="Testing.",
+                           type="simple", annotator_count=1, priority=3)
+        p2.full_clean()
+        p2.save()
+        p2.mergers.add(Group.objects.get(name="test group"))
+        p2.tags.add(ProjectTag.objects.create(name="b"), ProjectTag.objects.create(name="a"))
+        projects = main.views.overview.projects_query_set([])
+        main.views.overview.brief_project_dicts(projects)
+        ## once the projects' stats have been counted: the projects,
+        ## their stats, their annotators, mergers and tags
+        with self.assertNumQueries(5):
+            brief = main.views.overview.brief_project_dicts(projects)
+        self.failUnlessEqual([(d["id"], d["remaining_to_tag"], d["remaining_to_merge"], d["merged"])
+                              for d in brief if d["id"] in (self.p.id, p2.id)],
+                             [(p2.id, 0, 0, 0), (self.p.id, 0, 1, 0)])
+        expected = [p.as_dict() for p in projects]
+        for d in brief:
+            for key in ("priority_display", "remaining_to_tag", "remaining_to_merge", "merged"):
+                del d[key]
+        self.failUnlessEqual(brief, expected)
+
+    def project_task_pages(self):
+        ids = [self.t.id]
+        for i in range(4):
+            t = SimpleTask(question="question %d" % i, project=self.p)
+            t.full_clean()
+            t.save()
+            ids.append(t.id)
+        result = SimpleResult(task=self.t, answer="merged answer", comment="merged comment",
+                              start_time=datetime.datetime(2000, 1, 1), user=self.user)
+        result.full_clean()
+        result.save()
+        task_page = main.views.overview.task_page
+        with self.assertNumQueries(1):
+            page = task_page(self.p, page_size=2)
+        self.failUnlessEqual([(t["id"], t["completed"], t["merged"]) for t in page["tasks"]],
+                             [(ids[0], True, True), (ids[1], False, False)])
+        self.failUnlessEqual((page["previous_cursor"], page["next_cursor"]), (None, ids[1]))
+        page = task_page(self.p, after=page["next_cursor"], page_size=2)
+        self.failUnlessEqual([t["id"] for t in page["tasks"]], ids[2:4])
+        self.failUnlessEqual((page["previous_cursor"], page["next_cursor"]), (ids[2], ids[3]))
+        page = task_page(self.p, after=page["next_cursor"], page_size=2)
+        self.failUnlessEqual([t["id"] for t in page["tasks"]], ids[4:])
+        self.failUnlessEqual(page["next_cursor"], None)
+        page = task_page(self.p, before=page["previous_cursor"], page_size=2)
+        self.failUnlessEqual([t["id"] for t in page["tasks"]], ids[2:4])
+        self.failUnlessEqual([t["id"] for t in task_page(self.p, "to_tag")["tasks"]], ids[1:])
+        self.failUnlessEqual([t["id"] for t in task_page(self.p, "merged")["tasks"]], ids[:1])
+        ## the cursors are in the JSON version of the project page
+        self.client.login(username="testuser_getnexttask", password="abc")
+        response = self.client.get("/project/%d/" % self.p.id,
+                                   {"response_format": "json", "state": "to_tag",
+                                    "after": str(ids[1])})
+        page = json.loads(response.content)
+        self.failUnlessEqual([t["id"] for t in page["tasks"]], ids[2:])
+        self.failUnlessEqual((page["previous_cursor"], page["next_cursor"]), (ids[2], None))
+
+    def users_page(self):
+        """The users overview counts each user's work in one query and
+        pages through the active users by username."""
+        self.user.is_superuser = True
+        self.user.save()
+        for name in ("testuser_a", "testuser_b", "testuser_c"):
+            User.objects.create_user(name, "bar@example.com", "abc")
+        User.objects.filter(username="testuser_b").update(is_active=False)
+        old_page_size = settings.CLICKWORK_USER_PAGE_SIZE
+        settings.CLICKWORK_USER_PAGE_SIZE = 2
+        try:
+            self.client.login(username="testuser_getnexttask", password="abc")
+            with self.assertNumQueries(1):
+                main.views.overview.keyset_page(User.objects.filter(is_active=True)
+                                                .values("username"), "username", None, None, 2)
+            pages = []
+            response = self.client.get("/users/", {"response_format": "json",
+                                                   "after": "testuser"})
+            while True:
+                page = json.loads(response.content)
+                pages.append([(u["name"], u["annotated"], u["merged"]) for u in page["users"]])
+                if not page["next_cursor"]:
+                    break
+                response = self.client.get("/users/", {"response_format": "json",
+                                                       "after": page["next_cursor"]})
+            ## (users left over from other tests may come after ours)
+            self.failUnlessEqual(pages[0], [("testuser_a", 0, 0), ("testuser_c", 0, 0)])
+            self.failUnlessEqual(pages[1][0], ("testuser_getnexttask", 1, 0))
+            response = self.client.get("/users/", {"response_format": "json",
+                                                   "before": "testuser_getnexttask"})
+            page = json.loads(response.content)
+            self.failUnlessEqual([u["name"] for u in page["users"]], ["testuser_a", "testuser_c"])
+        finally:
+            settings.CLICKWORK_USER_PAGE_SIZE = old_page_size
+
+    def group_members_cached(self):
+        """Group members are cached across requests, and forgotten
+        when they change."""
+        main.membership.invalidate()
+        g = Group.objects.get(name="test group")
+        self.failUnlessEqual(main.membership.group_members([g.id]), {g.id: ["testuser_getnexttask"]})
+        with self.assertNumQueries(0):
+            main.membership.group_members([g.id])
+        other = User.objects.create_user("testuser_other", "bar@example.com", "abc")
+        other.groups.add(g)
+        self.failUnlessEqual(main.membership.group_members([g.id])[g.id],
+                             ["testuser_getnexttask", "testuser_other"])
+        other.is_active = False
+        other.save()
+        self.failUnlessEqual(main.membership.group_members([g.id])[g.id], ["testuser_getnexttask"])
+        g.user_set.remove(self.user)
+        self.failUnlessEqual(main.membership.group_members([g.id])[g.id], [])
+
+    def group_details(self):
+        g = Group.objects.get(name="test group")
+        other = User.objects.create_user("testuser_other", "bar@example.com", "abc")
+        other.groups.add(g)
+        User.objects.create_user("testuser_gone", "gone@example.com", "abc").groups.add(g)
+        User.objects.filter(username="testuser_gone").update(is_active=False)
+        self.p.mergers.add(g)
+        with self.assertNumQueries(3):
+            details = main.views.overview.group_details(g)
+        self.failUnlessEqual((details["users"], details["emails"]),
+                             (["testuser_getnexttask", "testuser_other"],
+                              ["foo@example.com", "bar@example.com"]))
+        self.failUnlessEqual(details["annotates"], [{"title": "Test Project", "id": self.p.id}])
+        self.failUnlessEqual(details["merges"], details["annotates"])
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="testuser_getnexttask", password="abc")
+        response = self.client.get("/group/%d/" % g.id)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless("bar@example.com" in response.content)
+
+    def workload_cached(self):
+        """Users' workload counts are cached, and counted again when the
+        user's work or groups change."""
+        main.workload.forget()
+        other = User.objects.create_user("testuser_other", "bar@example.com", "abc")
+        workload_counts = main.workload.workload_counts
+        self.failUnlessEqual(workload_counts(other), (0, 0))
+        with self.assertNumQueries(1):
+            self.failUnlessEqual(workload_counts(other), (0, 0))
+        other.groups.add(Group.objects.get(name="test group"))
+        t2 = SimpleTask(question="another question", project=self.p)
+        t2.full_clean()
+        t2.save()
+        self.failUnlessEqual(workload_counts(other), (1, 0))
+        self.p.mergers.add(Group.objects.get(name="test group"))
+        self.failUnlessEqual(workload_counts(other), (1, 1))
+        response = SimpleResponse(task=t2, answer="answer", comment="comment",
+                                  start_time=datetime.datetime(2000, 1, 1), user=other)
+        response.full_clean()
+        response.save()
+        self.failUnlessEqual(workload_counts(other), (0, 1))
+        ## finishing an upload to a project that the user doesn't
+        ## annotate leaves the user's counts alone
+        p2 = SimpleProject(admin=self.user, title="Other Project", description="Testing.",
+                           type="simple", annotator_count=1, priority=3)
+        p2.full_clean()
+        p2.save()
+        upload = ProjectUpload(project=p2, complete=True)
+        upload.save()
+        ## (looking up the new upload, and who annotates its project)
+        with self.assertNumQueries(2):
+            self.failUnlessEqual(workload_counts(other), (0, 1))
+        ## unless uploads are processed inline, out of date counts are
+        ## returned as they are, and counted again in the background
+        refreshed = threading.Event()
+        old_refresh, old_inline = main.workload._refresh, getattr(settings, "PROCESS_INLINE", None)
+        main.workload._refresh = lambda user: refreshed.set()
+        settings.PROCESS_INLINE = False
+        try:
+            self.p.mergers.clear()
+            with self.assertNumQueries(1):
+                self.failUnlessEqual(workload_counts(other), (0, 1))
+            refreshed.wait(5)
+            self.failUnless(refreshed.is_set())
+        finally:
+            main.workload._refresh = old_refresh
+            main.workload._refreshing.discard(other.id)
+            if old_inline is None:
+                del settings.PROCESS_INLINE
+            else:
+                settings.PROCESS_INLINE = old_inline
+        self.failUnlessEqual(workload_counts(other), (0, 0))
+        ## an upload that was queued before a later one finished is
+        ## still noticed when it finishes, even in another process
+        queued = ProjectUpload(project=self.p)
+        queued.save()
+        upload = ProjectUpload(project=p2, complete=True)
+        upload.save()
+        self.failUnlessEqual(workload_counts(other), (0, 0))
+        t3 = SimpleTask(question="uploaded question", project=self.p)
+        t3.full_clean()
+        t3.save()
+        ProjectUpload.objects.filter(pk=queued.pk).update(complete=True)
+        self.failUnlessEqual(workload_counts(other), (1, 0))
+
+    def dashboard_snapshots(self):
+        """The unfiltered overview pages are served from snapshots once
+        they have been built, until a superuser refreshes them."""
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="testuser_getnexttask", password="abc")
+        call_command("build_snapshots", stdout=StringIO())
+        p2 = SimpleProject(admin=self.user, title="Later Project", description="Testing.",
+                           type="simple", annotator_count=1, priority=1)
+        p2.full_clean()
+        p2.save()
+        def titles(url, **parameters):
+            parameters["response_format"] = "json"
+            page = json.loads(self.client.get(url, parameters).content)
+            return "snapshot_age" in page, \
+                [project["title"] for project in page["project_list"]]
+        for url in ("/projects/", "/projects-long/"):
+            self.failUnlessEqual(titles(url)[0], True)
+            self.failIf("Later Project" in titles(url)[1])
+            self.failUnless("Later Project" in titles(url, refresh="1")[1])
+            self.failUnless("Later Project" in titles(url)[1])
+        ## filtered pages are never snapshots
+        self.failUnlessEqual(titles("/projects/", filter="nonexistent")[0], False)
+        response = self.client.get("/users/")
+        self.failUnless("Refresh now" in response.content)
+
+    def annotator_timing_stats(self):
+        """The project stats page works out each annotator's timings
+        and agreement in the database."""
+        other = User.objects.create_user("testuser_other", "bar@example.com", "abc")
+        tasks = [self.t]
+        for i in range(3):
+            t = SimpleTask(question="question %d" % i, project=self.p)
+            t.full_clean()
+            t.save()
+            tasks.append(t)
+        start = datetime.datetime(2000, 1, 1)
+        for task, seconds in zip(tasks, (10, 30, 100, 20)):
+            r = SimpleResponse(task=task, answer="test answer", comment="c",
+                               start_time=start, user=other)
+            r.full_clean()
+            r.save()
+            SimpleResponse.objects.filter(pk=r.pk).update(
+                end_time=start + datetime.timedelta(seconds=seconds))
+        SimpleResponse.objects.filter(user=self.user).update(
+            answer="another answer", end_time=start + datetime.timedelta(seconds=5))
+        result = SimpleResult(task=self.t, answer="test answer", comment="c",
+                              start_time=start, user=self.user)
+        result.full_clean()
+        result.save()
+        annotator_stats = main.views.project.annotator_stats
+        with self.assertNumQueries(1):
+            stats = annotator_stats(self.p, main.types.type_list["simple"].agreement_sql)
+        self.failUnlessEqual([(a["username"], a["responses"], round(a["median_duration"]),
+                               round(a["p90_duration"]), round(a["per_hour"]), a["agreement"])
+                              for a in stats],
+                             [("testuser_getnexttask", 1, 5, 5, 720, 0.0),
+                              ("testuser_other", 4, 20, 100, 90, 1.0)])
+        self.failUnlessEqual(annotator_stats(self.p)[1]["agreement"], None)
+        self.client.login(username="testuser_getnexttask", password="abc")
+        response = self.client.get("/project/%d/stats/" % self.p.id)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless("testuser_other" in response.content)
+
+    def dashboard_api(self):
+        """The JSON API pages through projects and tasks, picks out
+        fields, and answers If-None-Match."""
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="testuser_getnexttask", password="abc")
+        p2 = SimpleProject(admin=self.user, title="Later Project", description="Testing.",
+                           type="simple", annotator_count=1, priority=1)
+        p2.full_clean()
+        p2.save()
+        response = self.client.get("/api/projects/", {"after": str(self.p.id - 1), "limit": "1",
+                                                      "fields": "id,title,remaining_to_merge"})
+        self.failIf("\n" in response.content)
+        page = json.loads(response.content)
+        self.failUnlessEqual(page["projects"], [{"id": self.p.id, "title": "Test Project",
+                                                 "remaining_to_merge": 1}])
+        self.failUnlessEqual(page["next_cursor"], self.p.id)
+        page = json.loads(self.client.get("/api/projects/", {"after": str(self.p.id),
+                                                             "fields": "title"}).content)
+        self.failUnlessEqual(page["projects"], [{"title": "Later Project"}])
+        self.failUnlessEqual(self.client.get("/api/projects/", {"fields": "nonsense"}).status_code,
+                             500)
+        ## taking a project off the page changes the page
+        etag = self.client.get("/api/projects/")["ETag"]
+        self.failUnlessEqual(self.client.get("/api/projects/", HTTP_IF_NONE_MATCH=etag)
+                             .status_code, 304)
+        ## asking for other fields gets another version of the page
+        self.failUnlessEqual(self.client.get("/api/projects/", {"fields": "id"},
+                                             HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        p2.delete()
+        self.failUnlessEqual(self.client.get("/api/projects/", HTTP_IF_NONE_MATCH=etag)
+                             .status_code, 200)
+        ## so does adding a project beyond the end of the page
+        query = {"after": str(self.p.id - 1), "limit": "1"}
+        etag = self.client.get("/api/projects/", query)["ETag"]
+        p3 = SimpleProject(admin=self.user, title="Last Project", description="Testing.",
+                           type="simple", annotator_count=1, priority=1)
+        p3.full_clean()
+        p3.save()
+        response = self.client.get("/api/projects/", query, HTTP_IF_NONE_MATCH=etag)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(json.loads(response.content)["next_cursor"], self.p.id)
+        ## a change is seen at once, even within the same second
+        url = "/api/project/%d/" % self.p.id
+        query = {"state": "needs_merging", "fields": "id"}
+        response = self.client.get(url, query)
+        page = json.loads(response.content)
+        self.failUnlessEqual((page["tasks_total"], page["needs_merging"], page["tasks"]),
+                             (1, 1, [{"id": self.t.id}]))
+        etag = response["ETag"]
+        self.failIf(response.has_header("Last-Modified"))
+        self.failUnlessEqual(self.client.get(url, query, HTTP_IF_NONE_MATCH=etag).status_code,
+                             304)
+        self.failUnlessEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        t2 = SimpleTask(question="another question", project=self.p)
+        t2.full_clean()
+        t2.save()
+        response = self.client.get(url, query, HTTP_IF_NONE_MATCH=etag)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(json.loads(response.content)["tasks_total"], 2)
+        ## as is a change to how many assignments the tasks have
+        etag = response["ETag"]
+        t2 = SimpleTask.objects.get(pk=t2.pk)
+        t2.completed_assignments = 1
+        t2.full_clean()
+        t2.save()
+        self.failUnlessEqual(self.client.get(url, query, HTTP_IF_NONE_MATCH=etag).status_code,
+                             200)
+        ## changes made in earlier seconds can also be checked with
+        ## If-Modified-Since
+        ProjectStats.objects.filter(project=self.p).update(updated=datetime.datetime(2000, 1, 1))
+        modified = self.client.get(url)["Last-Modified"]
+        self.failUnlessEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified).status_code,
+                             304)
+        ProjectStats.touch(self.p.id)
+        self.failUnlessEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified).status_code,
+                             200)
+
+    def project_stats_rebuild_race(self):
+        """A task added while the stats are being counted again is not
+        lost when the new counts are saved."""
+        ProjectStats.for_projects([self.p.id])
+        manager = WorkInProgress.objects
+        def racing_filter(*args, **kwargs):
+            ## the tasks have been counted, but not saved yet
+            del manager.filter
+            t2 = SimpleTask(question="another question", project=self.p)
+            t2.full_clean()
+            t2.save()
+            return manager.filter(*args, **kwargs)
+        manager.filter = racing_filter
+        try:
+            stats = ProjectStats.rebuild(self.p.id)
+        finally:
+            if "filter" in manager.__dict__:
+                del manager.filter
+        self.failUnlessEqual((stats.tasks, stats.stale), (2, False))
+        self.failUnlessEqual(ProjectStats.objects.get(project=self.p).tasks, 2)
+
+    def project_stats_kept_up(self):
+        """The project's stats are kept up to date as its tasks change,
+        and agree with counting them from scratch."""
+        def check():
+            stats = ProjectStats.for_projects([self.p.id])[self.p.id]
+            kept = (stats.tasks, stats.to_tag, stats.needs_merging, stats.merged,
+                    stats.in_flight, stats.assignments())
+            stats = ProjectStats.rebuild(self.p.id)
+            self.failUnlessEqual(kept, (stats.tasks, stats.to_tag, stats.needs_merging,
+                                        stats.merged, stats.in_flight, stats.assignments()))
+            return kept
+        check()
+        self.p.annotator_count = 2
+        self.p.save()
+        t2 = SimpleTask(question="another question", project=self.p)
+        t2.full_clean()
+        t2.save()
+        wip = WorkInProgress(task=t2, user=self.user)
+        wip.full_clean()
+        wip.save()
+        self.failUnlessEqual(check()[:5], (2, 1, 1, 0, 1))
+        t2 = SimpleTask.objects.get(pk=t2.pk)
+        t2.completed_assignments = 1
+        t2.full_clean()
+        t2.save()
+        wip.delete()
+        self.failUnlessEqual(check()[5], [{"completed_assignments": 1, "howmany": 2},
+                                          {"completed_assignments": "Needs Merging", "howmany": 1}])
+        result = SimpleResult(task=self.t, answer="merged answer", comment="merged comment",
+                              start_time=datetime.datetime(2000, 1, 1), user=self.user)
+        result.full_clean()
+        result.save()
+        self.failUnlessEqual(check()[:5], (2, 1, 0, 1, 0))
+        self.t.handle_unmerge()
+        self.failUnlessEqual(check()[:5], (2, 1, 1, 0, 0))
+        ProjectPurge.request(self.p).run()
+        self.failUnless(ProjectStats.objects.get(project=self.p).stale)
+        ## unless uploads are processed inline, the pages are shown the
+        ## stale counts until the task factory counts them again
+        old_inline = getattr(settings, "PROCESS_INLINE", None)
+        settings.PROCESS_INLINE = False
+        try:
+            stats = ProjectStats.for_projects([self.p.id])[self.p.id]
+        finally:
+            if old_inline is None:
+                del settings.PROCESS_INLINE
+            else:
+                settings.PROCESS_INLINE = old_inline
+        self.failUnlessEqual((stats.stale, stats.tasks), (True, 2))
+        ProjectStats.rebuild_stale()
+        self.failIf(ProjectStats.objects.get(project=self.p).stale)
+        self.failUnlessEqual(check()[:5], (0, 0, 0, 0, 0))
 
     def export_project_simple(self):
         def export_attrs(input_context, output_context):
@@ -142,12 +640,468 @@ class ProjectViews(TestCase):
         expectation = ViewExpectation(Conditions.post(export_attrs), target)
         output_context = expectation.check(self)
     
+    def export_project_streamed(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        response = self.client.get("/project/%d/export/" % self.p.id)
+        self.failUnlessEqual(response.status_code, 200)
+        zipped = ZipFile(StringIO(response.content), "r")
+        self.failUnlessEqual(sorted(zipped.namelist()),
+                             ["task-%d-question.txt" % self.t.id,
+                              "task-%d-responses.csv" % self.t.id])
+        self.failUnlessEqual(zipped.read("task-%d-question.txt" % self.t.id), "test question")
+
+    def export_project_incremental(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        url = "/project/%d/export/" % self.p.id
+        def exported(response):
+            self.failUnlessEqual(response.status_code, 200)
+            zipped = ZipFile(StringIO(response.content), "r")
+            manifest = json.loads(zipped.read("manifest.json"))
+            return sorted(zipped.namelist()), manifest
+        names, manifest = exported(self.client.get(url, {"cursor": "nightly"}))
+        self.failUnless("task-%d-question.txt" % self.t.id in names)
+        self.failUnlessEqual(manifest["since"], None)
+        ## until the consumer acknowledges the watermark, it gets the
+        ## same export again
+        names, manifest = exported(self.client.get(url, {"cursor": "nightly"}))
+        self.failUnless("task-%d-question.txt" % self.t.id in names)
+        self.failUnlessEqual(manifest["since"], None)
+        ## the watermark lags behind, so a task that has only just
+        ## changed would be exported again
+        self.failUnless(parse_watermark(manifest["watermark"]) <=
+                        datetime.datetime.now() - datetime.timedelta(
+                seconds=settings.CLICKWORK_EXPORT_WATERMARK_LAG))
+        Task.objects.filter(id=self.t.id).update(modified=datetime.datetime(2000, 1, 1))
+        since = manifest["watermark"]
+        names, manifest = exported(self.client.get(url, {"cursor": "nightly", "ack": since}))
+        self.failUnlessEqual(names, ["manifest.json"])
+        self.failUnlessEqual(manifest["since"], since)
+        ## acknowledging an older watermark doesn't move the cursor back
+        self.client.get(url, {"cursor": "nightly", "ack": "2000-01-01T00:00:00"})
+        self.failUnlessEqual(ExportCursor.objects.get(consumer="nightly").watermark,
+                             parse_watermark(since))
+        response = self.client.get(url, {"cursor": "nightly", "ack": "yesterday"})
+        self.failUnlessEqual(response.status_code, 500)
+        t2 = SimpleTask(question="another question", project=self.p, completed=True)
+        t2.full_clean()
+        t2.save()
+        r = SimpleResponse(task=t2, answer="another answer", comment="another comment",
+                           start_time=datetime.datetime(2000, 1, 1), user=self.user)
+        r.full_clean()
+        r.save()
+        names, manifest = exported(self.client.get(url, {"since": since}))
+        self.failUnlessEqual(names, ["manifest.json",
+                                     "task-%d-question.txt" % t2.id,
+                                     "task-%d-responses.csv" % t2.id])
+        self.failUnlessEqual(manifest["since"], since)
+
+    def export_project_ranges(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        url = "/project/%d/export/" % self.p.id
+        ## the first export is streamed as it is built
+        self.client.get(url).content
+        whole = self.client.get(url)
+        self.failUnlessEqual(whole["Accept-Ranges"], "bytes")
+        ## a streamed response's content can only be read once
+        contents = whole.content
+        size = len(contents)
+        response = self.client.get(url, HTTP_RANGE="bytes=10-")
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(response["Content-Range"], "bytes 10-%d/%d" % (size - 1, size))
+        self.failUnlessEqual(response.content, contents[10:])
+        ## a range of an older version of the file gets the whole file
+        response = self.client.get(url, HTTP_RANGE="bytes=10-", HTTP_IF_RANGE='"old"')
+        self.failUnlessEqual((response.status_code, response.content), (200, contents))
+        response = self.client.get(url, HTTP_RANGE="bytes=%d-" % size)
+        self.failUnlessEqual(response.status_code, 416)
+        ## the front web server can be left to send the file
+        old_settings = settings.CLICKWORK_SENDFILE_HEADER, settings.CLICKWORK_SENDFILE_ROOT
+        settings.CLICKWORK_SENDFILE_HEADER = "X-Accel-Redirect"
+        ## by default, the files are named relative to the export
+        ## directory, whatever it has been set to
+        settings.CLICKWORK_SENDFILE_ROOT = None
+        try:
+            response = self.client.get(url)
+        finally:
+            settings.CLICKWORK_SENDFILE_HEADER, settings.CLICKWORK_SENDFILE_ROOT = old_settings
+        self.failUnlessEqual(response.content, "")
+        self.failUnlessEqual(response["X-Accel-Redirect"],
+                             settings.CLICKWORK_SENDFILE_PREFIX +
+                             os.listdir(settings.CLICKWORK_EXPORT_DIR)[0])
+
+    def export_project_tables(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        url = "/project/%d/export/" % self.p.id
+        response = self.client.get(url, {"format": "jsonl"})
+        self.failUnlessEqual(response.status_code, 200)
+        zipped = ZipFile(StringIO(response.content), "r")
+        suffix = "-%d-%d.jsonl" % (self.t.id, self.t.id)
+        self.failUnlessEqual(sorted(zipped.namelist()), ["responses" + suffix, "tasks" + suffix])
+        self.failUnlessEqual(json.loads(zipped.read("tasks" + suffix)),
+                             {"id": self.t.id, "question": "test question"})
+        responses = [json.loads(line) for line in zipped.read("responses" + suffix).splitlines()]
+        self.failUnlessEqual([(r["user"], r["answer"]) for r in responses],
+                             [("testuser_getnexttask", "test answer")])
+        response = self.client.get(url, {"format": "csv"})
+        zipped = ZipFile(StringIO(response.content), "r")
+        self.failUnlessEqual(zipped.read("tasks-%d-%d.csv" % (self.t.id, self.t.id)),
+                             "id,question\r\n%d,test question\r\n" % self.t.id)
+        ## each format is cached separately
+        self.failUnlessEqual(ProjectExport.objects.filter(project=self.p).count(), 2)
+
+    def export_project_filtered(self):
+        self.client.login(username="testuser_getnexttask", password="abc")
+        url = "/project/%d/export/" % self.p.id
+        other = User.objects.create_user("testuser_other", "bar@example.com", "abc")
+        t2 = SimpleTask(question="another question", project=self.p, completed=True)
+        t2.full_clean()
+        t2.save()
+        r = SimpleResponse(task=t2, answer="another answer", comment="another comment",
+                           start_time=datetime.datetime(2000, 1, 1), user=other)
+        r.full_clean()
+        r.save()
+        result = SimpleResult(task=t2, answer="merged answer", comment="merged comment",
+                              start_time=datetime.datetime(2000, 1, 1), user=self.user)
+        result.full_clean()
+        result.save()
+        def exported(**parameters):
+            response = self.client.get(url, parameters)
+            self.failUnlessEqual(response.status_code, 200)
+            return sorted(ZipFile(StringIO(response.content), "r").namelist())
+        t_files = ["task-%d-question.txt" % self.t.id, "task-%d-responses.csv" % self.t.id]
+        t2_files = ["task-%d-question.txt" % t2.id, "task-%d-responses.csv" % t2.id]
+        self.failUnlessEqual(exported(max_id=self.t.id), t_files)
+        self.failUnlessEqual(exported(ids="%d,%d" % (self.t.id, t2.id)), sorted(t_files + t2_files))
+        self.failUnlessEqual(exported(merged="true"), t2_files)
+        self.failUnlessEqual(exported(merged_after="2100-01-01T00:00:00"), [])
+        self.failUnlessEqual(exported(annotators="testuser_getnexttask"), t_files)
+        ## the same filters work with the JSON response format
+        response = self.client.get(url, {"annotators": "testuser_other,nobody",
+                                         "response_format": "json"})
+        contents = b64decode(json.loads(response.content)["contents_in_base64"])
+        self.failUnlessEqual(sorted(ZipFile(StringIO(contents), "r").namelist()), t2_files)
+        self.failUnlessEqual(self.client.get(url, {"min_id": "first"}).status_code, 500)
+        ## a bad filter doesn't move, or make, the export cursor
+        response = self.client.get(url, {"cursor": "nightly", "ack": "2000-01-01T00:00:00",
+                                         "min_id": "first"})
+        self.failUnlessEqual(response.status_code, 500)
+        self.failIf(ExportCursor.objects.exists())
+
+    def export_query_count(self):
+        """Exporting a batch of tasks takes the same number of queries
+        however many tasks and responses there are."""
+        for i in range(5):
+            t = SimpleTask(question="question %d" % i, project=self.p, completed=True)
+            t.full_clean()
+            t.save()
+            r = SimpleResponse(task=t, answer="answer %d" % i, comment="comment",
+                               start_time=datetime.datetime(2000, 1, 1), user=self.user)
+            r.full_clean()
+            r.save()
+        ptype = get_project_type(self.p)
+        def cold_export_queries():
+            CachedTaskExport.objects.all().delete()
+            connection.use_debug_cursor = True
+            try:
+                start = len(connection.queries)
+                entries = list(export_entries(self.p, ptype))
+                return entries, len(connection.queries) - start
+            finally:
+                connection.use_debug_cursor = None
+        ## with nothing cached, each batch's exports are rendered and
+        ## then cached all at once
+        entries, queries = cold_export_queries()
+        for i in range(5, 10):
+            t = SimpleTask(question="question %d" % i, project=self.p, completed=True)
+            t.full_clean()
+            t.save()
+        more_entries, more_queries = cold_export_queries()
+        self.failUnlessEqual((len(more_entries), more_queries), (len(entries) + 10, queries))
+        SimpleTask.objects.filter(project=self.p, question__in=["question %d" % i
+                                                                 for i in range(5, 10)]).delete()
+        entries = list(export_entries(self.p, ptype))
+        ## once every task's export is cached: one query for the task
+        ## ids, one for their versions and one for the cached exports
+        with self.assertNumQueries(3):
+            self.failUnlessEqual(list(export_entries(self.p, ptype)), entries)
+        self.failUnlessEqual(len(entries), 12)
+        self.failUnless(("task-%d-responses.csv" % self.t.id,
+                         "user,answer,comment\r\ntestuser_getnexttask,test answer,test comment\r\n")
+                        in entries)
+
+    def export_task_cache(self):
+        ptype = get_project_type(self.p)
+        list(export_entries(self.p, ptype))
+        self.failUnlessEqual(CachedTaskExport.objects.filter(task=self.t).count(), 1)
+        ## the cached export is used until the task, a response or
+        ## the result changes
+        cached = CachedTaskExport.objects.get(task=self.t)
+        list(export_entries(self.p, ptype))
+        self.failUnlessEqual(CachedTaskExport.objects.get(task=self.t).pk, cached.pk)
+        task = SimpleTask.objects.get(pk=self.t.pk)
+        task.question = "new question"
+        task.save()
+        entries = dict(export_entries(self.p, ptype))
+        self.failUnlessEqual(entries["task-%d-question.txt" % self.t.id], "new question")
+        SimpleResponse.objects.get(task=self.t).delete()
+        entries = dict(export_entries(self.p, ptype))
+        self.failUnlessEqual(entries["task-%d-responses.csv" % self.t.id], "user,answer,comment\r\n")
+        ## emptying the project gets rid of its tasks' cached exports
+        ProjectPurge.request(self.p).run()
+        self.failIf(CachedTaskExport.objects.exists())
+
+    def export_render_batch(self):
+        """A worker process renders a batch of tasks just as the
+        export would have rendered it in-process."""
+        ptype = get_project_type(self.p)
+        self.failUnlessEqual(render_batch((ptype.name, [self.t.id], "files")),
+                             list(export_entries(self.p, ptype, format="files")))
+        tables = render_batch((ptype.name, [self.t.id], "jsonl"))
+        self.failUnlessEqual(list(table_entries([self.t.id], tables, "jsonl", {})),
+                             list(export_entries(self.p, ptype, format="jsonl")))
+
+    def export_csv_columns(self):
+        """Every CSV file of a table gets the same header, taken from
+        the first batch, with any new columns added at the end."""
+        columns = []
+        self.failUnlessEqual(csv_table([{"b": 1, "a": 2}], columns), "a,b\r\n2,1\r\n")
+        self.failUnlessEqual(csv_table([{"b": 3}], columns), "a,b\r\n,3\r\n")
+        self.failUnlessEqual(csv_table([{"c": 4, "a": 5}], columns), "a,b,c\r\n5,,4\r\n")
+
+    def export_zip64(self):
+        """An export with more entries than a plain zip file can hold
+        is still a readable zip file."""
+        count = 65536 + 10
+        zipped = "".join(zip_chunks(("task%d.txt" % i, "x") for i in xrange(count)))
+        names = ZipFile(StringIO(zipped)).namelist()
+        self.failUnlessEqual((len(names), names[-1]), (count, "task%d.txt" % (count - 1)))
+
     def export_project_dict(self):
         self.client.login(username="testuser_getnexttask", password="abc")
         target = WebTarget("GET", main.views.project.project_export, args=(self.p.id,))
         expectation = ViewExpectation(Conditions.null(), target)
         expectation.check(self)
 
+class UploadProcessing(TransactionTestCase):
+    """Uploads are committed in chunks and can be resumed after a failure."""
+    def setUp(self):
+        u = User.objects.create_user("testuser_upload", "foo@example.com", "abc")
+        p = SimpleProject(admin=u, title="Upload Project", description="Testing uploads.",
+                          type="simple", annotator_count=1, priority=3)
+        p.full_clean()
+        p.save()
+        self.p = p
+        self.pu = ProjectUpload(project=p)
+        self.pu.upload.save("test-upload.txt",
+                            ContentFile("one\ntwo\nthree\nfour\nfive\n"))
+
+    def tearDown(self):
+        self.pu.upload.delete(save=False)
+
+    def questions(self):
+        return [t.question for t in SimpleTask.objects.filter(project=self.p).order_by("id")]
+
+    def resume_after_failure(self):
+        handle_row = self.p.handle_row
+        def flaky_handle_row(row, **kwargs):
+            if row == "four":
+                raise ValueError("simulated failure")
+            handle_row(row, **kwargs)
+        self.p.handle_row = flaky_handle_row
+        self.assertRaises(ValueError, process_upload, self.pu, self.p, 2)
+        pu = ProjectUpload.objects.get(pk=self.pu.pk)
+        self.assertEqual((pu.rows_processed, pu.rows_total), (2, 5))
+        self.assertEqual(self.questions(), ["one", "two"])
+        self.p.handle_row = handle_row
+        process_upload(pu, self.p, 2)
+        pu = ProjectUpload.objects.get(pk=self.pu.pk)
+        self.assertEqual((pu.rows_processed, pu.rows_total), (5, 5))
+        self.assertEqual(self.questions(), ["one", "two", "three", "four", "five"])
+
+    def resume_repeated_rows(self):
+        """Resuming reads the upload from its checkpoint, and still
+        numbers the rows that repeat rows before it."""
+        pu = ProjectUpload(project=self.p)
+        pu.upload.save("test-upload-repeats.txt", ContentFile("a\nb\na\nc\na\n"))
+        handle_row = self.p.handle_row
+        def flaky_handle_row(row, **kwargs):
+            if row == "c":
+                raise ValueError("simulated failure")
+            handle_row(row, **kwargs)
+        read_fingerprinted_rows = main.uploads.read_fingerprinted_rows
+        offsets = []
+        def reading(upload, parser, offset=0):
+            offsets.append(offset)
+            return read_fingerprinted_rows(upload, parser, offset)
+        try:
+            self.p.handle_row = flaky_handle_row
+            self.assertRaises(ValueError, process_upload, pu, self.p, 2)
+            self.assertEqual(self.questions(), ["a", "b"])
+            self.p.handle_row = handle_row
+            main.uploads.read_fingerprinted_rows = reading
+            pu = ProjectUpload.objects.get(pk=pu.pk)
+            process_upload(pu, self.p, 2)
+            self.assertEqual(offsets, [4])
+            self.assertEqual(self.questions(), ["a", "b", "a", "c", "a"])
+            self.assertEqual(UploadFingerprint.objects.filter(upload=pu).count(), 0)
+        finally:
+            main.uploads.read_fingerprinted_rows = read_fingerprinted_rows
+            pu.upload.delete(save=False)
+
+    def repeated_upload(self):
+        """Rows that a project already has tasks for are skipped."""
+        process_upload(self.pu, self.p, 2)
+        pu = ProjectUpload(project=self.p)
+        pu.upload.save("test-upload-2.txt", ContentFile("four\nsix\nsix\none\n"))
+        try:
+            process_upload(pu, self.p, 2)
+            self.assertEqual((pu.rows_processed, pu.rows_skipped), (4, 2))
+            self.assertEqual(ProjectUpload.objects.get(pk=pu.pk).rows_skipped, 2)
+            ## a row that is repeated within an upload is not a duplicate
+            self.assertEqual(self.questions(),
+                             ["one", "two", "three", "four", "five", "six", "six"])
+        finally:
+            pu.upload.delete(save=False)
+        pu = ProjectUpload(project=self.p)
+        pu.upload.save("test-upload-3.txt", ContentFile("six\nsix\nsix\n"))
+        try:
+            process_upload(pu, self.p, 2)
+            self.assertEqual((pu.rows_processed, pu.rows_skipped), (3, 2))
+            self.assertEqual(self.questions()[-3:], ["six", "six", "six"])
+        finally:
+            pu.upload.delete(save=False)
+
+    def compressed_uploads(self):
+        text = "\xef\xbb\xbfa,b\r\n\"c, d\",souffl\xc3\xa9\r\n"
+        gzipped = StringIO()
+        f = gzip.GzipFile(fileobj=gzipped, mode="wb")
+        f.write(text)
+        f.close()
+        zipped = StringIO()
+        f = ZipFile(zipped, "w", ZIP_DEFLATED)
+        f.writestr("tasks.csv", text)
+        f.close()
+        for name, contents in (("plain.csv", text),
+                               ("tasks.csv.gz", gzipped.getvalue()),
+                               ("tasks.csv.bz2", bz2.compress(text)),
+                               ("tasks.zip", zipped.getvalue())):
+            pu = ProjectUpload(project=self.p)
+            pu.upload.save(name, ContentFile(contents))
+            try:
+                self.assertEqual([row for row, end in read_rows(pu, csv_row)],
+                                 [[u"a", u"b"], [u"c, d", u"souffl\xe9"]],
+                                 "Failed on reading %s" % name)
+                self.assertEqual([row for row, end in read_rows(pu, csv_row, 8)],
+                                 [[u"c, d", u"souffl\xe9"]],
+                                 "Failed on resuming %s" % name)
+            finally:
+                pu.upload.delete(save=False)
+
+    def sharded_upload(self):
+        """Parsing an upload in shards yields the same rows, in the same order."""
+        path = self.pu.upload.path
+        shards = shard_boundaries(path, 0, 5)
+        self.assertEqual(shards, [(0, 8), (8, 14), (14, 19), (19, 24)])
+        sequential = list(read_rows(self.pu))
+        fingerprinted = list(read_fingerprinted_rows(self.pu))
+        self.assertEqual(fingerprinted[1], (u"two", row_fingerprint(u"two"), 8))
+        self.assertEqual(parse_shard((path, 8, 14, text_row, True)),
+                         fingerprinted[2:3])
+        old_settings = (settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE)
+        settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE = 2, 5
+        try:
+            self.assertEqual(list(read_rows(self.pu)), sequential)
+            self.assertEqual(list(read_rows(self.pu, offset=8)), sequential[2:])
+            self.assertEqual(list(read_fingerprinted_rows(self.pu)), fingerprinted)
+        finally:
+            settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE = old_settings
+
+    def upload_view(self):
+        """An upload through the web is saved once, with its digest,
+        and processed."""
+        self.client.login(username="testuser_upload", password="abc")
+        f = tempfile.NamedTemporaryFile(suffix=".txt")
+        f.write("seven\neight\n")
+        f.seek(0)
+        response = self.client.post("/project/%d/upload/" % self.p.id,
+                                    {"action": "Upload", "upload": f})
+        f.close()
+        self.assertEqual(response.status_code, 200)
+        pu = ProjectUpload.objects.exclude(pk=self.pu.pk).get(project=self.p)
+        try:
+            self.assertEqual((pu.complete, pu.digest), (True, upload_digest(pu)))
+            self.assertEqual(self.questions(), ["seven", "eight"])
+        finally:
+            pu.upload.delete(save=False)
+
+    def sharded_csv_upload(self):
+        """A CSV upload is parsed in shards by the worker pool, no more
+        than a few shards ahead of the rows that have been used."""
+        pu = ProjectUpload(project=self.p)
+        pu.upload.save("tasks.csv", ContentFile("".join('%d,"row, %d"\n' % (i, i)
+                                                        for i in range(50))))
+        old_settings = (settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE)
+        try:
+            sequential = list(read_rows(pu, csv_row))
+            self.assertEqual(sequential[7][0], [u"7", u"row, 7"])
+            settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE = 2, 20
+            self.assertEqual(list(read_rows(pu, csv_row)), sequential)
+        finally:
+            settings.CLICKWORK_UPLOAD_WORKERS, settings.CLICKWORK_UPLOAD_SHARD_SIZE = old_settings
+            pu.upload.delete(save=False)
+        pulled = []
+        def items():
+            for i in range(-20, 0):
+                pulled.append(i)
+                yield i
+        pool = multiprocessing.Pool(2)
+        try:
+            results = bounded_imap(pool, abs, items(), 3)
+            self.assertEqual(results.next(), 20)
+            self.assertEqual(len(pulled), 4)
+            self.assertEqual(list(results), range(19, 0, -1))
+        finally:
+            pool.terminate()
+
+class ParallelExport(TransactionTestCase):
+    """Exports rendered by worker processes, which need the tasks to be
+    committed so that they can see them."""
+    def setUp(self):
+        u = User.objects.create_user("testuser_parallel", "foo@example.com", "abc")
+        p = SimpleProject(admin=u, title="Parallel Project", description="Testing exports.",
+                          type="simple", annotator_count=1, priority=3)
+        p.full_clean()
+        p.save()
+        for i in range(3):
+            t = SimpleTask(question="question %d" % i, project=p)
+            t.full_clean()
+            t.save()
+            r = SimpleResponse(task=t, answer="answer %d" % i, comment="comment",
+                               start_time=datetime.datetime(2000, 1, 1), user=u)
+            r.full_clean()
+            r.save()
+            t.completed_assignments = 1
+            t.full_clean()
+            t.save()
+        self.p = p
+
+    def runTest(self):
+        ptype = get_project_type(self.p)
+        def exported(workers):
+            old_settings = settings.CLICKWORK_EXPORT_WORKERS, settings.CLICKWORK_EXPORT_BATCH_SIZE
+            settings.CLICKWORK_EXPORT_WORKERS, settings.CLICKWORK_EXPORT_BATCH_SIZE = workers, 1
+            try:
+                return list(export_entries(self.p, ptype, format="csv"))
+            finally:
+                settings.CLICKWORK_EXPORT_WORKERS, settings.CLICKWORK_EXPORT_BATCH_SIZE = \
+                    old_settings
+        parallel = exported(2)
+        self.failUnlessEqual(parallel, exported(1))
+        self.failUnlessEqual(len([name for name, contents in parallel
+                                  if name.startswith("responses-")]), 3)
+        ## the workers leave this process's connection working
+        self.failUnlessEqual(SimpleTask.objects.filter(project=self.p).count(), 3)
+
 class GetNextTask(TestCase):
     def setUp(self):
         u = User.objects.create_user("testuser_getnexttask", "foo@example.com", "abc")
@@ -215,6 +1169,66 @@ class GetNextTask(TestCase):
         ## try getting the next task again
         self.task_expectation.check(self)
 
+    def purge_hides_and_deletes_tasks(self):
+        ## unless processing is inline, emptying a project from its
+        ## page only queues the purge
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="testuser_getnexttask", password="abc")
+        old_inline = getattr(settings, "PROCESS_INLINE", None)
+        settings.PROCESS_INLINE = False
+        try:
+            self.client.post("/project/%d/upload/" % self.t.project.id, {"action": "Empty"})
+        finally:
+            if old_inline is None:
+                del settings.PROCESS_INLINE
+            else:
+                settings.PROCESS_INLINE = old_inline
+        purge = ProjectPurge.objects.get(project=self.t.project)
+        self.failIf(purge.complete)
+        self.failUnless(Task.objects.filter(pk=self.t.pk).exists())
+        self.failUnlessEqual(Task.objects.next_for(self.user), None)
+        later = SimpleTask(question="uploaded after the purge", project=self.t.project)
+        later.full_clean()
+        later.save()
+        purge.run(chunk_size=1)
+        purge = ProjectPurge.objects.get(pk=purge.pk)
+        self.failUnless(purge.complete)
+        self.failUnlessEqual((purge.tasks_deleted, purge.tasks_total), (1, 1))
+        self.failUnlessEqual(list(Task.objects.filter(project=self.t.project)), [later.task_ptr])
+        self.failUnlessEqual(Task.objects.next_for(self.user), later.task_ptr)
+
+    def purge_inline(self):
+        """When processing is inline, emptying a project deletes its
+        tasks straight away."""
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="testuser_getnexttask", password="abc")
+        self.client.post("/project/%d/upload/" % self.t.project.id, {"action": "Empty"})
+        purge = ProjectPurge.objects.get(project=self.t.project)
+        self.failUnless(purge.complete)
+        self.failIf(Task.objects.filter(pk=self.t.pk).exists())
+
+    def purge_marks_stats_stale_once(self):
+        """A purge touches the project's stats once per chunk, not once
+        per task."""
+        for i in range(4):
+            t = SimpleTask(question="question %d" % i, project=self.t.project)
+            t.full_clean()
+            t.save()
+        ProjectStats.for_projects([self.t.project.id])
+        purge = ProjectPurge.request(self.t.project)
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            purge.run(chunk_size=10)
+            stats_queries = [q for q in connection.queries if "main_projectstats" in q["sql"]]
+        finally:
+            connection.use_debug_cursor = None
+        self.failUnlessEqual(len(stats_queries), 1)
+        self.failUnless(ProjectStats.objects.get(project=self.t.project).stale)
+        self.failUnlessEqual(ProjectStats.for_projects([self.t.project.id])[self.t.project.id].tasks, 0)
+
     def get_next_task_should_fail(self):
         """Try to get a task with the wrong user's authentication."""
         other_user = User.objects.create_user("nobody_special", "foo@example.com", "abc")
@@ -234,17 +1248,54 @@ def suite():
     from main.moretests.twostage import TwoStageTestCase, MultilingoTestCase, NeedingCorrection, AutoReview
     from main.moretests.expectation import ExpectationSmokeTest
     import main.views.timesheets
+    import main.wrapper
     suite = unittest.TestSuite()
     suite.addTest(FreshEyes())
     suite.addTest(doctest.DocTestSuite())
     suite.addTest(doctest.DocTestSuite(main.views.timesheets))
+    suite.addTest(doctest.DocTestSuite(main.wrapper))
     suite.addTests((WrapperTests("test_home_post"),
+                    WrapperTests("test_attachment_json_streamed"),
                     BaseViews("test_home"),
+                    ProjectViews("overview_brief"),
+                    ProjectViews("project_stats_kept_up"),
+                    ProjectViews("project_stats_rebuild_race"),
+                    ProjectViews("group_members_cached"),
+                    ProjectViews("group_details"),
+                    ProjectViews("workload_cached"),
+                    ProjectViews("dashboard_snapshots"),
+                    ProjectViews("annotator_timing_stats"),
+                    ProjectViews("dashboard_api"),
+                    ProjectViews("project_task_pages"),
+                    ProjectViews("users_page"),
                     ProjectViews("export_project_simple"),
                     ProjectViews("export_project_dict"),
+                    ProjectViews("export_project_streamed"),
+                    ProjectViews("export_project_incremental"),
+                    ProjectViews("export_query_count"),
+                    ProjectViews("export_project_cached"),
+                    ProjectViews("export_project_ranges"),
+                    ProjectViews("export_project_tables"),
+                    ProjectViews("export_render_batch"),
+                    ProjectViews("export_csv_columns"),
+                    ProjectViews("export_zip64"),
+                    ProjectViews("export_rekeyed"),
+                    ProjectViews("export_task_cache"),
+                    ProjectViews("export_project_filtered"),
                     GetNextTask("get_user_task"),
                     GetNextTask("get_next_task_view"),
                     GetNextTask("get_next_task_should_fail"),
+                    GetNextTask("purge_hides_and_deletes_tasks"),
+                    GetNextTask("purge_inline"),
+                    GetNextTask("purge_marks_stats_stale_once"),
+                    UploadProcessing("resume_after_failure"),
+                    UploadProcessing("resume_repeated_rows"),
+                    UploadProcessing("repeated_upload"),
+                    UploadProcessing("compressed_uploads"),
+                    UploadProcessing("sharded_upload"),
+                    UploadProcessing("sharded_csv_upload"),
+                    UploadProcessing("upload_view"),
+                    ParallelExport(),
                     SimpleTagMerge(),
                     KeepApart(),
                     UserCreationRestriction(),
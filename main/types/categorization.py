@@ -1,25 +1,27 @@
 from django.db import models
 from main.models import Task, Response, Project, ProjectType
-import csv
-from cStringIO import StringIO
+from main.uploads import csv_row, read_rows
 
 class CategorizationProject(Project):
+    #: Each line of an upload is a comma-separated list of queries.
+    row_parser = staticmethod(csv_row)
+
     def handle_input(self, input):
-        f = StringIO(input.encode("utf-8"))
-        r = csv.reader(f)
-        for row in r:
-            ci = []
-            ct = CategorizationTask(project=self)
-            ct.full_clean()
-            ct.save()
-            for q in row:
-                c = CategorizationInput(query_string=q)
-                c.full_clean()
-                c.save()
-                ci.append(c)
-                ct.queries.add(c)
-            ct.full_clean()
-            ct.save()
+        for row, end in read_rows(input, self.row_parser):
+            self.handle_row(row)
+
+    def handle_row(self, row, input_fingerprint=None):
+        ct = CategorizationTask(project=self, input_fingerprint=input_fingerprint)
+        ## main.uploads has already made sure the fingerprint is new
+        ct.full_clean(exclude=["input_fingerprint"])
+        ct.save()
+        for q in row:
+            c = CategorizationInput(query_string=q)
+            c.full_clean()
+            c.save()
+            ct.queries.add(c)
+        ct.full_clean(exclude=["input_fingerprint"])
+        ct.save()
 
 class CategorizationInput(models.Model):   
     class Meta:
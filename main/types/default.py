@@ -35,6 +35,27 @@ class Default:
         """Given a Project and ProjectUpload object,
            create tasks based on the Project and the Upload."""
         pass
+
+    #: Optional. A function that turns one line of an upload (a
+    #: unicode object, without its line terminator) into the row
+    #: that is passed to handle_row; main.uploads.text_row, which
+    #: passes the line through unchanged, is used if this is not set,
+    #: and main.uploads.csv_row splits comma-separated values.  It
+    #: must be a module-level function, since it may be run in worker
+    #: processes (see settings.CLICKWORK_UPLOAD_WORKERS).
+    #: Uploads may be gzip, bzip2 or zip files; they are decompressed
+    #: and decoded as they are read (see main.uploads.read_rows).
+    row_parser = None
+
+    def handle_row(self, project, row, input_fingerprint=None):
+        """Optional. Given a Project and one row of an upload,
+           create the task for that row, setting its input_fingerprint
+           field to the given value. Project types that define this
+           have their uploads processed in committed chunks, so that
+           an interrupted upload resumes where it stopped rather than
+           starting over, and rows whose fingerprint matches a task
+           already in the project are skipped; handle_input is then
+           not called."""
     
     def handle_response(self, guts, task):
         """Given a RequestGuts object, and a Task object,
@@ -63,6 +84,26 @@ class Default:
            zipfile and delivered to the client to download when
            the project is exported.
        """
+    def export_batch(self, task_ids):
+        """Given a list of task ids, in order, yield a (task, export)
+           pair for each of them, where export is what the task's
+           export method returns. The ProjectType superclass does this
+           one task at a time; types should override it to fetch the
+           tasks, and whatever their exports need (responses, users,
+           results), for the whole batch in a handful of queries, and
+           to stash those on the tasks so that export does not go
+           back to the database for each one.
+       """
+    def export_rows(self, task):
+        """Optional. Given a task, generate a dict whose keys are
+           table names ("tasks", "responses", "results", ...) and
+           whose values are lists of rows, each a dict of column names
+           and values. This is used when the project is exported in
+           one of the table formats (JSON lines or CSV), which put the
+           rows from a whole batch of tasks into one file per table.
+           Types can override export_rows_batch to fetch the batch's
+           data in a few queries, just as with export_batch.
+       """
     def review_template_input(self, review):
         """Generate template data for a review. Reviews have a reference to 
            the response (review.response) object that the user is being 
@@ -1,4 +1,5 @@
 from main.models import Project, Task, Response, Result, ProjectType
+from main.uploads import read_rows
 from django.db import models
 
 import csv
@@ -10,11 +11,16 @@ class SimpleProject(Project):
 
     def handle_input(self, input):
         """Given ProjectUpload object, create tasks based on it."""
-        for line in input.upload:
-            line = line.rstrip()
-            task = SimpleTask(question=line, project=self)
-            task.full_clean()
-            task.save()
+        for row, end in read_rows(input):
+            self.handle_row(row)
+
+    def handle_row(self, row, input_fingerprint=None):
+        """Create a task for one line of an upload."""
+        task = SimpleTask(question=row.rstrip(), project=self,
+                          input_fingerprint=input_fingerprint)
+        ## main.uploads has already made sure the fingerprint is new
+        task.full_clean(exclude=["input_fingerprint"])
+        task.save()
 
 class SimpleTask(Task):
     """A basic task, with just a single textfield for
@@ -63,6 +69,15 @@ class SimpleTask(Task):
         res.full_clean()
         res.save()
     
+    def simple_responses(self):
+        """Return this task's responses as SimpleResponse objects,
+        with their users.  Simple.export_batch fills these in for a
+        whole batch of tasks at once."""
+        if not hasattr(self, "_simple_responses"):
+            self._simple_responses = list(SimpleResponse.objects.filter(task=self)
+                                          .select_related("user").order_by("id"))
+        return self._simple_responses
+
     def export(self):
         """Generate a dictionary of key-value pairs for this task;
            the key should be a component of a filename, which will
@@ -80,15 +95,39 @@ class SimpleTask(Task):
         response_string = StringIO()
         writer = csv.writer(response_string)
         writer.writerow(['user', 'answer', 'comment'])
-        for response in self.response_set.all():
-            simple_res = response.simpleresponse
-            writer.writerow([response.user.username, simple_res.answer, simple_res.comment])
+        for simple_res in self.simple_responses():
+            writer.writerow([simple_res.user.username, simple_res.answer, simple_res.comment])
         
         input_string.seek(0)
         response_string.seek(0)
 
         return {'question.txt': input_string.read(), 'responses.csv': response_string.read()}   
 
+    def simple_result(self):
+        """Return this task's result as a SimpleResult, with its user,
+        or None if the task has not been merged.  Simple.export_rows_batch
+        fills these in for a whole batch of tasks at once."""
+        if not hasattr(self, "_simple_result"):
+            results = list(SimpleResult.objects.filter(task=self).select_related("user"))
+            self._simple_result = results and results[0] or None
+        return self._simple_result
+
+    def export_rows(self):
+        """Generate this task's rows for the tasks, responses and
+           results tables of a table-format export."""
+        rows = {'tasks': [{'id': self.id, 'question': self.question}],
+                'responses': [{'task': self.id, 'user': r.user.username,
+                               'answer': r.answer, 'comment': r.comment,
+                               'start_time': r.start_time, 'end_time': r.end_time}
+                              for r in self.simple_responses()]}
+        result = self.simple_result()
+        if result is not None:
+            rows['results'] = [{'task': self.id, 'user': result.user.username,
+                                'answer': result.answer, 'comment': result.comment,
+                                'start_time': result.start_time,
+                                'end_time': result.end_time}]
+        return rows
+
 class SimpleResponse(Response):
     """Response to simple question; includes fields for
        answer (char) and comment (textarea)"""
@@ -124,6 +163,10 @@ class Simple(ProjectType):
     #: a project with a type.
     name = "simple"
 
+    #: A response agrees with the result when their answers are the same.
+    agreement_sql = """(SELECT answer FROM main_simpleresponse WHERE response_ptr_id = %(response)s) =
+                       (SELECT answer FROM main_simpleresult WHERE result_ptr_id = %(result)s)"""
+
     def cast(self, model):
         if isinstance(model, Task):
             return model.simpletask
@@ -131,6 +174,32 @@ class Simple(ProjectType):
             return SimpleProject.objects.get(pk=model.id)
         else:
             return model
+
+    def export_batch(self, task_ids):
+        """Export a batch of tasks with two queries: one for the
+        tasks and one for all of their responses and users."""
+        responses = {}
+        for response in SimpleResponse.objects.filter(task__in=task_ids) \
+                .select_related("user").order_by("id"):
+            responses.setdefault(response.task_id, []).append(response)
+        for task in SimpleTask.objects.filter(pk__in=task_ids).order_by("id"):
+            task._simple_responses = responses.get(task.id, [])
+            yield task, task.export()
+
+    def export_rows_batch(self, task_ids):
+        """Export a batch of tasks as table rows with three queries:
+        one for the tasks, one for their responses and one for their
+        results."""
+        responses = {}
+        for response in SimpleResponse.objects.filter(task__in=task_ids) \
+                .select_related("user").order_by("id"):
+            responses.setdefault(response.task_id, []).append(response)
+        results = dict((result.task_id, result) for result in
+                       SimpleResult.objects.filter(task__in=task_ids).select_related("user"))
+        for task in SimpleTask.objects.filter(pk__in=task_ids).order_by("id"):
+            task._simple_responses = responses.get(task.id, [])
+            task._simple_result = results.get(task.id)
+            yield task, task.export_rows()
                 
 def get_type():
     """Return the type for the simple project."""
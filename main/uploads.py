@@ -0,0 +1,416 @@
+"""Helpers for turning a ProjectUpload into tasks.
+
+Uploaded files are read as a stream: gzip, bzip2 and zip files are
+decompressed on the fly, and the text is split into lines and decoded
+a line at a time, so that no upload is ever held in memory all at
+once.  Each line is turned into a row by a row parser: the project
+type's row_parser, such as csv_row, or text_row if it leaves
+row_parser unset or None.
+
+When settings.CLICKWORK_UPLOAD_WORKERS is more than 1, large
+uncompressed uploads are instead split into shards of about
+settings.CLICKWORK_UPLOAD_SHARD_SIZE bytes that begin and end on line
+boundaries, and the shards are parsed, and the rows fingerprinted,
+by a pool of worker processes, no more than two shards per worker
+ahead of the rows being committed.  The rows still come back in the
+order in which they appear in the file, so tasks are created in the
+same order either way; the parser has to be a module-level function,
+so that it can be pickled.  The tasks themselves are always created
+by the process that commits them.
+
+Each row is identified by a fingerprint of its contents and of how
+many rows with the same contents came before it in the upload (see
+row_fingerprint), which is stored on the task made from it; a project
+never gets two tasks with the same fingerprint, so when a file, or
+part of one, is uploaded to a project twice, the rows that are
+already there are skipped and counted in the upload's rows_skipped,
+while rows that are repeated within one upload each get a task.  How
+many rows with each contents have been committed so far is kept in
+the database (see UploadFingerprint) until the upload is finished,
+rather than in memory.
+
+Project types that only define handle_input() get the whole upload
+in one go, inside a single transaction.  Project types that also
+define handle_row() are fed the upload one row at a time, and the
+rows are committed in chunks of settings.CLICKWORK_UPLOAD_CHUNK_SIZE;
+after each chunk the position in the upload is stored on the
+ProjectUpload, so that processing that is interrupted can pick up
+again where it left off instead of starting over, without reading
+the rows before that position again."""
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from main.models import ProjectUpload, Task, UploadFingerprint
+from main.helpers import bounded_imap
+
+import bz2
+import codecs
+import csv
+import hashlib
+import multiprocessing
+import os
+import zipfile
+import zlib
+
+#: How many bytes to read from the uploaded file at a time.
+READ_SIZE = 64 * 1024
+
+def text_row(line):
+    """The default row parser: each line is one row."""
+    return line
+
+def csv_row(line):
+    """Row parser for CSV files: each line is a list of unicode
+    fields.  (Quoted fields may not contain line breaks.)"""
+    return [field.decode("utf-8")
+            for field in csv.reader([line.encode("utf-8")]).next()]
+
+def row_parser(project):
+    """Return the function that turns one line of an upload to the
+    given project into a row: its row_parser, or text_row if that is
+    not set."""
+    return getattr(project, "row_parser", None) or text_row
+
+def _read_chunks(f):
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def _decompress_chunks(f, decompressor):
+    for chunk in _read_chunks(f):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, "flush"):
+        yield decompressor.flush()
+
+def _zip_chunks(f):
+    archive = zipfile.ZipFile(f)
+    for info in archive.infolist():
+        if not info.filename.endswith("/"):
+            member = archive.open(info)
+            for chunk in _read_chunks(member):
+                yield chunk
+            member.close()
+
+def _compression(magic):
+    """Given the first four bytes of a file, return the kind of
+    compression it uses ("gzip", "bz2" or "zip"), or None."""
+    if magic.startswith("\x1f\x8b"):
+        return "gzip"
+    elif magic.startswith("BZh"):
+        return "bz2"
+    elif magic == "PK\x03\x04":
+        return "zip"
+    else:
+        return None
+
+def upload_chunks(upload, offset=0):
+    """Yield the contents of the uploaded file as a series of
+    bytestrings, starting at the given byte offset.  Compressed
+    uploads (recognized by their leading magic number) are
+    decompressed, in which case the offset counts decompressed bytes;
+    the members of a zip file are read one after the other."""
+    f = upload.upload
+    f.open("rb")
+    try:
+        compression = _compression(f.read(4))
+        f.seek(0)
+        if compression == "gzip":
+            chunks = _decompress_chunks(f, zlib.decompressobj(16 + zlib.MAX_WBITS))
+        elif compression == "bz2":
+            chunks = _decompress_chunks(f, bz2.BZ2Decompressor())
+        elif compression == "zip":
+            chunks = _zip_chunks(f)
+        else:
+            f.seek(offset)
+            offset = 0
+            chunks = _read_chunks(f)
+        for chunk in chunks:
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            yield chunk[offset:]
+            offset = 0
+    finally:
+        f.close()
+
+def _decode_line(line, position):
+    """Turn the line that starts at the given byte offset into
+    unicode, dropping its line terminator and, at the very beginning
+    of the file, any UTF-8 byte order mark."""
+    if position == 0 and line.startswith(codecs.BOM_UTF8):
+        line = line[len(codecs.BOM_UTF8):]
+    return line.rstrip("\r\n").decode("utf-8")
+
+def upload_lines(upload, offset=0):
+    """Yield (line, end_offset) pairs for each line of the uploaded
+    file, starting at the given byte offset.  Each line is a unicode
+    object without its line terminator; end_offset is the byte offset
+    just past the end of the line."""
+    position = offset
+    pending = ""
+    for chunk in upload_chunks(upload, offset):
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find("\n", start) + 1
+            if not end:
+                break
+            line = _decode_line(pending[start:end], position)
+            position += end - start
+            yield line, position
+            start = end
+        pending = pending[start:]
+    if pending:
+        line = _decode_line(pending, position)
+        position += len(pending)
+        yield line, position
+
+def _local_path(upload):
+    """Return the path of the uploaded file if it is an uncompressed
+    file in the local filesystem, or None otherwise."""
+    try:
+        path = upload.upload.path
+    except NotImplementedError:
+        return None
+    f = open(path, "rb")
+    try:
+        if _compression(f.read(4)):
+            return None
+    finally:
+        f.close()
+    return path
+
+def shard_boundaries(path, offset, shard_size):
+    """Split the file at the given path, from the given byte offset to
+    its end, into a list of (start, end) byte ranges of roughly
+    shard_size bytes, each of which begins and ends on a line
+    boundary."""
+    size = os.path.getsize(path)
+    shards = []
+    f = open(path, "rb")
+    try:
+        start = offset
+        while start < size:
+            end = start + shard_size
+            if end < size:
+                ## extend the shard to the end of the line it stops in
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            shards.append((start, end))
+            start = end
+    finally:
+        f.close()
+    return shards
+
+def parse_shard(args):
+    """Parse the lines in one shard of a file; args is a tuple of the
+    file's path, the start and end byte offsets of the shard, the row
+    parser, and whether to fingerprint the rows.  Returns a list of
+    (row, end_offset) pairs, or of (row, fingerprint, end_offset)
+    triples, where the fingerprint is that of the row's first
+    occurrence (see row_fingerprint).  This runs in a worker
+    process."""
+    path, start, end, parser, fingerprint = args
+    rows = []
+    f = open(path, "rb")
+    try:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            text = _decode_line(line, position)
+            position += len(line)
+            row = parser(text)
+            if fingerprint:
+                rows.append((row, row_fingerprint(row), position))
+            else:
+                rows.append((row, position))
+    finally:
+        f.close()
+    return rows
+
+def _sharded_rows(path, parser, offset, workers, fingerprint):
+    shards = [(path, start, end, parser, fingerprint) for start, end
+              in shard_boundaries(path, offset, settings.CLICKWORK_UPLOAD_SHARD_SIZE)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        ## the shards' rows come back in order, however the workers
+        ## happen to finish, and only two shards per worker are parsed
+        ## ahead of the rows being committed
+        for rows in bounded_imap(pool, parse_shard, shards, 2 * workers):
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+
+def _rows(upload, parser, offset, fingerprint):
+    workers = settings.CLICKWORK_UPLOAD_WORKERS
+    path = workers > 1 and _local_path(upload)
+    if path and os.path.getsize(path) - offset > settings.CLICKWORK_UPLOAD_SHARD_SIZE:
+        return _sharded_rows(path, parser, offset, workers, fingerprint)
+    rows = ((parser(line), end) for line, end in upload_lines(upload, offset))
+    if fingerprint:
+        rows = ((row, row_fingerprint(row), end) for row, end in rows)
+    return rows
+
+def read_rows(upload, parser=text_row, offset=0):
+    """Yield (row, end_offset) pairs for each line of the uploaded
+    file, starting at the given byte offset, where each row is what
+    the given parser (a function such as text_row or csv_row, not
+    None; see row_parser) returns for that line.  The parser may be
+    run in worker processes, so it has to be a module-level
+    function."""
+    for row in _rows(upload, parser, offset, False):
+        yield row
+
+def read_fingerprinted_rows(upload, parser=text_row, offset=0):
+    """Like read_rows, but yield (row, fingerprint, end_offset)
+    triples, where the fingerprint is that of the row's first
+    occurrence (see row_fingerprint); when the upload is read in
+    shards, the rows are fingerprinted by the worker processes."""
+    for row in _rows(upload, parser, offset, True):
+        yield row
+
+def count_rows(upload):
+    """Return the number of rows in the uploaded file."""
+    count = 0
+    last = ""
+    for chunk in upload_chunks(upload):
+        count += chunk.count("\n")
+        last = chunk
+    if last and not last.endswith("\n"):
+        count += 1
+    return count
+
+def file_digest(f):
+    """Return the SHA-1 digest, in hex, of the contents of the given
+    Django File, such as a file that has just been uploaded, without
+    closing it."""
+    digest = hashlib.sha1()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_digest(upload):
+    """Return the SHA-1 digest of the uploaded file, as it was
+    uploaded, in hex."""
+    f = upload.upload
+    f.open("rb")
+    try:
+        return file_digest(f)
+    finally:
+        f.close()
+
+def row_fingerprint(row, occurrence=0):
+    """Return a hex digest identifying the contents of a row, and
+    which occurrence of those contents in its upload it is, counting
+    from 0.  (The first occurrence's fingerprint depends only on the
+    contents.)"""
+    text = repr(row)
+    if occurrence:
+        text += "\n#%d" % occurrence
+    return hashlib.sha1(text).hexdigest()
+
+def process_upload(upload, project, chunk_size=None):
+    """Create the tasks for the given upload in the given project,
+    which should already have been cast to its project type's
+    subclass.  If the project supports row-at-a-time processing, any
+    rows that an earlier, interrupted run already committed are
+    skipped, as are rows that are already in the project."""
+    if not upload.digest:
+        upload.digest = upload_digest(upload)
+        ProjectUpload.objects.filter(pk=upload.pk).update(digest=upload.digest)
+    if not hasattr(project, "handle_row"):
+        with transaction.commit_on_success():
+            project.handle_input(upload)
+        return
+    if chunk_size is None:
+        chunk_size = settings.CLICKWORK_UPLOAD_CHUNK_SIZE
+    if upload.rows_total is None:
+        upload.rows_total = count_rows(upload)
+        ProjectUpload.objects.filter(pk=upload.pk).update(rows_total=upload.rows_total)
+    rows = []
+    for row, fingerprint, end in read_fingerprinted_rows(upload, row_parser(project),
+                                                         upload.byte_offset):
+        rows.append((row, fingerprint))
+        if len(rows) >= chunk_size:
+            commit_rows(upload, project, rows, end)
+            rows = []
+    if rows:
+        commit_rows(upload, project, rows, end)
+    UploadFingerprint.objects.filter(upload=upload).delete()
+
+def number_rows(upload, rows):
+    """Given a list of (row, fingerprint) pairs, where each
+    fingerprint is that of the row's first occurrence, return them
+    with the fingerprints of the rows that repeat earlier rows of the
+    upload, in this list or in earlier chunks, changed to that of
+    their occurrence, and record how many rows with each contents the
+    upload has had so far.  This should be called in the transaction
+    that commits the rows."""
+    counts = dict(UploadFingerprint.objects
+                  .filter(upload=upload,
+                          fingerprint__in=set(fingerprint for row, fingerprint in rows))
+                  .values_list("fingerprint", "occurrences"))
+    known = set(counts)
+    numbered = []
+    for row, fingerprint in rows:
+        occurrence = counts.get(fingerprint, 0)
+        counts[fingerprint] = occurrence + 1
+        if occurrence:
+            numbered.append((row, row_fingerprint(row, occurrence)))
+        else:
+            numbered.append((row, fingerprint))
+    ## rows seldom repeat, so there are few of these
+    for fingerprint in known:
+        UploadFingerprint.objects.filter(upload=upload, fingerprint=fingerprint) \
+            .update(occurrences=counts[fingerprint])
+    new = [(fingerprint, count) for fingerprint, count in counts.items()
+           if fingerprint not in known]
+    if new:
+        values = ", ".join(["(%s, %s, %s)"] * len(new))
+        params = []
+        for fingerprint, count in new:
+            params.extend([upload.pk, fingerprint, count])
+        connection.cursor().execute(
+            "INSERT INTO %s (upload_id, fingerprint, occurrences) VALUES %s" % \
+                (UploadFingerprint._meta.db_table, values), params)
+    return numbered
+
+def commit_rows(upload, project, rows, end):
+    """Hand the given rows, a list of (row, fingerprint) pairs, where
+    each fingerprint is that of the row's first occurrence, to the
+    project, except for those that it already has tasks for, and
+    record the new position in the upload, all in one transaction.
+    The upload object is only updated in memory once the transaction
+    has been committed, so that after a failure it still describes
+    the last good checkpoint."""
+    with transaction.commit_on_success():
+        rows = number_rows(upload, rows)
+        fingerprints = [fingerprint for row, fingerprint in rows]
+        ingested = set(Task.objects.filter(project=project,
+                                           input_fingerprint__in=fingerprints)
+                       .values_list("input_fingerprint", flat=True))
+        skipped = 0
+        for row, fingerprint in rows:
+            if fingerprint in ingested:
+                skipped += 1
+            else:
+                project.handle_row(row, input_fingerprint=fingerprint)
+                ingested.add(fingerprint)
+        ProjectUpload.objects.filter(pk=upload.pk).update(
+            rows_processed=upload.rows_processed + len(rows),
+            rows_skipped=upload.rows_skipped + skipped,
+            byte_offset=end)
+    upload.rows_processed += len(rows)
+    upload.rows_skipped += skipped
+    upload.byte_offset = end
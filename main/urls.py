@@ -29,7 +29,9 @@ urlpatterns = patterns('main.views',
     (r'^user/([A-Za-z0-9@+._-]+)/results/$', 'user.recent_results'),
     (r'^remerge/(\d+)/$', 'task.unmerge'),
     (r'^wips/$', 'task.wip_review'),
-    (r'^track/$', 'base.track_page_visit')
+    (r'^track/$', 'base.track_page_visit'),
+    (r'^api/projects/$', 'api.projects'),
+    (r'^api/project/(\d+)/$', 'api.project'),
 )
 
 ## If the "main.types.bar_baz module" has a urlpatterns variable
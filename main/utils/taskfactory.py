@@ -14,46 +14,126 @@ try:
     sys.path.append(djangopath)
     os.environ['DJANGO_SETTINGS_MODULE'] = "settings"
 
-    from main.models import Project, Task, ProjectUpload 
+    from django.conf import settings
+    from main.models import Project, Task, ProjectUpload, ProjectPurge, ProjectExport, \
+        DashboardSnapshot, ProjectStats
     from main.types import type_list
+    from main.uploads import process_upload
+    from main.exports import build_export
+    from main.views.overview import SNAPSHOTS
     import traceback
-    from django.db import transaction
 
 except Exception, e :
     syslog.syslog(syslog.LOG_ERR, "Failed importing %s" % e)
     raise e
 
-@transaction.commit_on_success
 def run_upload(upload):
+    """Process the upload in committed chunks; if this daemon was
+    stopped part of the way through an upload, this picks up from the
+    last committed chunk."""
     upload_type = upload.project.type
     type = type_list[upload_type]
     project = type.cast(upload.project)
     if project.handle_input:
-        project.handle_input(upload)
+        process_upload(upload, project)
 
 def check_uploads():
     pu = ProjectUpload.objects.filter(complete=False)
     if pu.count():
         upload = pu[0]
-        print "Running %s" % upload.id
+        if upload.rows_processed:
+            print "Resuming %s after row %s" % (upload.id, upload.rows_processed)
+        else:
+            print "Running %s" % upload.id
         error = None
+        offset = upload.byte_offset
         try:
             run_upload(upload)
         except Exception, E:
             tb = "".join(traceback.format_tb(sys.exc_traceback))
             error = "Exception Type: %s, Text: %s\nTraceback:\n%s" % (type(E), str(E), tb)    
-        upload.complete = True
         if error:
             syslog.syslog(syslog.LOG_ERR, error)
             upload.error = error
+            ## If some rows were committed before the failure, leave
+            ## the upload to be picked up again from the last
+            ## committed chunk; an upload that fails again without
+            ## getting any further is given up on.
+            upload.complete = upload.byte_offset == offset
+        else:
+            upload.complete = True
+            upload.error = ""
         upload.full_clean()
         upload.save()
         
         print "Done %s" % upload.id
 
+def check_purges():
+    pp = ProjectPurge.objects.filter(complete=False)
+    if pp.count():
+        purge = pp[0]
+        print "Purging %s" % purge.id
+        try:
+            purge.run()
+        except Exception, E:
+            tb = "".join(traceback.format_tb(sys.exc_traceback))
+            error = "Exception Type: %s, Text: %s\nTraceback:\n%s" % (type(E), str(E), tb)
+            syslog.syslog(syslog.LOG_ERR, error)
+            purge.complete = True
+            purge.error = error
+            purge.full_clean()
+            purge.save()
+        print "Done %s" % purge.id
+
+def check_exports():
+    pe = ProjectExport.objects.filter(complete=False)
+    if pe.count():
+        export = pe[0]
+        export_id = export.id
+        print "Exporting %s" % export_id
+        try:
+            build_export(export)
+        except Exception, E:
+            tb = "".join(traceback.format_tb(sys.exc_traceback))
+            error = "Exception Type: %s, Text: %s\nTraceback:\n%s" % (type(E), str(E), tb)
+            syslog.syslog(syslog.LOG_ERR, error)
+            ## Don't keep the failure: whatever went wrong may well
+            ## not happen again, so the next request for this export
+            ## queues it afresh.
+            export.delete()
+        print "Done %s" % export_id
+
+def check_snapshots():
+    """Rebuild the snapshots of the overview pages that are more than
+    settings.CLICKWORK_SNAPSHOT_INTERVAL seconds old, if it is set."""
+    interval = settings.CLICKWORK_SNAPSHOT_INTERVAL
+    if interval is None:
+        return
+    for name in sorted(SNAPSHOTS):
+        if DashboardSnapshot.load(name, interval) is None:
+            try:
+                DashboardSnapshot.store(name, SNAPSHOTS[name]())
+            except Exception, E:
+                tb = "".join(traceback.format_tb(sys.exc_traceback))
+                error = "Exception Type: %s, Text: %s\nTraceback:\n%s" % (type(E), str(E), tb)
+                syslog.syslog(syslog.LOG_ERR, error)
+
+def check_stats():
+    """Count the tasks of the projects whose stats are stale."""
+    try:
+        ProjectStats.rebuild_stale()
+    except Exception, E:
+        tb = "".join(traceback.format_tb(sys.exc_traceback))
+        error = "Exception Type: %s, Text: %s\nTraceback:\n%s" % (type(E), str(E), tb)
+        syslog.syslog(syslog.LOG_ERR, error)
+
 def main_loop():
     while True:
+        check_purges()
         check_uploads()
+        check_exports()
+        check_stats()
+        check_snapshots()
         time.sleep(10)
                         
 
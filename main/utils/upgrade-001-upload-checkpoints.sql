@@ -0,0 +1,7 @@
+-- Track how far processing of each upload has got, so that an
+-- interrupted upload can be resumed.
+BEGIN;
+ALTER TABLE main_projectupload ADD COLUMN rows_processed integer NOT NULL DEFAULT 0;
+ALTER TABLE main_projectupload ADD COLUMN rows_total integer NULL;
+ALTER TABLE main_projectupload ADD COLUMN byte_offset bigint NOT NULL DEFAULT 0;
+COMMIT;
@@ -0,0 +1,11 @@
+-- Fingerprint uploaded files and the rows they contain, so that
+-- uploading the same rows to a project twice does not make
+-- duplicate tasks.
+BEGIN;
+ALTER TABLE main_projectupload ADD COLUMN rows_skipped integer NOT NULL DEFAULT 0;
+ALTER TABLE main_projectupload ADD COLUMN digest varchar(40) NOT NULL DEFAULT '';
+CREATE INDEX main_projectupload_digest ON main_projectupload (digest);
+ALTER TABLE main_task ADD COLUMN input_fingerprint varchar(40) NULL;
+ALTER TABLE main_task ADD CONSTRAINT main_task_project_id_input_fingerprint_key
+    UNIQUE (project_id, input_fingerprint);
+COMMIT;
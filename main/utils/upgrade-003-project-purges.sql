@@ -0,0 +1,15 @@
+-- Requests to empty a project, which are carried out a chunk of
+-- tasks at a time.
+BEGIN;
+CREATE TABLE "main_projectpurge" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL REFERENCES "main_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "timestamp" timestamp with time zone NOT NULL,
+    "complete" boolean NOT NULL,
+    "error" text NOT NULL,
+    "last_task_id" integer NOT NULL,
+    "tasks_total" integer NOT NULL,
+    "tasks_deleted" integer NOT NULL
+);
+CREATE INDEX "main_projectpurge_project_id" ON "main_projectpurge" ("project_id");
+COMMIT;
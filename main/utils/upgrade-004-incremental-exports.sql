@@ -0,0 +1,22 @@
+-- Record when each task's responses or result last changed, so that
+-- exports can include only what changed since the previous one, and
+-- remember each export consumer's watermark.
+BEGIN;
+ALTER TABLE main_task ADD COLUMN modified timestamp with time zone NULL;
+UPDATE main_task SET modified = changes.modified
+    FROM (SELECT task_id, MAX(end_time) AS modified
+          FROM (SELECT task_id, end_time FROM main_response
+                UNION ALL
+                SELECT task_id, end_time FROM main_result) AS work
+          GROUP BY task_id) AS changes
+    WHERE changes.task_id = main_task.id;
+CREATE INDEX "main_task_modified" ON "main_task" ("modified");
+CREATE TABLE "main_exportcursor" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL REFERENCES "main_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "consumer" varchar(100) NOT NULL,
+    "watermark" timestamp with time zone NOT NULL,
+    UNIQUE ("project_id", "consumer")
+);
+CREATE INDEX "main_exportcursor_project_id" ON "main_exportcursor" ("project_id");
+COMMIT;
@@ -0,0 +1,13 @@
+-- Full project exports, kept on disk until the project changes.
+BEGIN;
+CREATE TABLE "main_projectexport" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL REFERENCES "main_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "marker" varchar(40) NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    "complete" boolean NOT NULL,
+    "error" text NOT NULL,
+    UNIQUE ("project_id", "marker")
+);
+CREATE INDEX "main_projectexport_project_id" ON "main_projectexport" ("project_id");
+COMMIT;
@@ -0,0 +1,4 @@
+-- The format each cached project export was built in.
+BEGIN;
+ALTER TABLE "main_projectexport" ADD COLUMN "format" varchar(10) NOT NULL DEFAULT 'files';
+COMMIT;
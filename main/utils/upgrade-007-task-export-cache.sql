@@ -0,0 +1,12 @@
+-- Rendered exports of single tasks, reused until the task changes.
+BEGIN;
+CREATE TABLE "main_cachedtaskexport" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "task_id" integer NOT NULL REFERENCES "main_task" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "kind" varchar(10) NOT NULL,
+    "version" timestamp with time zone NULL,
+    "payload" text NOT NULL,
+    UNIQUE ("task_id", "kind")
+);
+CREATE INDEX "main_cachedtaskexport_task_id" ON "main_cachedtaskexport" ("task_id");
+COMMIT;
@@ -0,0 +1,24 @@
+-- Task counts for each project, kept up to date as the tasks change.
+-- They are filled in the first time they are needed, or by running
+-- the rebuild_stats management command.
+BEGIN;
+CREATE TABLE "main_projectstats" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL UNIQUE REFERENCES "main_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "tasks" integer NOT NULL,
+    "to_tag" integer NOT NULL,
+    "needs_merging" integer NOT NULL,
+    "merged" integer NOT NULL,
+    "in_flight" integer NOT NULL,
+    "stale" boolean NOT NULL,
+    "updated" timestamp with time zone NOT NULL
+);
+CREATE TABLE "main_assignmentcount" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL REFERENCES "main_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "completed_assignments" integer NOT NULL,
+    "tasks" integer NOT NULL,
+    UNIQUE ("project_id", "completed_assignments")
+);
+CREATE INDEX "main_assignmentcount_project_id" ON "main_assignmentcount" ("project_id");
+COMMIT;
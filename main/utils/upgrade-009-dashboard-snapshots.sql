@@ -0,0 +1,10 @@
+-- Precomputed data for the overview pages (see the build_snapshots
+-- management command).
+BEGIN;
+CREATE TABLE "main_dashboardsnapshot" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "name" varchar(64) NOT NULL UNIQUE,
+    "data" text NOT NULL,
+    "built" timestamp with time zone NOT NULL
+);
+COMMIT;
@@ -0,0 +1,12 @@
+-- Counts of the rows seen so far in uploads that are being processed,
+-- so that repeated rows can be numbered a chunk at a time.
+BEGIN;
+CREATE TABLE "main_uploadfingerprint" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "upload_id" integer NOT NULL REFERENCES "main_projectupload" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "fingerprint" varchar(40) NOT NULL,
+    "occurrences" integer NOT NULL,
+    UNIQUE ("upload_id", "fingerprint")
+);
+CREATE INDEX "main_uploadfingerprint_upload_id" ON "main_uploadfingerprint" ("upload_id");
+COMMIT;
@@ -0,0 +1,152 @@
+"""A read-only JSON version of the overview pages, for monitoring
+scripts.
+
+Rather than rendering a whole page, each request gets one page of at
+most settings.CLICKWORK_API_PAGE_SIZE items (fewer if the limit
+parameter asks for fewer), as compact JSON, with the cursors to pass
+as the after or before parameter to get the next or previous page.
+The fields parameter, a comma-separated list of field names, picks
+out just those fields of each item.  Every response carries an ETag
+header, made from the ids of the projects on the page, the exact
+times at which their ProjectStats last changed, and what was asked
+for, so that a script that sends it back in If-None-Match gets an
+empty 304 response until something has changed, even within the same
+second.  Responses also carry a Last-Modified header, for scripts
+that send If-Modified-Since instead, unless the data changed within
+the current second (since Last-Modified can only name a whole second,
+a later change within the same second could not be told apart)."""
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db.models import Count, Max
+from django.shortcuts import get_object_or_404
+from main.helpers import http_basic_auth
+from main.models import Project, ProjectStats
+from main.views.overview import brief_project_dicts, keyset_page, task_page, TASK_STATES
+from main.wrapper import get, CompactJSONResponse, ErrorResponse, ForbiddenResponse, \
+    NotModifiedResponse, not_modified
+
+import django.utils.html
+import hashlib
+import time
+
+class BadParameter(ValueError):
+    """Raised when a request's parameters make no sense."""
+
+def page_size(guts):
+    """Return the number of items that the request asks for."""
+    try:
+        limit = int(guts.parameters.get("limit") or settings.CLICKWORK_API_PAGE_SIZE)
+    except ValueError:
+        raise BadParameter("The limit must be a number.")
+    if limit < 1:
+        raise BadParameter("The limit must be positive.")
+    return min(limit, settings.CLICKWORK_API_PAGE_SIZE)
+
+def cursors(guts):
+    """Return the after and before parameters, as ids, or None."""
+    try:
+        return [guts.parameters.get(name) and int(guts.parameters[name]) or None
+                for name in ("after", "before")]
+    except ValueError:
+        raise BadParameter("Cursors must be ids.")
+
+def select_fields(guts, items):
+    """Cut down each of the given dicts to the fields asked for."""
+    fields = guts.parameters.get("fields")
+    if not fields:
+        return items
+    fields = fields.split(",")
+    for field in fields:
+        if items and field not in items[0]:
+            raise BadParameter("There is no field called %s." % django.utils.html.escape(field))
+    return [dict((field, item[field]) for field in fields) for item in items]
+
+def page_etag(stats, *parts):
+    """Return an ETag for a page about the projects that the given
+    ProjectStats belong to, which changes when the projects on the
+    page change, when any of their stats do, or when any of the other
+    given parts of the page (such as its cursors, or the fields asked
+    for) do."""
+    versions = ["%s@%s" % (s.project_id, s.updated.isoformat())
+                for s in sorted(stats, key=lambda s: s.project_id)]
+    versions.extend(repr(part) for part in parts)
+    return '"%s"' % hashlib.sha1(" ".join(versions)).hexdigest()
+
+def last_modified(stats):
+    """Return the time, in seconds since the epoch, at which the most
+    recently changed of the given ProjectStats changed, or None if
+    that was within the current second, or there are none."""
+    if not stats:
+        return None
+    modified = int(time.mktime(max(s.updated for s in stats).timetuple()))
+    if modified >= int(time.time()):
+        return None
+    return modified
+
+@http_basic_auth
+@login_required
+@get
+def projects(guts):
+    """A page of the projects in all_projects_brief, in order of id,
+    with the same fields."""
+    if not guts.user.is_superuser:
+        return ForbiddenResponse("Only administrators can see this page.")
+    try:
+        after, before = cursors(guts)
+        rows, previous_cursor, next_cursor = keyset_page(
+            Project.objects.filter(priority__gte=0).values("id"), "id",
+            after, before, page_size(guts))
+        ids = [row["id"] for row in rows]
+        stats = ProjectStats.for_projects(ids).values()
+        ## a project that is added or taken away beyond this page
+        ## changes the cursors of some page, if not of this one
+        listing = Project.objects.filter(priority__gte=0) \
+            .aggregate(count=Count("id"), last=Max("id"))
+        etag = page_etag(stats, previous_cursor, next_cursor, guts.parameters.get("fields"),
+                         listing["count"], listing["last"])
+        modified = last_modified(stats)
+        if not_modified(guts.meta, etag, modified):
+            return NotModifiedResponse(etag, modified)
+        items = select_fields(guts, brief_project_dicts(
+                Project.objects.filter(id__in=ids).order_by("id")))
+    except BadParameter, e:
+        return ErrorResponse("Bad parameter", e.args[0])
+    return CompactJSONResponse({"projects": items,
+                                "previous_cursor": previous_cursor,
+                                "next_cursor": next_cursor}, etag, modified)
+
+@http_basic_auth
+@login_required
+@get
+def project(guts, project_id):
+    """A project's task counts, along with a page of its tasks (in
+    the state given by the state parameter, as in one_project)."""
+    project = get_object_or_404(Project, pk=project_id)
+    if not (guts.user.is_superuser or guts.user == project.admin):
+        return ForbiddenResponse("Only project owners or administrators may see this page.")
+    state = guts.parameters.get("state") or None
+    if state not in TASK_STATES:
+        return ErrorResponse("Bad task state", "There is no task state called %s." % \
+                                 django.utils.html.escape(state))
+    try:
+        after, before = cursors(guts)
+        limit = page_size(guts)
+        stats = ProjectStats.for_projects([project.id])[project.id]
+        etag = page_etag([stats], state, after, before, limit, guts.parameters.get("fields"))
+        modified = last_modified([stats])
+        if not_modified(guts.meta, etag, modified):
+            return NotModifiedResponse(etag, modified)
+        page = task_page(project, state, after, before, limit)
+        tasks = select_fields(guts, page["tasks"])
+    except BadParameter, e:
+        return ErrorResponse("Bad parameter", e.args[0])
+    return CompactJSONResponse({"id": project.id,
+                                "tasks_total": stats.tasks,
+                                "to_tag": stats.to_tag,
+                                "needs_merging": stats.needs_merging,
+                                "merged": stats.merged,
+                                "in_flight": stats.in_flight,
+                                "tasks": tasks,
+                                "previous_cursor": page["previous_cursor"],
+                                "next_cursor": page["next_cursor"]}, etag, modified)
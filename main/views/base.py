@@ -6,6 +6,7 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template.loader import get_template
 from main.models import Task, WorkInProgress, Response, Result, Review, AutoReview, PageTrack, Announcement
+from main.workload import workload_counts
 from main.wrapper import get, get_or_post, TemplateResponse, ViewResponse, RefererResponse, \
     ForbiddenResponse, RequestGuts
 from urlparse import urlparse
@@ -35,18 +36,15 @@ def home(guts):
        annotate or merge.
        """
     site_messages = Announcement.objects.filter(enabled=True)
-    respondable_tasks = Task.objects.can_annotate(guts.user)
-    resolvable_tasks = Task.objects.can_merge(guts.user)
+    respondable_task_count, resolvable_task_count = workload_counts(guts.user)
     recent_responses = Response.objects.filter(user=guts.user).order_by('-end_time')[0:5]
     recent_results = Result.objects.filter(user=guts.user).order_by('-end_time')[0:5]
     reviews = Review.objects.filter(complete=False, response__user=guts.user)
     if "visitable_pages" not in guts.session:
         guts.session["visitable_pages"] = visitable(guts.user)
     template = get_template("home.html")
-    return TemplateResponse(template, {'respondable_tasks': respondable_tasks,
-                                       'respondable_task_count': respondable_tasks.count(),
-                                       'resolvable_tasks': resolvable_tasks,
-                                       'resolvable_task_count': resolvable_tasks.count(),
+    return TemplateResponse(template, {'respondable_task_count': respondable_task_count,
+                                       'resolvable_task_count': resolvable_task_count,
                                        'recent_responses': recent_responses,
                                        'recent_results': recent_results,
                                        'reviews': reviews,
@@ -132,7 +130,8 @@ def next_task(guts):
                             auto_review_pending[0].task.id)
     new_auto_reviews = AutoReview.objects.filter(
         user=guts.user, task__project__priority__gte=0,
-        start_time__isnull=True, end_time__isnull=True).order_by("-task__project__priority")
+        start_time__isnull=True, end_time__isnull=True).exclude(
+        task__project__projectpurge__complete=False).order_by("-task__project__priority")
     if new_auto_reviews.exists():
         auto_review = new_auto_reviews[0]
         auto_review.start_time = datetime.datetime.now()
@@ -1,27 +1,29 @@
+from django.conf import settings
+from django.core.urlresolvers import reverse
 from django.db.models import Count
-from django.db import connection
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Group, User
 from django.shortcuts import get_object_or_404
 from django.template.loader import get_template
-from main.models import Project, ProjectTag, Response, Result, Review, Task, ProjectUpload
-from main.wrapper import get, DefaultResponse, TemplateResponse, ForbiddenResponse
+from main.models import Project, ProjectTag, Response, Result, Review, Task, ProjectUpload, \
+    ProjectPurge, ProjectStats, DashboardSnapshot
+from main.wrapper import get, DefaultResponse, TemplateResponse, ForbiddenResponse, ErrorResponse
+from main.membership import group_members
+from main.workload import workload_counts
 
+import django.utils.html
+import simplejson as json
 import sys
 
-def all_group_members(groups, cache=None):
+def all_group_members(groups):
     """Takes a list of group objects, and returns the usernames of every
-    user who is in at least one of the given groups.  If cache is
-    present, it should be a dict mapping group IDs to lists of usernames.  If
-    cache is None, this function goes to the database."""
-    if cache:
-        list_o_sets = [frozenset(cache[g.id]) for g in groups]
-    else:
-        list_o_sets = [frozenset([u.username for u in g.user_set.all() if u.is_active])
-                       for g in groups]
+    active user who is in at least one of the given groups, using the
+    shared group membership cache (see main.membership)."""
+    members = group_members([g.id for g in groups])
+    list_o_sets = [frozenset(members[g.id]) for g in groups]
     return sorted(reduce(lambda s1, s2: s1 | s2, list_o_sets, frozenset([])))
 
-def project_info(p, cache=None):
+def project_info(p):
     """Return many things about the given project that we might want to
     pass along to a template for display."""
     return {"id": p.id,
@@ -33,11 +35,11 @@ def project_info(p, cache=None):
             "task_count": p.task_set.count(),
             "annotator_groups": [{"name": g.name, "id": g.id}
                                  for g in p.annotators.all()],
-            "annotators": all_group_members(list(p.annotators.all()), cache),
+            "annotators": all_group_members(list(p.annotators.all())),
             "merger_groups": [{"name": g.name, "id": g.id}
                               for g in p.mergers.all()],
-            "mergers": all_group_members(list(p.mergers.all()), cache),
-            "tags": p.tags.all()}
+            "mergers": all_group_members(list(p.mergers.all())),
+            "tags": [unicode(t) for t in p.tags.all()]}
 
 def projects_query_set(filter_tags):
     """Generate a QuerySet object for projects, filtered as necessary according to
@@ -50,71 +52,166 @@ def projects_query_set(filter_tags):
     projects = projects.order_by("-id")
     return projects
 
+def projects_data(filter_tags):
+    """Return the data that all_projects shows."""
+    return {"project_list": [project_info(p) for p in projects_query_set(filter_tags)]}
+
 @login_required
 @get
 def all_projects(guts):
     """Summarize the status of the active projects whose tags match
     the filters in the query parameter."""
     if guts.user.is_superuser:
-        qs = projects_query_set(guts.parameters.getlist("filter"))
-        cache = dict([(g.id, [u.username for u in g.user_set.all() if u.is_active])
-                      for g in Group.objects.all()])
-        result = {"project_list":
-                      [project_info(p, cache) for p in qs]}
+        filter_tags = guts.parameters.getlist("filter")
+        if filter_tags:
+            result = projects_data(filter_tags)
+        else:
+            result = snapshot_data(guts, "all_projects")
         template = get_template("overview.html")
         return TemplateResponse(template, result)
     else:
         return ForbiddenResponse("Only administrators can see this page.")
 
+def related_names(relation, project_ids):
+    """Given a many-to-many relation of Project (such as
+    Project.annotators), return a dict mapping each of the given
+    project ids to the unicode names of its related objects, fetched
+    in a single query."""
+    source = relation.field.m2m_field_name()
+    target = relation.field.m2m_reverse_field_name()
+    names = dict((project_id, []) for project_id in project_ids)
+    for link in relation.through.objects.filter(**{source + "__in": project_ids}) \
+            .select_related(target).order_by(target + "__id"):
+        names[getattr(link, source + "_id")].append(unicode(getattr(link, target)))
+    return names
+
+def brief_project_dicts(projects):
+    """Return, for each of the given projects, what Project.as_dict
+    returns, along with its priority and status counts (from
+    ProjectStats), in a fixed number of queries however many projects
+    there are."""
+    projects = list(projects.select_related("admin"))
+    ids = [p.id for p in projects]
+    stats = ProjectStats.for_projects(ids)
+    annotators = related_names(Project.annotators, ids)
+    mergers = related_names(Project.mergers, ids)
+    tags = related_names(Project.tags, ids)
+    result = []
+    for p in projects:
+        ## the same keys as Project.as_dict
+        d = {"id": p.id,
+             "title": p.title,
+             "description": p.description,
+             "annotators": annotators[p.id],
+             "mergers": mergers[p.id],
+             "type": p.type,
+             "admin": unicode(p.admin),
+             "annotator_count": p.annotator_count,
+             "priority": p.priority,
+             "needs_fresh_eyes": p.needs_fresh_eyes,
+             "tags": sorted(tags[p.id])}
+        d["priority_display"] = p.get_priority_display()
+        d["remaining_to_tag"] = stats[p.id].to_tag
+        d["remaining_to_merge"] = stats[p.id].needs_merging
+        d["merged"] = stats[p.id].merged
+        result.append(d)
+    return result
+
+def brief_projects_data(filter_tags):
+    """Return the data that all_projects_brief shows."""
+    return {"project_list": brief_project_dicts(projects_query_set(filter_tags)),
+            "available_tags": [{"name": tag.name} for tag in ProjectTag.objects.all()],
+            "selected_tags": filter_tags}
+
 @login_required
 @get
 def all_projects_brief(guts):
     """Summarize the active projects, whose tags match the filters in
     the query parameter, more succinctly."""
-    def extended_dict(project):
-        d = project.as_dict()
-        d["priority_display"] = project.get_priority_display()
-        d["remaining_to_tag"] = project.task_set.filter(completed=False).count()
-        d["remaining_to_merge"] = project.task_set.filter(completed=True,
-                                                          result__isnull=True).count()
-        d["merged"] = project.task_set.filter(completed=True, result__isnull=False).count()
-        return d
     if guts.user.is_superuser:
         filter_tags = guts.parameters.getlist("filter")
-        qs = projects_query_set(filter_tags)
-        data = {"project_list": [extended_dict(p) for p in qs],
-                "available_tags": [tag for tag in ProjectTag.objects.all()],
-                "selected_tags": filter_tags}
+        if filter_tags:
+            data = brief_projects_data(filter_tags)
+        else:
+            data = snapshot_data(guts, "all_projects_brief")
         template = get_template("brief-overview.html")
         return TemplateResponse(template, data)
     else:
         return ForbiddenResponse("Only administrators can see this page.")
 
+def keyset_page(rows, key, after, before, page_size):
+    """Given a values() QuerySet and the name of a unique field in it,
+    return a (rows, previous_cursor, next_cursor) tuple for the page
+    of up to page_size rows, ordered by that field, that come just
+    after the value after, or just before the value before, or else
+    at the start.  The cursors are the values to pass as before or
+    after to get the previous or next page, or None if there is no
+    such page.  Since this seeks to the page by the field's value
+    rather than counting rows from the start, every page costs the
+    same."""
+    if before is not None:
+        rows = list(rows.filter(**{key + "__lt": before}).order_by("-" + key)[:page_size + 1])
+        more_before, more_after = len(rows) > page_size, True
+        rows = rows[:page_size]
+        rows.reverse()
+    else:
+        if after is not None:
+            rows = rows.filter(**{key + "__gt": after})
+        rows = list(rows.order_by(key)[:page_size + 1])
+        more_before, more_after = after is not None, len(rows) > page_size
+        rows = rows[:page_size]
+    previous_cursor = rows and more_before and rows[0][key] or None
+    next_cursor = rows and more_after and rows[-1][key] or None
+    return rows, previous_cursor, next_cursor
+
+#: The states that one_project can list the tasks in, and how to
+#: pick out the tasks in each of them.
+TASK_STATES = {None: {},
+               "to_tag": {"completed": False},
+               "needs_merging": {"completed": True, "result__isnull": True},
+               "merged": {"result__isnull": False}}
+
+def task_page(project, state=None, after=None, before=None, page_size=None):
+    """Return one page of the project's tasks in the given state (a
+    key of TASK_STATES), in id order, as a dict with these keys:
+
+      * tasks: a list of dicts with each task's id, url, and whether
+        it is completed and merged;
+      * next_cursor, previous_cursor: the values to pass as after or
+        before to get the next or previous page, or None if there is
+        no such page.
+
+    The page is the one just after the task whose id is after, or
+    just before the one whose id is before, or else the first.  It
+    is fetched in a single query, joined with the tasks' results, and
+    is as quick to get at the end of a big project as at the start.
+    Raises ValueError if a cursor is not a task id."""
+    if page_size is None:
+        page_size = settings.CLICKWORK_TASK_PAGE_SIZE
+    rows = Task.objects.filter(project=project, **TASK_STATES[state]) \
+        .values("id", "completed", "result__id")
+    rows, previous_cursor, next_cursor = keyset_page(rows, "id",
+                                                     after is not None and int(after) or None,
+                                                     before is not None and int(before) or None,
+                                                     page_size)
+    tasks = [{"id": row["id"],
+              "url": reverse("main.views.task.task_view", kwargs={"task_id": str(row["id"])}),
+              "completed": row["completed"],
+              "merged": row["result__id"] is not None}
+             for row in rows]
+    return {"tasks": tasks,
+            "next_cursor": next_cursor,
+            "previous_cursor": previous_cursor}
+
 @login_required
 @get
 def one_project(guts, project_id):
     """Summarize information about a single project."""
     project = get_object_or_404(Project, pk=project_id)
     if guts.user.is_superuser or guts.user == project.admin:
-        ## Generate assignment counts.  When a project has 5000 or more tasks,
-        ## the join-group-and-count operation using the Django QuerySet API
-        ## is painfully slow, so we are dropping back to raw SQL here.
-        query = """SELECT completed_assignments, COUNT(t.id) AS howmany
-                   FROM main_task AS t LEFT JOIN main_result AS r ON (r.task_id = t.id)
-                   WHERE project_id = %s AND (r.id IS NULL OR NOT completed)
-                   GROUP BY completed_assignments"""
-        cursor = connection.cursor()
-        cursor.execute(query, [project.id])
-        assignments = [{"completed_assignments": completed_assignments,
-                        "howmany": howmany}
-                       for completed_assignments, howmany in cursor.fetchall()]
-        tasks = project.task_set
-        needs_merging = tasks.filter(completed=True, result__isnull=True)
-        if needs_merging.count():
-            assignments.append({'completed_assignments': 'Needs Merging', 'howmany': needs_merging.count()})
-        finished = tasks.filter(result__isnull=False)
-        if finished.count():
-            assignments.append({'completed_assignments': 'Finished', 'howmany': finished.count()})
+        ## Assignment counts, kept up to date as the tasks change
+        stats = ProjectStats.for_projects([project.id])[project.id]
+        assignments = stats.assignments()
         
         # Project overview info    
         pi = project_info(project)
@@ -122,24 +219,30 @@ def one_project(guts, project_id):
         # Uploaded files
         uploads = ProjectUpload.objects.filter(project=project)
 
-        # Task info
-        MAXIMUM_TASKS_TO_LINK = 1500
-        if tasks.count() <= MAXIMUM_TASKS_TO_LINK:
-            ti = [{"id": t.id,
-                   "url": t.get_absolute_url(),
-                   "completed": t.completed,
-                   "merged": t.merged}
-                  for t in tasks.order_by("id")]
-            show_tasks = True
-        else:
-            ti = None
-            show_tasks = False
+        # Requests to empty the project that are still being carried out
+        purges = ProjectPurge.objects.filter(project=project, complete=False)
+
+        # Task info, a page at a time
+        state = guts.parameters.get("state") or None
+        if state not in TASK_STATES:
+            return ErrorResponse("Bad task state", "There is no task state called %s." % \
+                                     django.utils.html.escape(state))
+        try:
+            page = task_page(project, state,
+                             after=guts.parameters.get("after") or None,
+                             before=guts.parameters.get("before") or None)
+        except ValueError:
+            return ErrorResponse("Bad cursor", "The task list cursor must be a task id.")
         template = get_template("project.html")
         return TemplateResponse(template, {"project": pi,
-                                           "show_tasks": show_tasks,
-                                           "tasks": ti, 
+                                           "tasks": page["tasks"],
+                                           "task_state": state,
+                                           "next_cursor": page["next_cursor"],
+                                           "previous_cursor": page["previous_cursor"],
                                            'assignments': assignments, 
-                                           'uploads': uploads})
+                                           'in_flight': stats.in_flight,
+                                           'uploads': uploads,
+                                           'purges': purges})
     else:
         return ForbiddenResponse("Only project owners or administrators may see this page.")
 
@@ -148,49 +251,102 @@ def one_project(guts, project_id):
 def all_groups(guts):
     """Summarize information about all the groups in the database."""
     if guts.user.is_superuser:
+        groups = list(Group.objects.order_by("name"))
+        members = group_members([g.id for g in groups])
         groups_info = [{"id": g.id,
                         "name": g.name,
-                        "users": [u.username for u in g.user_set.order_by("username")
-                                  if u.is_active]}
-                       for g in Group.objects.order_by("name")]
+                        "users": members[g.id]}
+                       for g in groups]
         template = get_template("groups.html")
         return TemplateResponse(template, {"groups": groups_info})
     else:
         return ForbiddenResponse("Only administrators can see this page.")
 
+def group_details(group):
+    """Return what one_group shows about the given group: its active
+    members' usernames and email addresses (fetched together, in one
+    query) and the projects it may annotate and merge (one query
+    each)."""
+    members = list(group.user_set.filter(is_active=True).order_by("username")
+                   .values_list("username", "email"))
+    annotates = group.annotator_for.order_by("title").values("title", "id")
+    merges = group.merger_for.order_by("title").values("title", "id")
+    return {"id": group.id, "name": group.name,
+            "users": [username for username, email in members],
+            "emails": [email for username, email in members],
+            "annotates": list(annotates), "merges": list(merges)}
+
 @login_required
 @get
 def one_group(guts, group_id):
     """Summarize information about one group."""
     if guts.user.is_superuser:
         group = get_object_or_404(Group, pk=group_id)
-        users = [u.username for u in group.user_set.order_by("username") if u.is_active]
-        emails = [u.email for u in group.user_set.order_by("username") if u.is_active]
-        annotates = [{"title": p.title, "id": p.id}
-                     for p in group.annotator_for.order_by("title")]
-        merges = [{"title": p.title, "id": p.id}
-                  for p in group.merger_for.order_by("title")]
         template = get_template("group.html")
-        return TemplateResponse(template,
-                                {"id": group_id, "name": group.name,
-                                 "users": users, "annotates": annotates, "merges": merges, 
-                                 "emails": emails})
+        return TemplateResponse(template, group_details(group))
     else:
         return ForbiddenResponse("Only administrators can see this page.")
         
 
+def users_data(after=None, before=None):
+    """Return the page of users that all_users shows."""
+    ## The counts are correlated subqueries rather than joins, so
+    ## that the responses and results don't multiply each other.
+    rows = User.objects.filter(is_active=True).extra(select={
+            "annotated": """SELECT COUNT(*) FROM main_response
+                            WHERE main_response.user_id = auth_user.id""",
+            "merged": """SELECT COUNT(*) FROM main_result
+                         WHERE main_result.user_id = auth_user.id"""}) \
+        .values("username", "is_superuser", "annotated", "merged")
+    rows, previous_cursor, next_cursor = keyset_page(
+        rows, "username", after, before, settings.CLICKWORK_USER_PAGE_SIZE)
+    users = [{"name": row["username"],
+              "is_superuser": row["is_superuser"],
+              "annotated": row["annotated"],
+              "merged": row["merged"]}
+             for row in rows]
+    return {"users": users,
+            "previous_cursor": previous_cursor,
+            "next_cursor": next_cursor}
+
+#: The overview pages that can be served from snapshots (when they
+#: are not filtered or paged), and how to get the data for each.
+SNAPSHOTS = {"all_projects": lambda: projects_data([]),
+             "all_projects_brief": lambda: brief_projects_data([]),
+             "all_users": users_data}
+
+def snapshot_data(guts, name):
+    """Return the data for the overview page with the given name (one
+    of the keys of SNAPSHOTS) from its snapshot, if it has one that is
+    no older than settings.CLICKWORK_SNAPSHOT_MAX_AGE, and otherwise
+    from the database.  Data from a snapshot also says when the
+    snapshot was built.  Passing the refresh parameter (which only
+    superusers can do, as only they can see these pages) rebuilds the
+    snapshot first."""
+    if guts.parameters.get("refresh"):
+        snapshot = DashboardSnapshot.store(name, SNAPSHOTS[name]())
+    else:
+        snapshot = DashboardSnapshot.load(name, settings.CLICKWORK_SNAPSHOT_MAX_AGE)
+        if snapshot is None:
+            return SNAPSHOTS[name]()
+    data = json.loads(snapshot.data)
+    data.update({"snapshot_built": snapshot.built, "snapshot_age": snapshot.age()})
+    return data
+
 @login_required
 @get
 def all_users(guts):
-    """Summarize information about all users."""
+    """Summarize information about all active users, a page at a time
+    (see keyset_page; the cursors are usernames)."""
     if guts.user.is_superuser:
-        users = [{"name": u.username,
-                  "is_superuser": u.is_superuser,
-                  "annotated": u.response_set.count(),
-                  "merged": u.result_set.count()}
-                 for u in User.objects.order_by("username") if u.is_active]
+        after = guts.parameters.get("after") or None
+        before = guts.parameters.get("before") or None
+        if after or before:
+            data = users_data(after, before)
+        else:
+            data = snapshot_data(guts, "all_users")
         template = get_template("users.html")
-        return TemplateResponse(template, {"users": users})
+        return TemplateResponse(template, data)
     else:
         return ForbiddenResponse("Only administrators can see this page.")
 
@@ -207,13 +363,14 @@ def one_user(guts, username):
                           Result.objects.filter(user=user).order_by("-end_time")[0:20]]
         recent_reviews = [r.id for r in
                           Review.objects.filter(response__user=user).order_by("-creation_time")[0:20]]
+        respondable_task_count, resolvable_task_count = workload_counts(user)
         template = get_template("user.html")
         return TemplateResponse(template,
                                 {"name": username,
                                  "is_superuser": user.is_superuser,
                                  "groups": groups,
-                                 "respondable_task_count": Task.objects.can_annotate(user).count(),
-                                 "resolvable_task_count": Task.objects.can_merge(user).count(),
+                                 "respondable_task_count": respondable_task_count,
+                                 "resolvable_task_count": resolvable_task_count,
                                  "recent_responses": recent_responses,
                                  "recent_results": recent_results,
                                  "recent_reviews": recent_reviews})
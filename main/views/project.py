@@ -1,7 +1,8 @@
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template.loader import get_template
 from django.http import HttpResponse
-from main.models import Project, ProjectUpload, Task, Response
+from main.models import Project, ProjectPurge, ProjectUpload, Task, ExportCursor, \
+    ProjectExport, EXPORT_FORMAT_CHOICES
 from django.contrib.auth.decorators import login_required
 from django.forms import ModelForm
 from main.helpers import get_project_type
@@ -10,13 +11,20 @@ import zipfile
 from django.conf import settings
 from main.views.overview import one_project
 from main.wrapper import get, get_or_post, RequestGuts, TemplateResponse, \
-    DefaultResponse, AttachmentResponse, ForbiddenResponse, ErrorResponse, ViewResponse
+    DefaultResponse, AttachmentResponse, ForbiddenResponse, ErrorResponse, ViewResponse, \
+    FileAttachmentResponse, NotModifiedResponse
 from main.helpers import get_project_type, http_basic_auth
+from main.uploads import process_upload, file_digest
+from main.exports import export_entries, zip_chunks, completed_tasks, \
+    manifest_entry, parse_watermark, export_marker, export_chunks, filter_tasks, EXPORT_FILTERS
 from django.template.loader import get_template
-from django.db.models import Count
+from django.db import connection
 import django.utils.html
 from django.conf import settings
 
+import datetime
+import itertools
+import os
 from functools import wraps
 def project_owner_required(f):
     """Wraps a function that takes, as its first arguments, either a
@@ -103,14 +111,28 @@ def project_upload(get, guts, project):
             pu = ProjectUpload(project=project)
             item = UploadForm(guts.parameters, guts.files, instance=pu)
             if item.is_valid():
-                item.save()
-                if not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE:
-                    project.handle_input(pu)
+                item.save(commit=False)
+                pu.digest = file_digest(guts.files["upload"])
+                pu.save()
+                ## If the same file is still waiting to be processed (say,
+                ## because the first attempt to upload it timed out), there
+                ## is no need to queue it again.
+                pending = ProjectUpload.objects.filter(project=project, digest=pu.digest,
+                                                       complete=False).exclude(pk=pu.pk)
+                if pending.exists():
+                    pu.upload.delete(save=False)
+                    pu.delete()
+                    message = "This file was already uploaded, and is queued as %s" % pending[0].id
+                elif not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE:
+                    process_upload(pu, project)
                     if project.auto_review:
                         project.add_auto_reviews()
                     pu.complete = True
                     pu.save()
                     message = "Upload complete to project %s, tasks processed" % project.id
+                    if pu.rows_skipped:
+                        message += "; %d row%s already in the project skipped" % \
+                            (pu.rows_skipped, pu.rows_skipped != 1 and "s" or "")
                 else:
                     message = "Upload complete, queued as %s" % pu.id
                 guts.log_info(message)
@@ -120,18 +142,19 @@ def project_upload(get, guts, project):
                 template = get_template("project/upload_form.html")
                 return TemplateResponse(template, {"form": item})
         elif action == "Empty":
-            ## NOTE: if subclasses have customized the delete() method,
-            ## this bulk-delete will not call it.
-            Task.objects.filter(project=project).delete()
+            ## The tasks are hidden from annotators right away; if
+            ## settings.PROCESS_INLINE is turned off, they are deleted
+            ## a chunk at a time by the task factory.
+            purge = ProjectPurge.request(project)
+            if not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE:
+                purge.run()
+                guts.log_info("Emptied project %s" % project.id)
+            else:
+                guts.log_info("Emptying of project %s queued as %s" % (project.id, purge.id))
             return ViewResponse(one_project, project.id)
         else:
             return ErrorResponse("Bad form", "Action parameter %s not understood" % action)
 
-# TODO: Incremental exports (export what is done today, then export
-# what has been finished since that tomorrow) are not implemented.
-# at some point, we will want them if we like the current manual
-# tagger behavior, but we don't need them yet.
-
 # TODO: We probably want a flag to be able to export partially
 # completed tasks, but we may not want them to be exported by
 # default.
@@ -153,53 +176,221 @@ def project_export(guts, project):
        files for each Task; the filenames should be like 
        task-id-ExportString, where exportString is a string returned
        from the export_task function.
+
+       The zipfile is streamed to the client as it is built (unless
+       the JSON response format is requested), so only the first
+       entry has to be rendered before the download starts.
+
+       Full exports are built once and kept on disk until the
+       project changes; the response carries an ETag, so a client
+       that sends it back in If-None-Match is told that nothing has
+       changed.  When uploads are processed inline, the first client
+       to ask is sent the export as it is built; otherwise, the export
+       is built by the task factory, and until it is ready the client
+       is asked to try again later.  An interrupted download of a full
+       export can be resumed with a Range header.
+
+       Exports can be incremental.  With a \"since\" parameter (a
+       watermark from an earlier export's manifest.json), only the
+       tasks whose responses or result changed after that time are
+       exported.  With a \"cursor\" parameter, the watermark is
+       remembered on the server under that name, but only once the
+       consumer acknowledges it by sending it back as the \"ack\"
+       parameter of its next export: until then every export for
+       the cursor starts from the last acknowledged watermark (or is
+       a full one), so an export that never reached the consumer is
+       simply sent again.  Either way, the zipfile ends with a
+       manifest.json giving the new watermark, which is taken
+       settings.CLICKWORK_EXPORT_WATERMARK_LAG seconds in the past so
+       that changes still being committed when the export starts are
+       not missed.  Delivery is therefore at-least-once: a task can
+       turn up in two consecutive exports, and consumers should
+       expect to see it again.
+
+       With a "format" parameter of "jsonl" or "csv", the tasks
+       are exported as tables instead, using the tasks' export_rows
+       method: each batch of tasks gets one file per table.
+
+       The tasks to export can be narrowed down with the parameters
+       listed in main.exports.EXPORT_FILTERS (ranges of task ids,
+       merged tasks, result times, annotators; see
+       main.exports.filter_tasks).  Filtered exports are streamed
+       rather than cached, and only end with a manifest.json if they
+       are also incremental.
     """   
     ptype = get_project_type(project)
     project = ptype.cast(project)
-    completed_tasks = Task.objects.filter(completed=True, project=project)
-    data = []
-
-    buffer = StringIO()
-    zip = zipfile.ZipFile(buffer,  "w", zipfile.ZIP_DEFLATED)
-    def put(pathname, data):
-        if isinstance(data, unicode):
-            data = data.encode("utf-8")
-        info = zipfile.ZipInfo(pathname)
-        info.external_attr = settings.CLICKWORK_EXPORT_FILE_PERMISSIONS << 16L
-        zip.writestr(info, data)
-    ## a project type can put an export method on its task and/or its project subclass
+    format = guts.parameters.get("format", "files")
+    if format not in dict(EXPORT_FORMAT_CHOICES):
+        return ErrorResponse("Bad format",
+                             "There is no export format called %s." % \
+                                 django.utils.html.escape(format))
+    incremental = "since" in guts.parameters or "cursor" in guts.parameters
+    filtered = [name for name in EXPORT_FILTERS if guts.parameters.get(name)]
+    if not incremental and not filtered:
+        return cached_export(guts, project, format)
+    ## Take the new watermark before looking at the tasks, and a
+    ## little in the past, so that nothing that changes while the
+    ## export runs, or that was saved just before it started but not
+    ## yet committed, can be missed.
+    watermark = datetime.datetime.now() - \
+        datetime.timedelta(seconds=settings.CLICKWORK_EXPORT_WATERMARK_LAG)
+    ## Check the filters before any cursor is touched, so that a bad
+    ## request leaves no trace.
     try:
-        data = project.export()
-        for key, val in data.items():
-            put("project-%s" % key, val)
-    except NotImplementedError:
-        pass
+        tasks = filter_tasks(completed_tasks(project), guts.parameters)
+    except ValueError, E:
+        return ErrorResponse("Bad filter",
+                             "The export could not be filtered: %s" % \
+                                 django.utils.html.escape(str(E)))
+    since = None
     try:
-        for task in completed_tasks:
-            task = ptype.cast(task)
-            task_data = task.export()
-            if type(task_data) == dict:
-                for key, val in task_data.items():
-                    put("task-%s-%s" % (task.id, key), val)
-            else:
-                put("task-%s" % taskid, task_data)
-    except NotImplementedError:
-        pass
-    zip.close()
-    if len(zip.infolist()) == 0:
-        return ErrorResponse("Empty export",
-                             "Project %s could not be exported; the export file is empty." % \
-                                 django.utils.html.escape(repr(project)))
-    buffer.seek(0)
+        if "since" in guts.parameters:
+            since = parse_watermark(guts.parameters["since"])
+        elif "cursor" in guts.parameters:
+            since = acknowledged_watermark(project, guts.parameters["cursor"],
+                                           guts.parameters.get("ack"))
+    except ValueError:
+        return ErrorResponse("Bad watermark",
+                             "The since or ack parameter is not a watermark.")
+    if since is not None:
+        ## as in changed_tasks
+        tasks = tasks.filter(modified__gt=since)
+    entries = export_entries(project, ptype, tasks, format)
+    if incremental:
+        entries = itertools.chain(entries, [manifest_entry(project, since, watermark)])
+    guts.log_info("Exporting project %s to the client, since %s, filtered by %s" % \
+                      (project.id, since, ", ".join(filtered) or "nothing"))
+    return AttachmentResponse("project-%s.zip" % project.id, "application/zip",
+                              zip_chunks(entries))
+
+def acknowledged_watermark(project, consumer, ack=None):
+    """Return the watermark that the given consumer of the project's
+    exports has last acknowledged, or None if it has never
+    acknowledged one.  ack, if given, is a watermark (as a string)
+    that the consumer is acknowledging now; the consumer's cursor is
+    moved forward to it, never back."""
+    if ack is None:
+        cursors = ExportCursor.objects.filter(project=project, consumer=consumer)
+        return cursors and cursors[0].watermark or None
+    ack = parse_watermark(ack)
+    cursor, created = ExportCursor.objects.get_or_create(
+        project=project, consumer=consumer, defaults={"watermark": ack})
+    if cursor.watermark < ack:
+        cursor.watermark = ack
+        cursor.full_clean()
+        cursor.save()
+    return cursor.watermark
+
+def cached_export(guts, project, format):
+    """Return the full export of the project in the given format from
+    the export cache, building it first if need be."""
+    marker = export_marker(project, format)
+    etag = '"%s"' % marker
+    if guts.meta.get("HTTP_IF_NONE_MATCH") == etag:
+        return NotModifiedResponse(etag)
+    export, created = ProjectExport.objects.get_or_create(project=project, marker=marker,
+                                                          defaults={"format": format})
+    if export.complete and not export.error and not os.path.exists(export.path):
+        ## someone has cleaned out the export directory
+        export.complete = False
+    if not export.complete:
+        if not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE:
+            ## send the file as it is written, rather than making the
+            ## client wait for all of it
+            chunks = export_chunks(export)
+            try:
+                first_chunk = chunks.next()
+            except StopIteration:
+                if export.id is None:
+                    ## the project changed in the meantime, and
+                    ## someone else has asked for its new export
+                    return cached_export(guts, project, format)
+                return ErrorResponse("Empty export", django.utils.html.escape(export.error))
+            guts.log_info("Exporting project %s to the client as it is built" % project.id)
+            return AttachmentResponse("project-%s.zip" % project.id, "application/zip",
+                                      itertools.chain([first_chunk], chunks))
+        else:
+            export.save()
+            return DefaultResponse({"message": "The export of project %s is being prepared "
+                                    "as export %s; try again later." % (project.id, export.id)},
+                                   status=202)
+    if export.error:
+        return ErrorResponse("Empty export", django.utils.html.escape(export.error))
     guts.log_info("Exporting project %s to the client" % project.id)
-    return AttachmentResponse("project-%s.zip" % project.id,
-                              "application/zip", buffer.read())
+    return FileAttachmentResponse("project-%s.zip" % project.id, "application/zip",
+                                  export.path, etag, guts.meta)
+
+#: How to get the number of seconds between two datetime columns.
+DURATION_SQL = "EXTRACT(EPOCH FROM (%(end)s - %(start)s))"
+
+def annotator_stats(project, agreement_sql=None):
+    """Return a list of dicts, one for each user who has annotated
+    the given project (in order of username), giving the number of
+    their responses, the median and 90th percentile of how many
+    seconds the responses took, how many responses they make per
+    hour spent on them, and the fraction of their responses to merged
+    tasks that agree with the task's result.  agreement_sql is the
+    project type's agreement_sql (see ProjectType); without it the
+    agreement is None.
+
+    Everything is worked out by the database, in one query.
+    PostgreSQL 9.1 has no percentile_cont, so the percentiles are
+    nearest-rank percentiles, found by numbering each user's
+    responses in order of duration with a window function."""
+    duration = DURATION_SQL % {"end": "r.end_time", "start": "r.start_time"}
+    if agreement_sql is None:
+        agrees = "CAST(NULL AS integer)"
+    else:
+        agrees = "CASE WHEN %s THEN 1 ELSE 0 END" % \
+            (agreement_sql % {"response": "r.id", "result": "res.id"})
+    cursor = connection.cursor()
+    cursor.execute("""SELECT u.username, COUNT(*),
+                             MIN(CASE WHEN 2 * d.nth >= d.n THEN d.duration END),
+                             MIN(CASE WHEN 10 * d.nth >= 9 * d.n THEN d.duration END),
+                             SUM(d.duration),
+                             SUM(d.merged), SUM(d.agrees)
+                      FROM (SELECT r.user_id, %(duration)s AS duration,
+                                   ROW_NUMBER() OVER (PARTITION BY r.user_id
+                                                      ORDER BY %(duration)s) AS nth,
+                                   COUNT(*) OVER (PARTITION BY r.user_id) AS n,
+                                   CASE WHEN res.id IS NULL THEN 0 ELSE 1 END AS merged,
+                                   CASE WHEN res.id IS NULL THEN NULL ELSE %(agrees)s END AS agrees
+                            FROM main_response AS r
+                                 JOIN main_task AS t ON (t.id = r.task_id)
+                                 LEFT JOIN main_result AS res ON (res.task_id = r.task_id)
+                            WHERE t.project_id = %%s) AS d
+                           JOIN auth_user AS u ON (u.id = d.user_id)
+                      GROUP BY u.username
+                      ORDER BY u.username""" % {"duration": duration, "agrees": agrees},
+                   [project.id])
+    stats = []
+    for username, responses, median, p90, total, merged, agreed in cursor.fetchall():
+        if merged and agreed is not None:
+            agreement = float(agreed) / merged
+            agreement_percent = int(round(agreement * 100))
+        else:
+            agreement = agreement_percent = None
+        stats.append({"username": username,
+                      "responses": responses,
+                      "median_duration": median,
+                      "p90_duration": p90,
+                      "per_hour": total and responses * 3600.0 / total or None,
+                      "agreement": agreement,
+                      "agreement_percent": agreement_percent})
+    return stats
 
 @http_basic_auth
 @login_required
 @get
 @project_owner_required
 def project_stats(guts, project):
-    user_response_counts = Response.objects.filter(task__project=project).values("user__username").annotate(Count("id"))
+    ptype = get_project_type(project)
+    annotators = annotator_stats(project, getattr(ptype, "agreement_sql", None))
+    ## the response counts on their own, as this page used to show
+    user_response_counts = [{"user__username": a["username"], "id__count": a["responses"]}
+                            for a in annotators]
     template = get_template("project/stats.html")
-    return TemplateResponse(template, {'user_response_counts': user_response_counts, 'project': project})
+    return TemplateResponse(template, {'user_response_counts': user_response_counts,
+                                       'annotators': annotators,
+                                       'project': project})
@@ -188,6 +188,7 @@ def unmerge(get, guts, task_id):
             project_type = get_project_type(task.project)
             task = project_type.cast(task)
             task.handle_unmerge()
+            Task.objects.filter(pk=task.pk).update(modified=datetime.datetime.now())
             wip = WorkInProgress(user=guts.user, task=task)
             wip.full_clean()
             wip.save()
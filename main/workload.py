@@ -0,0 +1,153 @@
+"""A process-wide cache of how many tasks each user can annotate and
+merge.
+
+The home page and the user overview both show these counts, and
+counting the tasks that Task.objects.can_annotate and can_merge
+return are the two heaviest queries in the system, so workload_counts
+remembers each user's counts for settings.CLICKWORK_WORKLOAD_CACHE_TTL
+seconds.  The counts are only ever shown as estimates, so being a
+little out of date is fine; but they are marked out of date early
+when the user's groups change, when a project's annotators or mergers
+change, when the user tags or merges a task, and when an upload to a
+project that the user annotates finishes.  Uploads are usually
+finished by the taskfactory, in another process, so each lookup also
+looks up the uploads that are newer than the newest one it has seen,
+or that were not complete yet when it last looked, which is a single
+cheap query.
+
+Only a user's first lookup waits for the counts.  After that, out of
+date counts are still returned as they are, and counted again in a
+background thread, to be returned from then on; unless uploads are
+processed inline, in which case they are counted again straight
+away."""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Max, Q
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+
+from main.models import Project, ProjectUpload, Response, Result, Task
+
+import threading
+import time
+
+## user id -> (when the counts were counted, or None if they are out
+## of date; the counts)
+_counts = {}
+_refreshing = set()
+## the id of the newest upload, and the ids of the uploads that were
+## not complete yet, when the uploads were last looked up
+_uploads = [None, set()]
+_lock = threading.Lock()
+
+def invalidate(user_ids=None):
+    """Mark the counts of the given users, or of all users, as out of
+    date."""
+    with _lock:
+        if user_ids is None:
+            user_ids = _counts.keys()
+        for user_id in user_ids:
+            if user_id in _counts:
+                _counts[user_id] = (None, _counts[user_id][1])
+
+def forget():
+    """Forget everyone's counts altogether, and which uploads have
+    been seen."""
+    with _lock:
+        _counts.clear()
+        _uploads[:] = [None, set()]
+
+def invalidate_annotators(project_ids):
+    """Mark the counts of the users who annotate any of the given
+    projects as out of date."""
+    invalidate(list(User.objects.filter(groups__annotator_for__in=project_ids)
+                    .values_list("id", flat=True).distinct()))
+
+def _check_uploads():
+    with _lock:
+        last_id, pending = _uploads[0], set(_uploads[1])
+    if last_id is None:
+        last_id = ProjectUpload.objects.aggregate(last=Max("id"))["last"] or 0
+        pending = set(ProjectUpload.objects.filter(complete=False).values_list("id", flat=True))
+    else:
+        query = Q(id__gt=last_id)
+        if pending:
+            query |= Q(id__in=pending)
+        uploads = list(ProjectUpload.objects.filter(query).values_list("id", "project", "complete"))
+        finished = set(project for id, project, complete in uploads if complete)
+        if finished:
+            invalidate_annotators(finished)
+        pending = set(id for id, project, complete in uploads if not complete)
+        last_id = max([last_id] + [id for id, project, complete in uploads])
+    with _lock:
+        _uploads[:] = [last_id, pending]
+
+def _count(user):
+    counts = (Task.objects.can_annotate(user).count(),
+              Task.objects.can_merge(user).count())
+    with _lock:
+        _counts[user.id] = (time.time(), counts)
+    return counts
+
+def _refresh(user):
+    try:
+        _count(user)
+    finally:
+        with _lock:
+            _refreshing.discard(user.id)
+        ## this thread had a database connection of its own
+        connection.close()
+
+def workload_counts(user):
+    """Return a (respondable, resolvable) pair of the (approximate)
+    numbers of tasks that the given user can annotate and merge."""
+    _check_uploads()
+    with _lock:
+        cached = _counts.get(user.id)
+    if cached is None:
+        return _count(user)
+    counted, counts = cached
+    if counted is not None and time.time() - counted <= settings.CLICKWORK_WORKLOAD_CACHE_TTL:
+        return counts
+    if not hasattr(settings, "PROCESS_INLINE") or settings.PROCESS_INLINE:
+        return _count(user)
+    with _lock:
+        if user.id in _refreshing:
+            return counts
+        _refreshing.add(user.id)
+    thread = threading.Thread(target=_refresh, args=(user,))
+    thread.daemon = True
+    thread.start()
+    return counts
+
+@receiver(m2m_changed, sender=User.groups.through)
+def on_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        ## instance is a user, and its groups changed
+        invalidate([instance.id])
+    elif pk_set is not None:
+        invalidate(pk_set)
+    else:
+        invalidate()
+
+@receiver(m2m_changed, sender=Project.annotators.through)
+@receiver(m2m_changed, sender=Project.mergers.through)
+def on_project_groups_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        invalidate()
+
+@receiver(post_save)
+def on_work_saved(sender, instance, created, **kwargs):
+    ## Tagging or merging a task makes the user's own counts out of
+    ## date straight away; other users find out when theirs expire.
+    if created and isinstance(instance, (Response, Result)):
+        invalidate([instance.user_id])
+
+@receiver(post_save, sender=ProjectUpload)
+def on_upload_saved(sender, instance, **kwargs):
+    if instance.complete:
+        invalidate_annotators([instance.project_id])
@@ -3,10 +3,13 @@ from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.sessions.backends.db import SessionStore
 from django.core.context_processors import csrf
 from django.core.urlresolvers import reverse
+from django.conf import settings
 import django.db.models
 from django.db.models.query import QuerySet
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect, HttpResponseServerError, HttpResponseNotFound, HttpResponseForbidden, HttpResponseNotAllowed, QueryDict, MultiValueDict, Http404
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect, HttpResponseServerError, HttpResponseNotFound, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotModified, QueryDict, MultiValueDict, Http404
 from django.template import RequestContext
+from django.utils.http import http_date, parse_http_date_safe
 from django.template.loader import get_template
 
 from base64 import b64encode
@@ -15,6 +18,7 @@ from urlparse import urlsplit, urlunsplit
 from datetime import datetime, date
 import simplejson as json
 
+import os
 import sys
 
 import logging
@@ -61,6 +65,7 @@ class RequestGuts(object):
             self.user = request.user
             self.session = request.session
             self.client_ip = request.META.get('HTTP_X_FORWARDED_FOR', None) or request.META.get("REMOTE_ADDR", None) or "unknown ip"
+            self.meta = request.META
         else:
             self.parameters = QueryDict("")
             self.files = MultiValueDict({})
@@ -73,6 +78,7 @@ class RequestGuts(object):
             else:
                 self.session = SessionStore()
             self.client_ip = "[NOT_HTTP]"
+            self.meta = {}
 
     def _log(self, level, message):
         logger.log(level, message, extra={"user": self.user.username,
@@ -217,30 +223,256 @@ class DefaultResponse(ResponseSeed):
         dump = json.dumps(self.data, cls=Encoder, indent=2)
         context.update({"json": dump})
         body = default_template.render(context)
-        return HttpResponse(body, content_type=HTML)
+        return HttpResponse(body, status=self.status, content_type=HTML)
 
     def sprout_json(self, context):
         body = json.dumps(self.data, cls=Encoder, indent=2)
         return HttpResponse(body, status=self.status, content_type=JSON)
 
+#: How many bytes of an attachment to read from a file at a time;
+#: a multiple of 3, so that each piece can be base64-encoded by itself.
+ATTACHMENT_BLOCK_SIZE = 48 * 1024
+
+def base64_chunks(pieces):
+    """Base64-encode a series of bytestrings a piece at a time,
+    yielding pieces of the encoding that add up to the encoding of
+    the whole.  Leftover bytes that don't make up a multiple of 3 are
+    carried over into the next piece."""
+    leftover = ""
+    for piece in pieces:
+        data = leftover + piece
+        cut = len(data) - len(data) % 3
+        leftover = data[cut:]
+        if cut:
+            yield b64encode(data[:cut])
+    if leftover:
+        yield b64encode(leftover)
+
 class AttachmentResponse(DefaultResponse):
-    """A response for returning an attached file."""
+    """A response for returning an attached file.  The contents may be
+    a bytestring, an iterable of bytestrings or a file-like object; in
+    the latter cases, the response streams the contents to the client
+    as they are generated or read, in HTML and JSON alike, rather than
+    holding them all in memory."""
     def __init__(self, name, content_type, contents):
         self.name = name
         self.content_type = content_type
         self.contents = contents
 
+    def pieces(self):
+        """Return the contents as an iterable of bytestrings."""
+        if isinstance(self.contents, basestring):
+            return [self.contents]
+        elif hasattr(self.contents, "read"):
+            return FileWrapper(self.contents, ATTACHMENT_BLOCK_SIZE)
+        else:
+            return self.contents
+
     def sprout_html(self, context):
-        response = HttpResponse(self.contents, content_type=self.content_type)
+        response = HttpResponse(self.pieces(), content_type=self.content_type)
         response["Content-Disposition"] = "attachment; filename=%s" % self.name
         return response
 
+    def json_chunks(self):
+        ## This is the same JSON object that json.dumps would produce,
+        ## but the base64-encoded contents are generated a piece at
+        ## a time.
+        yield '{\n  "name": %s,\n  "content_type": %s,\n  "contents_in_base64": "' % \
+            (json.dumps(self.name), json.dumps(self.content_type))
+        for chunk in base64_chunks(self.pieces()):
+            yield chunk
+        yield '"\n}'
+
     def sprout_json(self, context):
-        body = json.dumps({"name": self.name,
-                           "content_type": self.content_type,
-                           "contents_in_base64": b64encode(self.contents)},
-                          indent=2)
-        return HttpResponse(body, content_type=JSON)
+        return HttpResponse(self.json_chunks(), content_type=JSON)
+
+class RangeNotSatisfiable(WrapperException):
+    pass
+
+def parse_range(header, size):
+    """Given the value of a Range header and the size of a file,
+    return the (first, last) byte positions that the header asks for,
+    or None if the whole file should be sent instead: if there is no
+    header, if it asks for several ranges, or if it can't be parsed.
+    Raises RangeNotSatisfiable if the range lies beyond the file.
+
+    >>> parse_range("bytes=0-99", 1000), parse_range("bytes=900-", 1000)
+    ((0, 99), (900, 999))
+    >>> parse_range("bytes=-100", 1000), parse_range("bytes=500-2000", 1000)
+    ((900, 999), (500, 999))
+    >>> parse_range("bytes=0-1,5-6", 1000), parse_range("lines=1-2", 1000)
+    (None, None)
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, dash, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            ## a suffix range: the last so many bytes
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first, last = int(first), min(int(last or size - 1), size - 1)
+    except ValueError:
+        return None
+    if first > last:
+        if first >= size:
+            raise RangeNotSatisfiable()
+        return None
+    return first, last
+
+def file_range(path, first, last):
+    """Yield the bytes of the given file from position first to last,
+    inclusive, a block at a time."""
+    f = open(path, "rb")
+    try:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            block = f.read(min(remaining, ATTACHMENT_BLOCK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+class FileAttachmentResponse(AttachmentResponse):
+    """A response for returning an attached file that is already on
+    disk.  The file is streamed to the client, not read into memory.
+    If an etag is given, clients can use it in an If-None-Match
+    header (see NotModifiedResponse).
+
+    If settings.CLICKWORK_SENDFILE_HEADER is set, the file is not read
+    by Django at all: the response just names it in that header, and
+    the front web server sends it.  Otherwise, if the request's meta
+    (its META dict) is given, a Range header in it is honored, so that
+    an interrupted download can be resumed; an If-Range header holding
+    anything but the current etag makes the whole file be sent."""
+    def __init__(self, name, content_type, path, etag=None, meta=None):
+        self.name = name
+        self.content_type = content_type
+        self.path = path
+        self.etag = etag
+        self.meta = meta or {}
+
+    @property
+    def contents(self):
+        return open(self.path, "rb")
+
+    def sendfile_location(self):
+        """Return the value for the sendfile header: the path itself
+        for X-Sendfile, and for X-Accel-Redirect the internal URI that
+        the front web server serves the file at."""
+        if settings.CLICKWORK_SENDFILE_HEADER == "X-Accel-Redirect":
+            root = settings.CLICKWORK_SENDFILE_ROOT or settings.CLICKWORK_EXPORT_DIR
+            relative = os.path.relpath(self.path, root)
+            return settings.CLICKWORK_SENDFILE_PREFIX + relative.replace(os.sep, "/")
+        return self.path
+
+    def sprout_html(self, context):
+        size = os.path.getsize(self.path)
+        if settings.CLICKWORK_SENDFILE_HEADER:
+            ## the front web server deals with ranges itself
+            response = HttpResponse("", content_type=self.content_type)
+            response[settings.CLICKWORK_SENDFILE_HEADER] = self.sendfile_location()
+        else:
+            byte_range = None
+            if self.meta.get("HTTP_IF_RANGE", self.etag) == self.etag:
+                try:
+                    byte_range = parse_range(self.meta.get("HTTP_RANGE"), size)
+                except RangeNotSatisfiable:
+                    response = HttpResponse("", status=416, content_type=self.content_type)
+                    response["Content-Range"] = "bytes */%d" % size
+                    return response
+            if byte_range:
+                first, last = byte_range
+                response = HttpResponse(file_range(self.path, first, last), status=206,
+                                        content_type=self.content_type)
+                response["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+                response["Content-Length"] = str(last - first + 1)
+            else:
+                response = HttpResponse(self.pieces(), content_type=self.content_type)
+                response["Content-Length"] = str(size)
+            response["Accept-Ranges"] = "bytes"
+        response["Content-Disposition"] = "attachment; filename=%s" % self.name
+        if self.etag:
+            response["ETag"] = self.etag
+        return response
+
+class NotModifiedResponse(ResponseSeed):
+    """Use when the client already has the current version of the
+    page, as identified by the given ETag or last modification time
+    (in seconds since the epoch)."""
+    def __init__(self, etag=None, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def sprout(self, context, format):
+        response = HttpResponseNotModified()
+        if self.etag is not None:
+            response["ETag"] = self.etag
+        if self.last_modified is not None:
+            response["Last-Modified"] = http_date(self.last_modified)
+        return response
+
+class CompactJSONResponse(ResponseSeed):
+    """JSON-serializable data for programs rather than people: it is
+    sent as JSON without any indentation, whatever response format is
+    asked for, along with an ETag identifying this version of the
+    data and the time it was last modified (in seconds since the
+    epoch), if they are given (see NotModifiedResponse)."""
+    def __init__(self, data, etag=None, last_modified=None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def sprout(self, context, format):
+        body = json.dumps(self.data, cls=Encoder, separators=(",", ":"))
+        response = HttpResponse(body, content_type=JSON)
+        if self.etag is not None:
+            response["ETag"] = self.etag
+        if self.last_modified is not None:
+            response["Last-Modified"] = http_date(self.last_modified)
+        return response
+
+def modified_since(meta, last_modified):
+    """Given a request's META dict and the time, in seconds since the
+    epoch, at which the requested data was last modified, return
+    False if the request's If-Modified-Since header shows that the
+    client already has that version of the data, and True otherwise.
+
+    >>> modified_since({}, 1000000000)
+    True
+    >>> modified_since({"HTTP_IF_MODIFIED_SINCE": http_date(1000000000)}, 1000000000)
+    False
+    >>> modified_since({"HTTP_IF_MODIFIED_SINCE": http_date(1000000000)}, 1000000001)
+    True
+    >>> modified_since({"HTTP_IF_MODIFIED_SINCE": "yesterday"}, 1000000000)
+    True
+    """
+    since = parse_http_date_safe(meta.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return since is None or int(last_modified) > since
+
+def not_modified(meta, etag, last_modified=None):
+    """Given a request's META dict, and the ETag and last modification
+    time (in seconds since the epoch, or None) of the requested data,
+    return whether the client already has that version of the data.
+    If-None-Match is used if the request sends it, and
+    If-Modified-Since otherwise.
+
+    >>> not_modified({"HTTP_IF_NONE_MATCH": '"a"'}, '"a"')
+    True
+    >>> not_modified({"HTTP_IF_NONE_MATCH": '"b"',
+    ...               "HTTP_IF_MODIFIED_SINCE": http_date(1000000000)}, '"a"', 1000000000)
+    False
+    >>> not_modified({"HTTP_IF_MODIFIED_SINCE": http_date(1000000000)}, '"a"', 1000000000)
+    True
+    >>> not_modified({"HTTP_IF_MODIFIED_SINCE": http_date(1000000000)}, '"a"')
+    False
+    """
+    if "HTTP_IF_NONE_MATCH" in meta:
+        return meta["HTTP_IF_NONE_MATCH"] == etag
+    return last_modified is not None and not modified_since(meta, last_modified)
 
 class TemplateResponse(DefaultResponse):
     """A normal response involving data that can be sent to fill in a
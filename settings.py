@@ -105,6 +105,43 @@ EMAIL_FROM = "Clickwork <clickwork@example.com>"
 ## in the archive that is created when a project is exported.
 CLICKWORK_EXPORT_FILE_PERMISSIONS = 0444
 
+## Tasks are handed to their project type's export_batch method in
+## batches of this many tasks when a project is exported.
+CLICKWORK_EXPORT_BATCH_SIZE = 500
+
+## If this is more than 1, the batches of tasks are rendered for
+## export by this many worker processes, which helps project types
+## whose export methods do a lot of work.
+CLICKWORK_EXPORT_WORKERS = 1
+
+## Each task's export is cached until the task, or its responses or
+## result, change.  Turn this off if a project type's exports depend on
+## anything else, or if tasks are changed with QuerySet.update().
+CLICKWORK_EXPORT_TASK_CACHE = True
+
+## The watermark in an incremental export's manifest is taken this
+## many seconds before the export starts, so that responses that were
+## still being saved at the time turn up in the next export.  It
+## should be longer than any transaction that saves a response.
+CLICKWORK_EXPORT_WATERMARK_LAG = 5
+
+## Full exports of projects are kept in this directory, and served
+## again for as long as the project does not change.
+CLICKWORK_EXPORT_DIR = os.path.join(BASE_PATH, 'exports')
+
+## If the front web server can send files from disk by itself, set
+## this to the header it looks for: "X-Sendfile" (Apache with
+## mod_xsendfile, lighttpd) or "X-Accel-Redirect" (nginx), and
+## exports will be handed over to it instead of being read by Django.
+## nginx wants a URI rather than a path: a file under
+## CLICKWORK_SENDFILE_ROOT (by default, None, CLICKWORK_EXPORT_DIR) is
+## named by CLICKWORK_SENDFILE_PREFIX plus its path below the root, so
+## the prefix should be an internal location that serves that
+## directory.
+CLICKWORK_SENDFILE_HEADER = None
+CLICKWORK_SENDFILE_ROOT = None
+CLICKWORK_SENDFILE_PREFIX = "/internal/exports/"
+
 ## These are the usernames of people who should not both annotate the
 ## same task.  E.g., (("a", "b"), ("c", "d", "e")) means that if "a"
 ## is one annotator for a task, then "b" should not be the other, and
@@ -112,6 +149,50 @@ CLICKWORK_EXPORT_FILE_PERMISSIONS = 0444
 ## other.
 CLICKWORK_KEEP_APART = (("TEST_EXCLUSION_1", "TEST_EXCLUSION_2"),)
 
+## Uploads to project types that can process their input a row at a
+## time are committed in chunks of this many rows, so that an upload
+## that is interrupted can be resumed from the last committed chunk.
+CLICKWORK_UPLOAD_CHUNK_SIZE = 1000
+
+## If this is more than 1, uncompressed uploads bigger than
+## CLICKWORK_UPLOAD_SHARD_SIZE bytes are split into shards of about
+## that size, which are parsed by this many worker processes.
+CLICKWORK_UPLOAD_WORKERS = 1
+CLICKWORK_UPLOAD_SHARD_SIZE = 16 * 1024 * 1024
+
+## When a project is emptied, its tasks are deleted in chunks of this
+## many tasks at a time.
+CLICKWORK_PURGE_CHUNK_SIZE = 500
+
+## The usernames of each group's members are cached in each process,
+## and forgotten as soon as that process sees them change; since other
+## processes can change them too, they are also forgotten after this
+## many seconds.
+CLICKWORK_GROUP_CACHE_TTL = 300
+
+## The project page lists the project's tasks this many at a time.
+CLICKWORK_TASK_PAGE_SIZE = 500
+
+## The overview of users lists this many users at a time.
+CLICKWORK_USER_PAGE_SIZE = 200
+
+## How long, in seconds, to remember how many tasks each user can
+## annotate and merge (see main/workload.py).
+CLICKWORK_WORKLOAD_CACHE_TTL = 60
+
+## How often, in seconds, the taskfactory rebuilds the snapshots of
+## the overview pages (see the build_snapshots management command);
+## None means that it never does.
+CLICKWORK_SNAPSHOT_INTERVAL = None
+
+## The overview pages are served from snapshots no older than this
+## many seconds, when there are any.
+CLICKWORK_SNAPSHOT_MAX_AGE = 900
+
+## The most items that one request to the JSON API (see
+## main/views/api.py) can get.
+CLICKWORK_API_PAGE_SIZE = 100
+
 try:
     from local_settings import *
 except ImportError: